@@ -0,0 +1,59 @@
+""" Time CherryPick._build_patch_tree against the number of changed paths
+
+Usage:
+    python benchmarks/bench_patch_tree.py [max_paths]
+
+Prints the build time per path for 1k up to `max_paths` (default 100k)
+synthetic paths. Linear scaling shows up as a flat time per path.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ghpick.cherry import CherryPick
+
+def make_summary(count, fanout=10, depth=5):
+    """ count paths spread over a `fanout`-wide, `depth`-deep directory tree """
+    summary = []
+    for i in xrange(count):
+        dirs = []
+        n = i
+        for _ in xrange(depth):
+            dirs.append('d{}'.format(n % fanout))
+            n //= fanout
+        path = '/'.join(dirs + ['file_{}.txt'.format(i)])
+        summary.append(dict(path=path, mode=None, is_deleted=i % 7 == 0))
+    return summary
+
+def walk(node):
+    count = 0
+    for name, child in node.iteritems():
+        count += 1 if child.is_file else walk(child)
+    return count
+
+def main(max_paths=100000):
+    cherry = CherryPick(username='bench', password='bench',
+                        org='bench', repo='bench')
+    print "{:>8} {:>10} {:>14} {:>10}".format(
+        'paths', 'build (s)', 'per path (us)', 'walk (s)')
+
+    count = 1000
+    while count <= max_paths:
+        cherry.patch_summary = make_summary(count)
+
+        start = time.time()
+        cherry._build_patch_tree()
+        built = time.time() - start
+
+        start = time.time()
+        assert walk(cherry.patch_tree) == count
+        walked = time.time() - start
+
+        print "{:>8} {:>10.3f} {:>14.2f} {:>10.3f}".format(
+            count, built, built / count * 1e6, walked)
+        count *= 10
+
+if __name__ == '__main__':
+    main(*[ int(x) for x in sys.argv[1:] ])
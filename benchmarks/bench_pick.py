@@ -0,0 +1,260 @@
+""" Measure CherryPick.patch() and commit() against synthetic repositories
+
+Each scenario generates a repository (see synthetic.py), serves it with
+a git backed fake Github (see fakegithub.py) and picks the source
+branch's commit onto the target branch in a child process. The new
+commit's tree is checked against what `git apply` makes of the same
+commit.
+
+Usage:
+    python benchmarks/bench_pick.py [--full] [--scenario NAME ...]
+        [--workers N] [--applier git|python] [--fetch-strategy NAME]
+        [--tree-strategy NAME] [--latency SECONDS]
+        [--rate-limit N] [--secondary-every N] [--warm] [--save] [--check]
+
+Reports wall time, requests, bytes sent and received, and the pick's
+peak memory and how much it grew while picking (the peak includes what
+the child inherited when it was forked).
+
+With --warm each scenario is picked twice sharing an ObjectStore, with
+the target branch put back in between, and the second pick is measured.
+
+Results are compared with the baseline stored in baselines.json for the
+same options; --save replaces it, and --check exits with 1 if anything
+regressed.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+import requests
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, os.path.join(here, '..', 'test'))
+
+from ghpick.cherry import CherryPick
+from ghpick.objectstore import ObjectStore
+from ghpick_server import LocalGithub
+from fakegithub import GitBackedGithub
+from synthetic import make_repo, expected_tree
+
+SCENARIOS = [
+    dict(name='1_file', files=1, depth=0, modify=1),
+    dict(name='10_files', files=20, modify=6, add=2, delete=2),
+    dict(name='100_files', files=200, modify=60, add=20, delete=20),
+    dict(name='100_large_files', files=100, size=256 * 1024, modify=100),
+    # Peak memory should stay well under one file's size
+    dict(name='4_huge_files', files=4, depth=0, size=32 * 1024 * 1024, modify=4),
+    dict(name='1k_files', files=2000, depth=3, modify=600, add=200, delete=200),
+    dict(name='1k_files_deep', files=2000, depth=10, fanout=2,
+         modify=600, add=200, delete=200),
+    dict(name='10k_files', files=12000, depth=3, modify=6000, add=2000,
+         delete=2000, full=True),
+]
+
+BASELINES = os.path.join(here, 'baselines.json')
+
+# A result regresses if it's this much worse than the baseline...
+TOLERANCE = 0.25
+# ...and worse by more than this much, so tiny numbers don't flap
+MINIMUM = dict(seconds=0.05, requests=0, bytes=4096, memory_growth_mb=2)
+
+def _stats(base_url):
+    return requests.get(base_url + '/_bench/stats').json()
+
+def _memory_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def _pick(base_url, shas, options, results):
+    """ Runs in the child process, so its memory is the pick's alone """
+    # The engine logs the 404s for files the pick creates as errors
+    logging.disable(logging.ERROR)
+    try:
+        start_memory = _memory_mb()
+        options = dict(options)
+        if options.get('object_store'):
+            options['object_store'] = ObjectStore(options['object_store'])
+        cherry = CherryPick(username='bench', password='bench', org='bench',
+                            repo='bench', base_url=base_url, **options)
+        phases = []
+        for phase, call in (('patch', lambda: cherry.patch(shas['source'], 'target')),
+                            ('commit', lambda: cherry.commit())):
+            before = _stats(base_url)
+            started = time.time()
+            call()
+            seconds = time.time() - started
+            after = _stats(base_url)
+            phases.append(dict(
+                phase=phase,
+                seconds=seconds,
+                requests=after['requests'] - before['requests'],
+                bytes_sent=after['request_bytes'] - before['request_bytes'],
+                bytes_received=after['response_bytes'] - before['response_bytes'],
+                rate_limited=after['rate_limited'] - before['rate_limited']))
+        store = cherry.engine.object_store_stats()
+        results.put(dict(phases=phases,
+                         memory_mb=_memory_mb(),
+                         memory_growth_mb=_memory_mb() - start_memory,
+                         store_hit_rate=store and store['hit_rate']))
+    except Exception as e:
+        results.put(dict(error='{}: {}'.format(type(e).__name__, e)))
+
+def _run_pick(server, shas, options):
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(
+        target=_pick, args=(server.base_url, shas, options, results))
+    child.start()
+    result = results.get()
+    child.join()
+    return result
+
+def run_scenario(scenario, options, server_options, warm=False):
+    """ Generate, serve and pick one scenario. Returns its results. """
+    repo_options = dict((k, v) for k, v in scenario.items()
+                        if k not in ('name', 'full'))
+    path = tempfile.mkdtemp(prefix='ghpick_bench')
+    try:
+        shas = make_repo(path, **repo_options)
+        github = GitBackedGithub(path, **server_options)
+        if warm:
+            options = dict(options, object_store=os.path.join(path, 'objects'))
+        try:
+            with LocalGithub(github) as server:
+                result = _run_pick(server, shas, options)
+                if warm and 'error' not in result:
+                    github.refs['heads/target'] = shas['target']
+                    result = _run_pick(server, shas, options)
+        finally:
+            github.close()
+        if 'error' in result:
+            return result
+
+        commit = github.commit_json(github.refs['heads/target'])
+        result['ok'] = commit['tree']['sha'] == expected_tree(
+            path, shas['source'], shas['target'])
+        result['seconds'] = sum(x['seconds'] for x in result['phases'])
+        result['requests'] = sum(x['requests'] for x in result['phases'])
+        result['bytes'] = sum(x['bytes_sent'] + x['bytes_received']
+                              for x in result['phases'])
+        return result
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+def config_key(options, server_options):
+    items = sorted(options.items()) + sorted(server_options.items())
+    return ','.join('{}={}'.format(k, v) for k, v in items)
+
+def regressions(result, baseline):
+    """ Names of the measures where result is worse than baseline """
+    worse = []
+    # Not the peak, which counts whatever the server had grown to when
+    # the pick was forked from it
+    for measure in ('seconds', 'requests', 'bytes', 'memory_growth_mb'):
+        old, new = baseline[measure], result[measure]
+        if new - old > max(old * TOLERANCE, MINIMUM[measure]):
+            worse.append(measure)
+    return worse
+
+def _change(new, old):
+    if not old:
+        return ''
+    return '{:+.0%}'.format((new - old) / float(old))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scenario', action='append',
+                        help='Only run the named scenario(s)')
+    parser.add_argument('--full', action='store_true',
+                        help='Include the 10k file scenario')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--applier', default='git')
+    parser.add_argument('--fetch-strategy', default='contents')
+    parser.add_argument('--tree-strategy', default='recursive')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--rate-limit', type=int)
+    parser.add_argument('--secondary-every', type=int)
+    parser.add_argument('--warm', action='store_true',
+                        help='Measure a second pick sharing an object store')
+    parser.add_argument('--save', action='store_true',
+                        help='Store the results as the baseline')
+    parser.add_argument('--check', action='store_true',
+                        help='Exit with 1 if anything regressed')
+    args = parser.parse_args(argv)
+
+    options = dict(workers=args.workers, applier=args.applier,
+                   fetch_strategy=args.fetch_strategy,
+                   tree_strategy=args.tree_strategy)
+    server_options = dict(latency=args.latency)
+    if args.rate_limit:
+        server_options['rate_limit'] = args.rate_limit
+    if args.secondary_every:
+        server_options['secondary_every'] = args.secondary_every
+    key = config_key(options, server_options)
+    if args.warm:
+        key += ',warm=True'
+
+    baselines = dict()
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as f:
+            baselines = json.load(f)
+    baseline = baselines.get(key, dict())
+
+    scenarios = [ s for s in SCENARIOS
+                  if (args.scenario and s['name'] in args.scenario) or
+                  (not args.scenario and (args.full or not s.get('full'))) ]
+
+    print key
+    print "{:<16} {:>8} {:>8} {:>8} {:>8} {:>10} {:>8} {:>8}  {}".format(
+        'scenario', 'patch s', 'commit s', 'total s', 'requests', 'KB', 'peak MB',
+        'grew MB', '')
+    results = dict()
+    failed = False
+    for scenario in scenarios:
+        result = run_scenario(scenario, options, server_options, args.warm)
+        name = scenario['name']
+        if 'error' in result:
+            print "{:<16} {}".format(name, result['error'])
+            failed = True
+            continue
+        results[name] = result
+
+        notes = []
+        if not result['ok']:
+            notes.append('WRONG TREE')
+            failed = True
+        if result['store_hit_rate'] is not None:
+            notes.append('{:.0%} from store'.format(result['store_hit_rate']))
+        old = baseline.get(name)
+        if old:
+            notes.append('vs baseline: {} time, {} requests'.format(
+                _change(result['seconds'], old['seconds']),
+                _change(result['requests'], old['requests'])))
+            worse = regressions(result, old)
+            if worse:
+                notes.append('REGRESSED: ' + ', '.join(worse))
+                failed = True
+        patch, commit = result['phases']
+        print "{:<16} {:>8.3f} {:>8.3f} {:>8.3f} {:>8} {:>10.1f} {:>8.1f} {:>8.1f}  {}".format(
+            name, patch['seconds'], commit['seconds'], result['seconds'],
+            result['requests'], result['bytes'] / 1024.0, result['memory_mb'],
+            result['memory_growth_mb'], '; '.join(notes))
+
+    if args.save:
+        baselines.setdefault(key, dict()).update(results)
+        with open(BASELINES, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.check and failed:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,424 @@
+""" A stand-in Github REST API backed by a real local git repository
+
+Objects are read from the repository through one long running
+`git cat-file --batch`, and the blobs, trees and commits the API creates
+are written into it as loose objects, so their SHAs are the ones Github
+would give. Branches live in memory, starting from the repository's.
+
+Latency and rate limits can be injected to see how picks behave against
+a slow or busy Github.
+
+Usage:
+    github = GitBackedGithub('/path/to/repo', latency=0.01)
+    with LocalGithub(github) as server:
+        cherry = CherryPick(..., base_url=server.base_url)
+"""
+import os
+import re
+import json
+import time
+import zlib
+import calendar
+import urlparse
+import threading
+import subprocess
+
+from hashlib import sha1
+from base64 import b64encode, b64decode
+
+class GitObjects(object):
+    """ Read and write the objects of a git repository """
+
+    def __init__(self, path):
+        self.path = path
+        self.git_dir = subprocess.check_output(
+            ['git', 'rev-parse', '--absolute-git-dir'], cwd=path).strip()
+        self._written = dict()
+        self._lock = threading.Lock()
+        self._batch = subprocess.Popen(
+            ['git', 'cat-file', '--batch'], cwd=path,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def close(self):
+        self._batch.stdin.close()
+        self._batch.wait()
+
+    def git(self, *args, **kwargs):
+        return subprocess.check_output(('git',) + args, cwd=self.path, **kwargs)
+
+    def read(self, sha):
+        """ Returns (type, body), or (None, None) if there's no such object """
+        written = self._written.get(sha)
+        if written is not None:
+            return written
+        with self._lock:
+            self._batch.stdin.write(sha + '\n')
+            self._batch.stdin.flush()
+            header = self._batch.stdout.readline().split()
+            if header[-1] == 'missing':
+                return None, None
+            body = self._batch.stdout.read(int(header[2]))
+            self._batch.stdout.read(1)
+        return header[1], body
+
+    def write(self, kind, body):
+        """ Store an object, returns its SHA """
+        data = '{} {}\0'.format(kind, len(body)) + body
+        sha = sha1(data).hexdigest()
+        if sha in self._written:
+            return sha
+        directory = os.path.join(self.git_dir, 'objects', sha[:2])
+        filename = os.path.join(directory, sha[2:])
+        if not os.path.exists(filename):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+            tmp = '{}.{}.tmp'.format(filename, threading.current_thread().ident)
+            with open(tmp, 'wb') as f:
+                f.write(zlib.compress(data, 1))
+            os.rename(tmp, filename)
+        self._written[sha] = (kind, body)
+        return sha
+
+    def read_tree(self, sha):
+        """ Returns [(mode, name, sha)] for a tree, or for a commit's tree """
+        kind, body = self.read(sha)
+        if kind == 'commit':
+            kind, body = self.read(self.parse_commit(body)['tree'])
+        if kind != 'tree':
+            raise KeyError(sha)
+        entries = []
+        pos = 0
+        while pos < len(body):
+            space = body.index(' ', pos)
+            nul = body.index('\0', space)
+            entries.append((body[pos:space], body[space + 1:nul],
+                            body[nul + 1:nul + 21].encode('hex')))
+            pos = nul + 21
+        return entries
+
+    def write_tree(self, entries):
+        """ entries is [(mode, name, sha)], in any order """
+        def key(entry):
+            mode, name, _ = entry
+            return name + '/' if mode == '40000' else name
+        body = ''.join('{} {}\0{}'.format(mode, name, sha.decode('hex'))
+                       for mode, name, sha in sorted(entries, key=key))
+        return self.write('tree', body)
+
+    @staticmethod
+    def parse_commit(body):
+        headers, _, message = body.partition('\n\n')
+        commit = dict(parents=[], message=message)
+        for line in headers.split('\n'):
+            key, _, value = line.partition(' ')
+            if key == 'parent':
+                commit['parents'].append(value)
+            elif key in ('tree', 'author', 'committer'):
+                commit[key] = value
+        return commit
+
+def _mode(mode):
+    """ Github sends '040000' for trees, git objects say '40000' """
+    return '{:o}'.format(int(mode, 8))
+
+person_re = re.compile(r'^(.*) <(.*)> (\d+) ([+-]\d{4})$')
+
+def _person_json(value):
+    name, email, timestamp, _ = person_re.match(value).groups()
+    date = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(int(timestamp)))
+    return dict(name=name, email=email, date=date)
+
+def _person_line(person):
+    timestamp = int(time.time())
+    if person.get('date'):
+        timestamp = calendar.timegm(time.strptime(person['date'], '%Y-%m-%dT%H:%M:%SZ'))
+    return '{} <{}> {} +0000'.format(person['name'], person['email'], timestamp)
+
+class GitBackedGithub(object):
+    """ Enough of the Github REST API, served from a git repository, for picks
+
+    Pass an instance to LocalGithub as its handler.
+
+    Attributes:
+        latency (float): Seconds added to every response
+        rate_limit (int): Requests allowed per `rate_limit_window` seconds.
+            Once spent, requests get 403 until the window resets. None
+            means unlimited, and no rate limit headers are sent.
+        secondary_every (int): Answer every Nth request with a 429
+        secondary_retry_after (float): The Retry-After sent with those
+        stats: Counts of requests and bytes in and out. Served as JSON
+            from /_bench/stats too, for picks running in another process.
+    """
+    prefix = '/repos/bench/bench'
+
+    def __init__(self, path, latency=0, rate_limit=None, rate_limit_window=60,
+                 secondary_every=None, secondary_retry_after=0.1):
+        self.objects = GitObjects(path)
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.secondary_every = secondary_every
+        self.secondary_retry_after = secondary_retry_after
+        self.refs = dict()
+        for line in self.objects.git('for-each-ref', '--format=%(objectname) %(refname)').splitlines():
+            sha, name = line.split(' ', 1)
+            self.refs[name[len('refs/'):]] = sha
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = dict(requests=0, request_bytes=0, response_bytes=0,
+                          rate_limited=0, by_endpoint=dict())
+        self._window_start = time.time()
+        self._window_used = 0
+
+    def close(self):
+        self.objects.close()
+
+    def __call__(self, method, path, headers, body):
+        if path == '/_bench/stats':
+            return 200, {}, json.dumps(self.stats)
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['request_bytes'] += len(body or '')
+            limited = self._rate_limit()
+        if limited is not None:
+            status, headers, payload = limited
+        else:
+            try:
+                status, headers, payload = self.route(
+                    method, path, headers, json.loads(body) if body else None)
+            except KeyError:
+                status, headers, payload = 404, {}, dict(message='Not Found')
+
+        if not isinstance(payload, basestring):
+            payload = json.dumps(payload)
+            headers.setdefault('Content-Type', 'application/json')
+        headers.update(self._rate_limit_headers())
+        with self.lock:
+            self.stats['response_bytes'] += len(payload)
+            endpoint = '{} {}'.format(method, self._endpoint(path))
+            by_endpoint = self.stats['by_endpoint']
+            by_endpoint[endpoint] = by_endpoint.get(endpoint, 0) + 1
+        return status, headers, payload
+
+    def _endpoint(self, path):
+        parts = urlparse.urlparse(path).path[len(self.prefix) + 1:].split('/')
+        return '/'.join(parts[:2] if parts[0] == 'git' else parts[:1])
+
+    def _rate_limit(self):
+        """ Returns the response for a rate limited request, else None """
+        if self.secondary_every and self.stats['requests'] % self.secondary_every == 0:
+            self.stats['rate_limited'] += 1
+            return 429, {'Retry-After': str(self.secondary_retry_after)}, \
+                dict(message='You have exceeded a secondary rate limit')
+        if self.rate_limit is None:
+            return None
+        if time.time() - self._window_start >= self.rate_limit_window:
+            self._window_start = time.time()
+            self._window_used = 0
+        if self._window_used >= self.rate_limit:
+            self.stats['rate_limited'] += 1
+            return 403, {}, dict(message='API rate limit exceeded')
+        self._window_used += 1
+        return None
+
+    def _rate_limit_headers(self):
+        if self.rate_limit is None:
+            return {}
+        return {'X-RateLimit-Limit': str(self.rate_limit),
+                'X-RateLimit-Remaining': str(max(self.rate_limit - self._window_used, 0)),
+                'X-RateLimit-Reset': str(int(self._window_start + self.rate_limit_window))}
+
+    def route(self, method, path, headers, body):
+        url = urlparse.urlparse(path)
+        query = dict(urlparse.parse_qsl(url.query))
+        parts = url.path[len(self.prefix) + 1:].split('/')
+
+        if parts[:2] == ['git', 'refs']:
+            name = '/'.join(parts[2:])
+            if method == 'PATCH':
+                self.refs[name] = body['sha']
+            return 200, {}, dict(ref='refs/' + name,
+                                 object=dict(sha=self.refs[name], type='commit'))
+        if parts[:2] == ['git', 'blobs']:
+            if method == 'POST':
+                content = body['content']
+                if body.get('encoding') == 'base64':
+                    content = b64decode(content)
+                else:
+                    content = content.encode('utf-8')
+                return 201, {}, dict(sha=self.objects.write('blob', content))
+            kind, content = self.objects.read(parts[2])
+            if kind != 'blob':
+                raise KeyError(parts[2])
+            if headers.get('Accept', '').endswith('.raw'):
+                return 200, {'Content-Type': 'application/octet-stream'}, content
+            return 200, {}, dict(sha=parts[2], encoding='base64',
+                                 content=b64encode(content), size=len(content))
+        if parts[:2] == ['git', 'trees']:
+            if method == 'POST':
+                return 201, {}, self.tree_json(self.create_tree(body))
+            return 200, {}, self.tree_json(parts[2], bool(query.get('recursive')))
+        if parts[:2] == ['git', 'commits']:
+            if method == 'POST':
+                return 201, {}, self.commit_json(self.create_commit(body))
+            return 200, {}, self.commit_json(parts[2])
+        if parts[0] == 'commits':
+            if len(parts) > 1:
+                return 200, {}, self.repo_commit_json(parts[1])
+            return 200, {}, self.list_commits(query['sha'])
+        if parts[0] == 'contents':
+            file_path = '/'.join(parts[1:])
+            sha = self.lookup(query['ref'], file_path)
+            _, content = self.objects.read(sha)
+            if headers.get('Accept', '').endswith('.raw'):
+                return 200, {'Content-Type': 'application/octet-stream'}, content
+            return 200, {}, dict(path=file_path, sha=sha, encoding='base64',
+                                 content=b64encode(content))
+        if parts[0] == 'compare':
+            base, head = parts[1].split('...')
+            accept = headers.get('Accept', '')
+            if accept.endswith('.patch'):
+                with open(os.devnull, 'w') as devnull:
+                    # Quiet the warning that big diffs skip rename detection
+                    patch = self.objects.git('format-patch', '--stdout',
+                                             '{}..{}'.format(base, head),
+                                             stderr=devnull)
+                return 200, {'Content-Type': 'text/plain'}, patch
+            if accept.endswith('.diff'):
+                return 200, {'Content-Type': 'text/plain'}, \
+                    self.objects.git('diff', base, head)
+            return 200, {}, self.comparison_json(base, head)
+        raise KeyError(path)
+
+    def lookup(self, ref, path):
+        """ Returns the SHA at `path` in the commit or tree `ref` """
+        sha = ref
+        for name in path.split('/'):
+            for mode, entry_name, entry_sha in self.objects.read_tree(sha):
+                if entry_name == name:
+                    sha = entry_sha
+                    break
+            else:
+                raise KeyError(path)
+        return sha
+
+    def tree_json(self, sha, recursive=False):
+        kind, body = self.objects.read(sha)
+        if kind == 'commit':
+            sha = GitObjects.parse_commit(body)['tree']
+        entries = []
+
+        def walk(tree_sha, prefix):
+            for mode, name, entry_sha in self.objects.read_tree(tree_sha):
+                is_tree = mode == '40000'
+                entries.append(dict(path=prefix + name,
+                                    mode=mode.zfill(6),
+                                    type='tree' if is_tree else 'blob',
+                                    sha=entry_sha))
+                if is_tree and recursive:
+                    walk(entry_sha, prefix + name + '/')
+
+        walk(sha, '')
+        return dict(sha=sha, tree=entries, truncated=False)
+
+    def create_tree(self, body):
+        """ Apply the entries, whose paths may be nested, to the base tree """
+        root = self._load(body.get('base_tree'))
+        for entry in body['tree']:
+            names = entry['path'].split('/')
+            node = root
+            for name in names[:-1]:
+                child = node.get(name)
+                if child is None or child[0] != '40000':
+                    child = node[name] = ('40000', dict())
+                elif not isinstance(child[1], dict):
+                    # Only subtrees on an edited path are read
+                    child = node[name] = ('40000', self._load(child[1]))
+                node = child[1]
+            if entry['sha'] is None:
+                node.pop(names[-1], None)
+            else:
+                node[names[-1]] = (_mode(entry['mode']), entry['sha'])
+        return self._store(root)
+
+    def _load(self, sha):
+        """ A tree as name -> (mode, sha) """
+        if sha is None:
+            return dict()
+        return dict((name, (mode, entry_sha))
+                    for mode, name, entry_sha in self.objects.read_tree(sha))
+
+    def _store(self, node):
+        """ Write a tree whose edited subtrees are dicts """
+        entries = []
+        for name, (mode, value) in node.items():
+            if isinstance(value, dict):
+                if not value:
+                    # git doesn't keep empty directories
+                    continue
+                value = self._store(value)
+            entries.append((mode, name, value))
+        return self.objects.write_tree(entries)
+
+    def create_commit(self, body):
+        author = _person_line(body['author'])
+        committer = _person_line(body.get('committer') or dict(
+            name='Bench Committer', email='bench@example.com'))
+        lines = ['tree ' + body['tree']]
+        lines.extend('parent ' + parent for parent in body['parents'])
+        lines.append('author ' + author)
+        lines.append('committer ' + committer)
+        return self.objects.write('commit', '\n'.join(lines) + '\n\n' + body['message'])
+
+    def commit_json(self, sha):
+        kind, body = self.objects.read(sha)
+        if kind != 'commit':
+            raise KeyError(sha)
+        commit = GitObjects.parse_commit(body)
+        return dict(sha=sha,
+                    tree=dict(sha=commit['tree']),
+                    parents=[ dict(sha=p) for p in commit['parents'] ],
+                    message=commit['message'],
+                    author=_person_json(commit['author']),
+                    committer=_person_json(commit['committer']))
+
+    def files_json(self, base, head):
+        """ The files changed between two commits, as compare lists them """
+        statuses = dict(A='added', D='removed', M='modified', T='modified')
+        files = []
+        for line in self.objects.git('diff-tree', '-r', base, head).splitlines():
+            info, filename = line.split('\t', 1)
+            _, _, _, sha, status = info.split()
+            files.append(dict(filename=filename, sha=sha,
+                              status=statuses.get(status, 'modified')))
+        return files
+
+    def repo_commit_json(self, sha, files=True):
+        """ A commit as the commits and compare APIs give it """
+        commit = self.commit_json(sha)
+        result = dict(sha=sha, parents=commit['parents'], commit=commit)
+        if files:
+            parent = commit['parents'][0]['sha'] if commit['parents'] else \
+                self.objects.git('hash-object', '-t', 'tree', '/dev/null').strip()
+            result['files'] = self.files_json(parent, sha)
+        return result
+
+    def comparison_json(self, base, head):
+        shas = self.objects.git('rev-list', '--reverse', '--max-count=250',
+                                '{}..{}'.format(base, head)).split()
+        total = len(self.objects.git('rev-list', '{}..{}'.format(base, head)).split())
+        return dict(base_commit=self.repo_commit_json(base, files=False),
+                    total_commits=total,
+                    commits=[ self.repo_commit_json(x, files=False) for x in shas ],
+                    files=self.files_json(base, head))
+
+    def list_commits(self, sha):
+        shas = self.objects.git('rev-list', '--max-count=100', sha).split()
+        return [ dict(self.commit_json(x), commit=self.commit_json(x)) for x in shas ]
@@ -0,0 +1,139 @@
+""" Generate git repositories and commits to cherry pick
+
+Each repository has three branches:
+ - master: `files` files spread over a `fanout`-wide, `depth`-deep tree
+ - target: master plus an unrelated commit, where the pick goes
+ - source: master plus the commit to pick, which modifies, adds and
+   deletes files
+
+Contents are generated deterministically from `seed` and streamed into
+`git fast-import`, so even large repositories are quick to make and
+never held in memory.
+"""
+import os
+import random
+import subprocess
+
+AUTHOR = 'Bench Author <bench@example.com> 1500000000 +0000'
+
+def path_for(index, depth, fanout, prefix='file'):
+    """ The path of the `index`th file """
+    dirs = []
+    n = index
+    for _ in xrange(depth):
+        dirs.append('d{}'.format(n % fanout))
+        n //= fanout
+    return '/'.join(dirs + ['{}_{}.txt'.format(prefix, index)])
+
+def contents(index, size, seed, version=0):
+    """ `size` bytes of text lines, with the middle line changed per version """
+    rng = random.Random(seed * 1000003 + index)
+    lines = []
+    total = 0
+    while total < size:
+        line = '{:06d} {}\n'.format(len(lines), '%x' % rng.getrandbits(200))
+        lines.append(line)
+        total += len(line)
+    if version:
+        middle = len(lines) // 2
+        lines[middle] = 'changed in version {} of file {}\n'.format(version, index)
+    return ''.join(lines)
+
+class _FastImport(object):
+    def __init__(self, path):
+        self.process = subprocess.Popen(
+            ['git', 'fast-import', '--quiet', '--done'],
+            cwd=path, stdin=subprocess.PIPE)
+        self.marks = 0
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def blob(self, content):
+        self.marks += 1
+        self.write('blob\nmark :{}\ndata {}\n{}\n'.format(
+            self.marks, len(content), content))
+        return self.marks
+
+    def commit(self, ref, message, parent, changes):
+        """ changes yields ('M', path, content) or ('D', path, None) """
+        operations = []
+        for op, path, content in changes:
+            if op == 'M':
+                operations.append('M 100644 :{} {}\n'.format(self.blob(content), path))
+            else:
+                operations.append('D {}\n'.format(path))
+        self.marks += 1
+        self.write('commit refs/heads/{}\nmark :{}\nauthor {}\ncommitter {}\n'
+                   'data {}\n{}\n'.format(ref, self.marks, AUTHOR, AUTHOR,
+                                          len(message), message))
+        if parent:
+            self.write('from {}\n'.format(parent))
+        self.write(''.join(operations) + '\n')
+        return ':{}'.format(self.marks)
+
+    def close(self):
+        self.write('done\n')
+        self.process.stdin.close()
+        if self.process.wait():
+            raise RuntimeError("git fast-import failed")
+
+def make_repo(path, files=100, depth=2, fanout=10, size=1024, modify=10,
+              add=0, delete=0, seed=0):
+    """ Create the repository for a pick
+
+    Params:
+        path (string): Where to create it
+        files (int): Files on master
+        depth (int): Directories deep each file is
+        fanout (int): Subdirectories per directory
+        size (int): Approximate bytes per file
+        modify, add, delete (int): What the commit to pick does. The
+            modified and deleted files are spread evenly over master's.
+
+    Returns:
+        A dict of the branch SHAs: master, target, source
+    """
+    subprocess.check_call(['git', 'init', '--quiet', path])
+
+    touched = modify + delete
+    if touched > files:
+        raise ValueError("can't touch {} of {} files".format(touched, files))
+    step = files // touched if touched else 1
+    modified = set(xrange(0, step * modify, step))
+    deleted = set(xrange(step * modify, step * touched, step))
+
+    stream = _FastImport(path)
+    master = stream.commit(
+        'master', 'Base', None,
+        (('M', path_for(i, depth, fanout), contents(i, size, seed))
+         for i in xrange(files)))
+    stream.commit(
+        'target', 'Unrelated change on target', master,
+        [('M', 'TARGET_ONLY.txt', 'only on target\n')])
+    changes = [ ('M', path_for(i, depth, fanout), contents(i, size, seed, 1))
+                for i in sorted(modified) ]
+    changes += [ ('D', path_for(i, depth, fanout), None) for i in sorted(deleted) ]
+    changes += [ ('M', path_for(files + i, depth, fanout, 'added'),
+                  contents(files + i, size, seed))
+                 for i in xrange(add) ]
+    stream.commit('source', 'The change to pick', master, changes)
+    stream.close()
+
+    return dict((branch, subprocess.check_output(
+                     ['git', 'rev-parse', branch], cwd=path).strip())
+                for branch in ('master', 'target', 'source'))
+
+def expected_tree(path, source, target):
+    """ The tree `git cherry-pick source` onto target would make """
+    index = '{}/.git/bench-index'.format(path)
+    env = dict(os.environ, GIT_INDEX_FILE=index)
+    subprocess.check_call(['git', 'read-tree', target], cwd=path, env=env)
+    diff = subprocess.Popen(['git', 'diff', '--binary', source + '^', source],
+                            cwd=path, stdout=subprocess.PIPE)
+    subprocess.check_call(['git', 'apply', '--cached'], cwd=path, env=env,
+                          stdin=diff.stdout)
+    diff.wait()
+    tree = subprocess.check_output(['git', 'write-tree'], cwd=path, env=env).strip()
+    os.remove(index)
+    return tree
@@ -0,0 +1,277 @@
+""" A pure Python `git apply` for the patches Github hands back
+
+The patch is applied to file contents held in memory, so no workspace
+or `git` subprocess is needed. Only exact hunks are applied: the context
+and removed lines must match the file byte for byte, although a hunk may
+be found a few lines away from where the header says, like `git apply`.
+"""
+import re
+
+from .engine import GithubMergeConflict
+
+class PatchUnsupported(Exception):
+    """ The patch uses a feature the applier doesn't handle, i.e. binary
+    diffs. Fall back to `git apply`.
+    """
+    pass
+
+class Hunk(object):
+    """ One @@ section of a file diff """
+    __slots__ = ('header', 'old_start', 'old_lines', 'new_lines')
+
+    def __init__(self, header, old_start):
+        self.header = header
+        self.old_start = old_start
+        self.old_lines = []
+        self.new_lines = []
+
+class FilePatch(object):
+    """ Everything a patch says about one file """
+    __slots__ = ('old_path', 'new_path', 'old_mode', 'new_mode',
+                 'is_new', 'is_deleted', 'is_binary', 'hunks')
+
+    def __init__(self, old_path, new_path):
+        self.old_path = old_path
+        self.new_path = new_path
+        self.old_mode = None
+        self.new_mode = None
+        self.is_new = False
+        self.is_deleted = False
+        self.is_binary = False
+        self.hunks = []
+
+header_start_re = re.compile(r'^diff --git a/(.*?) b/(.*)$')
+commit_start_re = re.compile(r'^From [0-9a-f]{40} ')
+hunk_re = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+old_mode_re = re.compile(r'^old mode (\d+)$')
+new_mode_re = re.compile(r'^new mode (\d+)$')
+new_file_re = re.compile(r'^new file mode (\d+)$')
+deleted_file_re = re.compile(r'^deleted file mode (\d+)$')
+rename_from_re = re.compile(r'^rename from (.*)$')
+rename_to_re = re.compile(r'^rename to (.*)$')
+binary_re = re.compile(r'^(?:GIT binary patch|Binary files .* differ)$')
+
+no_newline = '\\ No newline at end of file'
+
+def split_lines(data):
+    """ Split on \\n only, keeping line endings """
+    lines = data.split('\n')
+    result = [ line + '\n' for line in lines[:-1] ]
+    if lines[-1]:
+        result.append(lines[-1])
+    return result
+
+def parse_patch(lines):
+    """ Parse a git "am" style patch into FilePatch objects
+
+    Params:
+        lines (iterable): The patch, one line at a time
+
+    Returns:
+        A list of FilePatch in the order they appear. A file touched by
+        several commits in the patch appears once per commit.
+    """
+    patches = []
+    curr = None
+    hunk = None
+    last_sides = ()
+    old_left = new_left = 0
+
+    for line in lines:
+        stripped = line.rstrip('\r\n')
+
+        if hunk is not None:
+            if stripped == no_newline:
+                # Applies to whichever side(s) the previous line went to
+                for side in last_sides:
+                    side[-1] = side[-1][:-1]
+                continue
+            if old_left > 0 or new_left > 0:
+                tag, body = line[:1], line[1:]
+                if tag == '\n':
+                    # A blank context line that lost its leading space
+                    tag, body = ' ', '\n'
+                elif not body.endswith('\n'):
+                    body += '\n'
+
+                if tag == ' ':
+                    last_sides = (hunk.old_lines, hunk.new_lines)
+                    old_left -= 1
+                    new_left -= 1
+                elif tag == '-':
+                    last_sides = (hunk.old_lines,)
+                    old_left -= 1
+                elif tag == '+':
+                    last_sides = (hunk.new_lines,)
+                    new_left -= 1
+                else:
+                    raise GithubMergeConflict(
+                        "corrupt patch for {}: {}".format(curr.new_path, stripped))
+                for side in last_sides:
+                    side.append(body)
+                continue
+            hunk = None
+
+        match = header_start_re.match(stripped)
+        if match:
+            curr = FilePatch(match.group(1), match.group(2))
+            patches.append(curr)
+            continue
+
+        if commit_start_re.match(stripped):
+            # The next commit's message, not part of any file
+            curr = None
+            continue
+
+        if curr is None:
+            continue
+
+        match = hunk_re.match(stripped)
+        if match:
+            old_start, old_count, new_start, new_count = match.groups()
+            hunk = Hunk(stripped, int(old_start))
+            old_left = 1 if old_count is None else int(old_count)
+            new_left = 1 if new_count is None else int(new_count)
+            last_sides = ()
+            curr.hunks.append(hunk)
+            continue
+
+        for regex, attr in ((old_mode_re, 'old_mode'),
+                            (new_mode_re, 'new_mode'),
+                            (new_file_re, 'new_mode'),
+                            (deleted_file_re, 'old_mode')):
+            match = regex.match(stripped)
+            if match:
+                setattr(curr, attr, match.group(1))
+                if regex is new_file_re:
+                    curr.is_new = True
+                elif regex is deleted_file_re:
+                    curr.is_deleted = True
+                break
+        else:
+            match = rename_from_re.match(stripped)
+            if match:
+                curr.old_path = match.group(1)
+            match = rename_to_re.match(stripped)
+            if match:
+                curr.new_path = match.group(1)
+            if binary_re.match(stripped):
+                curr.is_binary = True
+
+    return patches
+
+def _find_hunk(lines, hunk, expected):
+    """ Find where the hunk's old lines sit, searching out from `expected` """
+    old = hunk.old_lines
+    size = len(old)
+    if not size:
+        return expected if 0 <= expected <= len(lines) else None
+
+    last = len(lines) - size
+    for offset in xrange(0, max(expected, last - expected) + 1):
+        for pos in (expected - offset, expected + offset):
+            if 0 <= pos <= last and lines[pos:pos + size] == old:
+                return pos
+    return None
+
+def _reject_message(path, hunk_no, hunk):
+    return ("error: while searching for:\n{}"
+            "error: patch failed: {}:{}\n"
+            "Rejected hunk #{}: {}\n").format(
+        ''.join(hunk.old_lines), path, hunk.old_start, hunk_no, hunk.header)
+
+def apply_file_patch(file_patch, content):
+    """ Apply a single FilePatch to `content`
+
+    Params:
+        file_patch (FilePatch): The parsed diff for this file
+        content (string): The current contents, or None if it doesn't exist
+
+    Returns:
+        The new contents, or None if the file is deleted.
+
+    Raises:
+        GithubMergeConflict with one entry per rejected hunk
+        PatchUnsupported for binary diffs
+    """
+    path = file_patch.new_path
+    if file_patch.is_binary:
+        raise PatchUnsupported("binary patch for {}".format(path))
+    if file_patch.is_new and content is not None:
+        raise GithubMergeConflict("error: {}: already exists".format(path))
+    if not file_patch.is_new and content is None:
+        raise GithubMergeConflict(
+            "error: {}: does not exist in index".format(file_patch.old_path))
+
+    lines = split_lines(content or '')
+    rejects = []
+    # Track how far earlier hunks moved things so later ones line up
+    delta = 0
+    for hunk_no, hunk in enumerate(file_patch.hunks, 1):
+        expected = hunk.old_start - 1 + delta
+        if not hunk.old_lines:
+            # Pure additions at -N,0 go after line N
+            expected += 1
+        pos = _find_hunk(lines, hunk, expected)
+        if pos is None:
+            rejects.append(_reject_message(path, hunk_no, hunk))
+            continue
+        lines[pos:pos + len(hunk.old_lines)] = hunk.new_lines
+        delta = pos - (hunk.old_start - 1) + \
+            len(hunk.new_lines) - len(hunk.old_lines)
+        if not hunk.old_lines:
+            delta -= 1
+
+    if rejects:
+        exc = GithubMergeConflict(
+            "Applying patch {} with {} reject{}...\n{}".format(
+                path, len(rejects), '' if len(rejects) == 1 else 's',
+                ''.join(rejects)))
+        exc.rejects = rejects
+        raise exc
+
+    result = ''.join(lines)
+    if file_patch.is_deleted:
+        if result:
+            raise GithubMergeConflict(
+                "error: removal patch leaves file contents: {}".format(path))
+        return None
+    return result
+
+def apply_patch(patch, files):
+    """ Apply a patch to in-memory files
+
+    Params:
+        patch (string or iterable): The patch text, or its lines
+        files (dict): path -> contents. Files the patch creates must be
+            absent, all others present.
+
+    Returns:
+        A new dict of path -> contents. Deleted files map to None.
+
+    Raises:
+        GithubMergeConflict listing every file and hunk that didn't apply
+        PatchUnsupported if the patch needs `git apply`
+    """
+    if isinstance(patch, basestring):
+        patch = split_lines(patch)
+
+    result = dict(files)
+    conflicts = []
+    rejects = []
+    for file_patch in parse_patch(patch):
+        try:
+            content = apply_file_patch(file_patch, result.get(file_patch.old_path))
+        except GithubMergeConflict as e:
+            conflicts.append(str(e))
+            rejects.extend(getattr(e, 'rejects', []))
+            continue
+        if file_patch.old_path != file_patch.new_path:
+            result[file_patch.old_path] = None
+        result[file_patch.new_path] = content
+
+    if conflicts:
+        exc = GithubMergeConflict('\n'.join(conflicts))
+        exc.rejects = rejects
+        raise exc
+    return result
@@ -0,0 +1,168 @@
+""" Non-blocking counterparts of GithubRequestsEngine and CherryPick
+
+Every method returns a concurrent.futures.Future instead of blocking.
+Work is multiplexed over a bounded pool of threads that share a single
+pooled session, so thousands of calls or picks can be queued at once
+while at most `max_concurrency` run at a time.
+
+Usage:
+    engine = AsyncGithubRequestsEngine(username=username, password=password,
+                                       org=organization, repo=repo)
+    futures = [ engine.get_branch(b) for b in branches ]
+    shas = [ f.result()['object']['sha'] for f in futures ]
+
+    picker = AsyncCherryPick(username=username, password=password,
+                             org=organization, repo=repo, max_concurrency=8)
+    futures = dict((b, picker.pick(sha, b)) for b in branches)
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from .engine import GithubRequestsEngine, make_session
+from .cherry import CherryPick
+from .ratelimit import RateLimitScheduler
+
+class AsyncGithubRequestsEngine(object):
+    """ Perform the requests to Github without blocking
+
+    Mirrors the public methods of GithubRequestsEngine. Each returns a
+    Future whose result is what the blocking method returns, or whose
+    exception is the one it raises (mapped through HTTP_EXCEPTIONS).
+    """
+
+    HTTP_EXCEPTIONS = GithubRequestsEngine.HTTP_EXCEPTIONS
+
+    def __init__(self, username, password, org, repo, base_url=None,
+                 max_concurrency=10, **engine_options):
+        """ AsyncGithubRequestsEngine
+
+        Params:
+            max_concurrency (int): Most requests in flight at once
+            engine_options: Passed through to GithubRequestsEngine
+        """
+        engine_options.setdefault('pool_maxsize', max_concurrency)
+        self.engine = GithubRequestsEngine(
+            username=username,
+            password=password,
+            org=org,
+            repo=repo,
+            base_url=base_url,
+            **engine_options)
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    is_valid_sha = staticmethod(GithubRequestsEngine.is_valid_sha)
+    blob_sha = staticmethod(GithubRequestsEngine.blob_sha)
+
+    def submit(self, func, *args, **kwargs):
+        """ Run any callable on the engine's pool """
+        return self.executor.submit(func, *args, **kwargs)
+
+    def connection_stats(self):
+        return self.engine.connection_stats()
+
+    def retry_stats(self):
+        return self.engine.retry_stats()
+
+    def object_store_stats(self):
+        return self.engine.object_store_stats()
+
+    def close(self, wait=True):
+        """ Stop accepting work, optionally waiting for what's queued """
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _mirror(name):
+    blocking = getattr(GithubRequestsEngine, name)
+
+    def method(self, *args, **kwargs):
+        return self.submit(getattr(self.engine, name), *args, **kwargs)
+
+    method.__name__ = name
+    method.__doc__ = "{}\n        Non-blocking: returns a Future.\n        ".format(
+        (blocking.__doc__ or '').rstrip())
+    return method
+
+for _name in ('create_blob', 'get_blob', 'get_tree', 'create_tree',
+              'point_branch', 'get_ref', 'get_sha', 'get_file', 'get_files',
+              'get_tag', 'get_branch', 'get_commit', 'get_repo_commit',
+              'create_commit', 'commits', 'compare'):
+    setattr(AsyncGithubRequestsEngine, _name, _mirror(_name))
+
+class AsyncCherryPick(object):
+    """ Run many cherry picks at once without blocking
+
+    Each pick is a full CherryPick patch and commit. Picks are queued and
+    run `max_concurrency` at a time, all sharing one pooled session and
+    one rate limiter.
+    """
+
+    def __init__(self, username, password, org, repo, base_url=None,
+                 max_concurrency=10, session=None, rate_limiter=None,
+                 **pick_options):
+        """ AsyncCherryPick
+
+        Params:
+            max_concurrency (int): Most picks running at once
+            session (requests.Session): Shared by every pick. One sized
+                for `max_concurrency` picks is made if not given.
+            rate_limiter (RateLimitScheduler): Shared by every pick, so the
+                budget and secondary limits are tracked across all of
+                them. One is made if not given, False disables it.
+            pick_options: Passed through to each CherryPick, i.e. workers,
+                applier, tree_strategy and the engine options.
+        """
+        workers = pick_options.get('workers', 1)
+        self.session = session or make_session(
+            pool_maxsize=max_concurrency * workers)
+        if rate_limiter is None:
+            rate_limiter = RateLimitScheduler()
+        self.rate_limiter = rate_limiter
+        self.pick_options = dict(
+            username=username,
+            password=password,
+            org=org,
+            repo=repo,
+            base_url=base_url,
+            session=self.session,
+            rate_limiter=self.rate_limiter,
+            **pick_options)
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def pick(self, target_sha, target_branch, message=None):
+        """ Cherry pick `target_sha` onto `target_branch`
+
+        Returns:
+            A Future for the new commit. Its exception is whatever
+            CherryPick raised, i.e. GithubMergeConflict.
+        """
+        return self.executor.submit(self._pick, target_sha, target_branch, message)
+
+    def pick_range(self, starting_sha, ending_sha, target_branch):
+        """ Non-blocking CherryPick.pick_range. Returns a Future. """
+        return self.executor.submit(
+            lambda: CherryPick(**self.pick_options).pick_range(
+                starting_sha, ending_sha, target_branch))
+
+    def _pick(self, target_sha, target_branch, message):
+        cherry = CherryPick(**self.pick_options)
+        try:
+            cherry.patch(target_sha, target_branch)
+            return cherry.commit(message)
+        finally:
+            cherry._delete_workspace()
+
+    def close(self, wait=True):
+        """ Stop accepting picks, optionally waiting for what's queued """
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,171 @@
+""" Response caches for conditional GETs
+
+The engine stores each cacheable response's body with its ETag and
+Last-Modified headers, sends them back as If-None-Match and
+If-Modified-Since, and reuses the stored body when Github answers 304
+Not Modified. Github doesn't count 304s against the rate limit.
+
+Pass either cache to the engine (or CherryPick) as `http_cache`:
+
+    engine = GithubRequestsEngine(..., http_cache=MemoryCache())
+"""
+import os
+import json
+import errno
+import hashlib
+import tempfile
+import threading
+import collections
+
+class HttpCache(object):
+    """ The bookkeeping shared by the cache backends
+
+    Entries are dicts with the keys etag, last_modified, content_type,
+    link (the Link header, for paged lists) and body. Subclasses
+    implement _load, _save and _size.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        """ Returns the entry stored under key, or None """
+        with self._lock:
+            entry = self._load(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        """ Store an entry, evicting the least recently used to make room """
+        if self._size(entry) > self.max_bytes:
+            return
+        with self._lock:
+            self._save(key, entry)
+
+    def record_not_modified(self):
+        with self._lock:
+            self.not_modified += 1
+
+    def stats(self):
+        """ Returns a dict of hits, misses, not_modified, entries and bytes
+
+        hits counts lookups that found an entry (and so were sent as
+        conditional requests), not_modified how many of those Github
+        answered with 304 and were served from the cache.
+        """
+        with self._lock:
+            return dict(hits=self.hits,
+                        misses=self.misses,
+                        not_modified=self.not_modified,
+                        entries=self._count(),
+                        bytes=self._bytes())
+
+    @staticmethod
+    def _size(entry):
+        return len(entry['body'] or '')
+
+class MemoryCache(HttpCache):
+    """ An in-process LRU cache bounded by the total size of the bodies """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        super(MemoryCache, self).__init__(max_bytes)
+        self._entries = collections.OrderedDict()
+        self._total = 0
+
+    def _load(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._entries[key] = entry
+        return entry
+
+    def _save(self, key, entry):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._total -= self._size(old)
+        self._entries[key] = entry
+        self._total += self._size(entry)
+        while self._total > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._total -= self._size(evicted)
+
+    def _count(self):
+        return len(self._entries)
+
+    def _bytes(self):
+        return self._total
+
+class DiskCache(HttpCache):
+    """ An LRU cache kept in a directory, bounded by total file size
+
+    Each entry is a JSON file named after the hash of its key. Files are
+    written to a temporary name and renamed into place, so several
+    processes may share a directory. Recency is the file's mtime.
+    """
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024):
+        super(DiskCache, self).__init__(max_bytes)
+        self.path = path
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _filename(self, key):
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest() + '.json')
+
+    def _load(self, key):
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                entry = json.load(f)
+            os.utime(filename, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return entry
+
+    def _save(self, key, entry):
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(entry, f)
+        os.rename(tmp, self._filename(key))
+        self._evict()
+
+    def _files(self):
+        """ Returns [(mtime, size, filename)] for every entry """
+        files = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            filename = os.path.join(self.path, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, filename))
+        return files
+
+    def _evict(self):
+        files = sorted(self._files())
+        total = sum(x[1] for x in files)
+        for mtime, size, filename in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
+
+    def _count(self):
+        return len(self._files())
+
+    def _bytes(self):
+        return sum(x[1] for x in self._files())
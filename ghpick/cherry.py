@@ -3,13 +3,101 @@ import re
 import copy
 import logging
 import tempfile
+import Queue
 import datetime
+import threading
+import collections
 
 import subprocess
 import shutil
 import distutils.dir_util
 
+from base64 import b64decode
+from cStringIO import StringIO
+from concurrent.futures import ThreadPoolExecutor, Future
+
 from .engine import GithubRequestsEngine, GithubMergeConflict, GithubNotFound
+from .engine import GithubUnprocessableEntity
+from .applier import apply_patch, PatchUnsupported
+
+# Stands in for the contents of a file that was streamed straight to disk
+_ON_DISK = object()
+
+class PatchTreeNode(object):
+    """ One directory or file in the patch tree
+
+    Directories have `children` (name -> PatchTreeNode) and no `item`.
+    Files have the patch summary record as `item` and no children.
+    """
+    __slots__ = ('children', 'item')
+
+    def __init__(self, item=None):
+        self.item = item
+        self.children = None if item is not None else dict()
+
+    @property
+    def is_file(self):
+        return self.item is not None
+
+    def insert(self, path, item):
+        """ Add a file, creating directories along the way """
+        node = self
+        elems = [ x for x in path.split('/') if x != '' ]
+        for name in elems[:-1]:
+            child = node.children.get(name)
+            if child is None or child.is_file:
+                child = node.children[name] = PatchTreeNode()
+            node = child
+        node.children[elems[-1]] = PatchTreeNode(item)
+
+    def iteritems(self):
+        """ Yields (name, node) for each child, sorted by name """
+        for name in sorted(self.children):
+            yield name, self.children[name]
+
+class PickMetadata(object):
+    """ What a pick needs to know about the commits it picks
+
+    Built from one compare call, or one commits API call for a single
+    commit, so patch() and commit() don't look the same commits up
+    again. `commits` is oldest first, each a dict with the keys sha,
+    parents (a list of SHAs), author, committer and message. `files` is
+    the file list Github gave with them.
+    """
+    __slots__ = ('base_sha', 'head_sha', 'commits', 'files', '_by_sha')
+
+    def __init__(self, base_sha, head_sha, commits, files=()):
+        self.base_sha = base_sha
+        self.head_sha = head_sha
+        self.commits = [ self._flatten(x) for x in commits ]
+        self.files = list(files)
+        self._by_sha = dict((x['sha'], x) for x in self.commits)
+
+    @staticmethod
+    def _flatten(commit):
+        """ Compare and commits API entries keep the details under 'commit' """
+        details = commit.get('commit', commit)
+        return dict(sha=commit['sha'],
+                    parents=[ x['sha'] for x in commit['parents'] ],
+                    author=details['author'],
+                    committer=details.get('committer'),
+                    message=details['message'])
+
+    @classmethod
+    def from_commit(cls, commit):
+        """ Metadata for one commit from the commits API """
+        parents = commit['parents']
+        base_sha = parents[0]['sha'] if parents else None
+        return cls(base_sha, commit['sha'], [commit], commit.get('files', ()))
+
+    def __contains__(self, sha):
+        return sha in self._by_sha
+
+    def commit(self, sha):
+        return self._by_sha[sha]
+
+    def parent_of(self, sha):
+        return self._by_sha[sha]['parents'][0]
 
 class CherryPick(object):
     """ CherryPick
@@ -31,6 +119,15 @@ class CherryPick(object):
                             org=organization, repo=repo,
                             base_url='https://gh.internal.com/api/v3')
 
+    Sharing connections:
+        Every CherryPick owns an engine, and every engine owns a pooled
+        keep-alive session. To share one pool between many picks build
+        the session once and pass it in:
+
+        session = make_session(pool_maxsize=20)
+        cherry = CherryPick(username=username, password=password,
+                            org=organization, repo=repo, session=session)
+
     When committing:
         If you don't pass a commit message then a default will be used:
         "This is a cherry pick between {sha1} and {sha2}."
@@ -41,8 +138,17 @@ class CherryPick(object):
     """
     default_dir_mode = '040000'
     default_file_mode = '100644'
+    # The in-memory applier keeps patches smaller than this off the disk
+    patch_spool_size = 8 * 1024 * 1024
+    # Paths per GraphQL query with the 'graphql' fetch strategy
+    graphql_batch_size = 100
+    # Files in the workspace larger than this are hashed and uploaded a
+    # block at a time instead of being read into memory
+    stream_size = 1024 * 1024
 
-    def __init__(self, username, password, org, repo, base_url=None):
+    def __init__(self, username, password, org, repo, base_url=None,
+                 workers=1, fetch_strategy='contents', known_blobs=None,
+                 tree_strategy='recursive', applier='git', **engine_options):
         """ CherryPick
 
         Params:
@@ -51,20 +157,59 @@ class CherryPick(object):
             org (string): The Github org (could be the username)
             repo (string): The repo
             base_url (string): The full URL for Enterprise.
+            workers (int): How many files to download or upload at once
+            fetch_strategy (string): How to download the files to patch.
+                'contents' makes one contents API call per file. 'tree'
+                lists the target branch once with a recursive tree and
+                downloads only the blobs it needs, with no size limit.
+                'graphql' fetches `graphql_batch_size` files per GraphQL
+                query, downloading binary and very large files as blobs.
+            known_blobs (set): SHAs of blobs Github already has. Blobs in
+                here are never uploaded again. May be shared between picks.
+            tree_strategy (string): How to build the new tree. 'recursive'
+                rebuilds every directory on a changed path. 'flat' sends a
+                single create_tree on top of the target tree, falling back
+                to 'recursive' if Github rejects it.
+            applier (string): How to apply the patch. 'git' runs `git apply`
+                in a temporary workspace. 'python' applies it to the files
+                in memory without touching the disk, handing over to
+                `git apply` only for patches it can't handle (binary diffs).
+            engine_options: Passed through to GithubRequestsEngine, i.e.
+                session, timeout, pool_maxsize.
         """
         self.engine = GithubRequestsEngine(
             username=username,
             password=password,
             org=org,
             repo=repo,
-            base_url=base_url)
+            base_url=base_url,
+            **engine_options)
+        self.workers = workers
+        self.fetch_strategy = fetch_strategy
+        self.known_blobs = set() if known_blobs is None else known_blobs
+        # sha -> Future for uploads in flight, shared with pick_onto's picks
+        self._uploading = dict()
+        self._upload_lock = threading.Lock()
+        self.tree_strategy = tree_strategy
+        self.applier = applier
+        self.files = None
+        self.metadata = None
+        # sha -> tree, see _get_tree
+        self.trees = dict()
+        # path -> post-image blob SHA of the commit being picked, see _unapplied
+        self.post_images = dict()
+        self.unapplied = dict()
 
     def patch(self, target_sha, target_branch):
         """ Apply the patch
 
         This will create a temporary directory under $TMPDIR, retrieve
         the files from `target_branch`, and apply the patch using
-        `git apply`.
+        `git apply`. With the 'python' applier the files are kept in
+        memory instead.
+
+        The patch is streamed, and each file is fetched as soon as its
+        header has been downloaded.
 
         Params:
             target_sha (string): The target sha
@@ -73,24 +218,262 @@ class CherryPick(object):
         Returns:
             True if successful. Otherwise an exception will be raised.
         """
-        self.target_sha = target_sha
+        metadata, self.target_sha = self._metadata_for(target_sha)
         self.target_branch = target_branch
-        self._prepare_workspace()
-        self._make_patch(target_sha)
-        self._fetch_files()
+        # Files are fetched from, and the commit built on, the branch as it is now
+        self.base_sha = self.engine.get_sha(target_branch)
+        self.post_images = self._post_images(metadata)
+        self._start_pick()
+        return self._patch_commit(self.target_sha,
+                                  parent_sha=metadata.parent_of(self.target_sha),
+                                  ref=self.base_sha)
+
+    def load_metadata(self, base_sha, head_sha):
+        """ Look up every commit between two shas with one compare call
+
+        The result is kept as `self.metadata`, so picking any of those
+        commits afterwards needs no further lookups.
+
+        Params:
+            base_sha (string): The sha, tag, or branch to start after
+            head_sha (string): The last sha, tag, or branch
+
+        Returns:
+            PickMetadata
+        """
+        comparison = self.engine.compare(base_sha, head_sha)
+        commits = comparison['commits']
+        if comparison.get('total_commits', len(commits)) > len(commits):
+            # Compare lists at most 250 commits, page through them instead
+            commits = list(reversed(self.engine.commits(base_sha, head_sha)))
+        base = comparison['base_commit']['sha']
+        head = commits[-1]['sha'] if commits else base
+        self.metadata = PickMetadata(base, head, commits,
+                                     comparison.get('files', ()))
+        return self.metadata
+
+    def _metadata_for(self, target_sha):
+        """ Metadata holding target_sha, looking it up if we don't have it
+
+        Returns:
+            (PickMetadata, the commit's full SHA). target_sha is kept as
+            is if the loaded metadata has it, which may be a range from
+            load_metadata. Otherwise it may be a tag or branch, and is
+            resolved by the commit Github returns for it.
+        """
+        if self.metadata is not None and target_sha in self.metadata:
+            return self.metadata, target_sha
+        self.metadata = PickMetadata.from_commit(
+            self.engine.get_repo_commit(target_sha))
+        return self.metadata, self.metadata.head_sha
+
+    @staticmethod
+    def _post_images(metadata):
+        """ path -> the blob SHA each file has after metadata's one commit
+
+        Deleted files map to None. Empty unless the metadata's file list
+        is that of its head commit alone, renames and copies are left out.
+        """
+        if len(metadata.commits) != 1:
+            return dict()
+        images = dict()
+        for entry in metadata.files:
+            if entry.get('status') in ('renamed', 'copied'):
+                continue
+            if entry.get('status') == 'removed':
+                images[entry['filename']] = None
+            elif entry.get('sha'):
+                images[entry['filename']] = entry['sha']
+        return images
+
+    def pick_range(self, starting_sha, ending_sha, target_branch):
+        """ Cherry pick a range of commits onto a branch
+
+        Every commit after `starting_sha` up to and including `ending_sha`
+        is applied in order, each committed on top of the one before.
+        The files stay in the workspace (or memory) between commits, so
+        each file is only downloaded once, and the branch is only moved
+        once, after the last commit.
+
+        Params:
+            starting_sha (string): The sha, tag, or branch to start after
+            ending_sha (string): The last sha, tag, or branch to pick
+            target_branch (string): The branch to make the changes to
+
+        Returns:
+            The list of new commits, oldest first. If a commit doesn't
+            apply, GithubMergeConflict is raised with `sha` and `index`
+            (1-based, in range order) naming it, and the branch isn't moved.
+        """
+        commits = self.load_metadata(starting_sha, ending_sha).commits
+        self.target_branch = target_branch
+        # Later commits may patch the same files again, so every file is fetched
+        self.post_images = dict()
+        self._start_pick()
+
+        # Everything is fetched from, and built on, the branch as it is now
+        base_sha = parent_sha = self.engine.get_sha(target_branch)
+        tree = self._get_tree(base_sha)
+
+        created = []
+        try:
+            for index, commit in enumerate(commits, 1):
+                self.target_sha = commit['sha']
+                try:
+                    self._patch_commit(commit['sha'],
+                                       parent_sha=commit['parents'][0],
+                                       ref=base_sha)
+                except GithubMergeConflict as e:
+                    exc = GithubMergeConflict(
+                        "Conflict in commit {} ({} of {}):\n{}".format(
+                            commit['sha'], index, len(commits), e))
+                    exc.sha = commit['sha']
+                    exc.index = index
+                    exc.rejects = getattr(e, 'rejects', [])
+                    raise exc
+
+                tree = self._build_tree(tree)
+                author = dict(commit['author'])
+                author['date'] = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+                new_commit = self.engine.create_commit(commit['message'],
+                                                       tree['sha'],
+                                                       [parent_sha],
+                                                       author)
+                parent_sha = new_commit['sha']
+                created.append(new_commit)
+        finally:
+            self._delete_workspace()
+
+        if created:
+            self.engine.point_branch(target_branch, parent_sha)
+        return created
+
+    def pick_onto(self, target_sha, target_branches, message=None):
+        """ Cherry pick one commit onto several branches at once
+
+        The patch is downloaded and parsed once. Each branch then fetches,
+        applies, builds and commits in its own thread. Blobs are shared
+        between the branches, so a file that ends up identical on several
+        branches is only uploaded once.
+
+        Params:
+            target_sha (string): The sha to pick
+            target_branches (list): The branches to make the changes to
+            message (string): The commit message, defaults to target_sha's
+
+        Returns:
+            A dict of branch -> the new commit, or the exception that
+            stopped that branch (GithubMergeConflict for conflicts).
+        """
+        metadata, target_sha = self._metadata_for(target_sha)
+        self.target_sha = target_sha
+        parent_sha = metadata.parent_of(target_sha)
+        lines = self.engine.compare(parent_sha, target_sha,
+                                    as_patch=True, stream=True)
+        patchdata = ''.join(lines)
+        summary = list(self._iter_patch_summary(StringIO(patchdata)))
+        self.post_images = self._post_images(metadata)
+        # The branches share their trees, they likely have most in common
+        self.trees = dict()
+
+        def pick(branch):
+            child = None
+            try:
+                child = self._fork(branch, patchdata, summary)
+                return child.commit(message)
+            except Exception as e:
+                logging.info("Picking %s onto %s failed: %s", target_sha, branch, e)
+                return e
+            finally:
+                if child is not None:
+                    child._delete_workspace()
+
+        results = dict()
+        executor = ThreadPoolExecutor(max_workers=max(len(target_branches), 1))
+        try:
+            for branch, result in zip(target_branches,
+                                      executor.map(pick, target_branches)):
+                results[branch] = result
+        finally:
+            executor.shutdown(wait=True)
+        return results
+
+    def _fork(self, branch, patchdata, summary):
+        """ Patch a copy of this pick onto `branch`
+
+        The copy shares the engine and the blob bookkeeping with us.
+        """
+        child = copy.copy(self)
+        child.target_branch = branch
+        child.base_sha = self.engine.get_sha(branch)
+        child._start_pick(trees=self.trees)
+        child.patch_summary = summary
+        if child.files is None:
+            child.patchfile = os.path.join(child.cwd, "patch")
+            child.patch_buffer = open(child.patchfile, 'w+b')
+            child.patch_buffer.write(patchdata)
+            child.patch_buffer.flush()
+        else:
+            child.patch_buffer = StringIO(patchdata)
+        try:
+            child._fetch_files(ref=child.base_sha)
+            child._build_patch_tree()
+            child._apply_patch()
+        except:
+            child._delete_workspace()
+            raise
+        return child
+
+    def _start_pick(self, trees=None):
+        """ Set up somewhere to keep the files being patched
+
+        Params:
+            trees (dict): Trees by SHA to share with another pick, a
+                fresh snapshot is started if not given
+        """
+        self.trees = dict() if trees is None else trees
+        if self.applier == 'python':
+            # path -> contents, None once deleted
+            self.files = dict()
+            self.cwd = None
+        else:
+            self.files = None
+            self._prepare_workspace()
+        # Paths whose contents we already hold, or know to be missing
+        self.held = set()
+        # path -> blob SHA for files the patch isn't applied to, see _unapplied
+        self.unapplied = dict()
+
+    def _patch_commit(self, target_sha, parent_sha=None, ref=None):
+        """ Download and apply one commit's patch to the held files
+
+        Only files we don't already hold are downloaded, from `ref` or
+        the head of the target branch.
+        """
+        lines = self._stream_patch(target_sha, parent_sha)
+        summary = self._iter_patch_summary(lines)
+        self._fetch_files(self._unheld(summary), ref)
+        self._build_patch_tree()
         return self._apply_patch()
 
+    def _unheld(self, summary):
+        """ Filter summary records down to the files we don't hold yet """
+        for item in summary:
+            if item['path'] not in self.held:
+                self.held.add(item['path'])
+                yield item
+
     def commit(self, message=None):
-        target_tree = self.engine.get_tree(self.target_branch)
+        # On top of the commit the files were fetched from
+        target_tree = self._get_tree(self.base_sha)
         tree = self._build_tree(target_tree)
 
-        parent_commit = self.engine.get_commit(self.target_branch)
-        target_commit = self.engine.get_commit(self.target_sha)
-        author = target_commit['author']
+        target_commit = self.metadata.commit(self.target_sha)
+        author = dict(target_commit['author'])
         author['date'] = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
         commit = self.engine.create_commit(message or target_commit['message'],
                                            tree['sha'],
-                                           [parent_commit['sha']],
+                                           [self.base_sha],
                                            author)
 
         self._delete_workspace()
@@ -99,15 +482,100 @@ class CherryPick(object):
 
     def _make_patch(self, target_sha):
         """ Retrieves the patch file and sends it to the parsers """
-        parent_commit = self.engine.get_commit(self.target_sha)['parents'][0]['sha']
-        self.patchdata = self.engine.compare(parent_commit, target_sha, as_patch=True)
-        self.patchfile = os.path.join(self.cwd, "patch")
-        with open(self.patchfile, 'w') as patch:
-            patch.write(self.patchdata.encode('utf-8'))
-        self._make_patch_summary()
+        for _ in self._iter_patch_summary(self._stream_patch(target_sha)):
+            pass
         self._build_patch_tree()
-        
+
+    def _stream_patch(self, target_sha, parent_sha=None):
+        """ Yields the patch line by line as it downloads
+
+        Each line is also saved to `self.patch_buffer` for applying later:
+        the workspace's patch file for `git apply`, otherwise a spooled
+        temporary file that only goes to disk for very large patches.
+        """
+        if parent_sha is None:
+            metadata, target_sha = self._metadata_for(target_sha)
+            parent_sha = metadata.parent_of(target_sha)
+        lines = self.engine.compare(parent_sha, target_sha,
+                                    as_patch=True, stream=True)
+        if getattr(self, 'patch_buffer', None):
+            self.patch_buffer.close()
+        if self.files is None:
+            self.patchfile = os.path.join(self.cwd, "patch")
+            self.patch_buffer = open(self.patchfile, 'w+b')
+        else:
+            self.patch_buffer = tempfile.SpooledTemporaryFile(
+                max_size=self.patch_spool_size)
+
+        for line in lines:
+            self.patch_buffer.write(line)
+            yield line
+        self.patch_buffer.flush()
+
     def _apply_patch(self):
+        """ Applies the patch in memory or with `git apply` """
+        if self.unapplied and not self._drop_unapplied():
+            # Every file's result is already on Github
+            return True
+        if self.files is None:
+            return self._git_apply()
+
+        try:
+            self.patch_buffer.seek(0)
+            self.files = apply_patch(self.patch_buffer, self.files)
+        except PatchUnsupported as e:
+            logging.info("Falling back to git apply: %s", e)
+            self._spill_to_workspace()
+            return self._git_apply()
+        return True
+
+    def _drop_unapplied(self):
+        """ Cut the files in `self.unapplied` out of the saved patch
+
+        Returns:
+            Whether any file is left to apply
+        """
+        header_start_re = re.compile(r'^diff --git a/(.*?) b/.*$')
+        if self.files is None:
+            self.patchfile = os.path.join(self.cwd, "patch.apply")
+            patch_buffer = open(self.patchfile, 'w+b')
+        else:
+            patch_buffer = tempfile.SpooledTemporaryFile(
+                max_size=self.patch_spool_size)
+
+        left = 0
+        keep = True
+        self.patch_buffer.seek(0)
+        for line in self.patch_buffer:
+            match = header_start_re.match(line)
+            if match:
+                keep = match.group(1) not in self.unapplied
+                left += keep
+            if keep:
+                patch_buffer.write(line)
+        patch_buffer.flush()
+
+        self.patch_buffer.close()
+        self.patch_buffer = patch_buffer
+        return left > 0
+
+    def _spill_to_workspace(self):
+        """ Move the in-memory files and patch onto disk for `git apply` """
+        files = self.files
+        self.files = None
+        self._prepare_workspace()
+
+        self.patchfile = os.path.join(self.cwd, "patch")
+        with open(self.patchfile, 'wb') as f:
+            self.patch_buffer.seek(0)
+            shutil.copyfileobj(self.patch_buffer, f)
+
+        distutils.dir_util.create_tree(self.files_base, files.keys())
+        for path, content in files.iteritems():
+            if content is not None:
+                self._write_file(path, content)
+
+    def _git_apply(self):
         """ Executes the patch command """
         child = subprocess.Popen(['git',
             'apply',
@@ -139,147 +607,470 @@ class CherryPick(object):
         self.files_base = os.path.join(self.cwd, 'b')
         os.mkdir(self.files_base)
     
-    def _fetch_files(self):
-        """ Download each file to patch """
+    def _fetch_files(self, summary=None, ref=None):
+        """ Download each file to patch
 
-        # First we create the tree to put the files into
-        files = [ x['path'] for x in self.patch_summary ]
-        distutils.dir_util.create_tree(self.files_base, files)
+        Params:
+            summary (iterable): Patch summary records. Defaults to
+                `self.patch_summary`. Downloads start as records arrive.
+            ref (string): The sha to download from. Defaults to the
+                current head of `self.target_branch`.
+        """
+        if summary is None:
+            summary = self.patch_summary
 
-        for item in self.patch_summary:
+        # Pin the branch so every file comes from the same commit
+        if ref is None:
+            ref = self.engine.get_sha(self.target_branch)
+
+        if self.post_images:
+            summary = self._unapplied(summary, ref)
+        files = ( x['path'] for x in summary )
+
+        if self.fetch_strategy == 'tree':
+            fetched = self._fetch_from_tree(files, ref)
+        elif self.fetch_strategy == 'graphql':
+            fetched = self._fetch_from_graphql(files, ref)
+        else:
+            fetched = self._fetch_from_contents(files, ref)
+
+        for path, content in fetched:
+            if content is not None and content is not _ON_DISK:
+                self._write_file(path, content)
+
+        # Files the patch creates still need their directory on disk
+        if self.files is None:
+            paths = [ x['path'] for x in self.patch_summary ]
+            distutils.dir_util.create_tree(self.files_base, paths)
+
+    def _unapplied(self, summary, ref):
+        """ Yields the records of the files the patch has to be applied to
+
+        When a file's blob on `ref` is the patch's pre-image, the patched
+        file is the picked commit's post-image, which Github already has.
+        Those files are put in `self.unapplied` (path -> post-image SHA,
+        None for deletions) instead, and are never downloaded, patched
+        or uploaded.
+        """
+        for item in summary:
+            path = item['path']
+            pre_image = item.get('pre_image')
+            if pre_image is None or path not in self.post_images:
+                yield item
+                continue
+            post_image = self.post_images[path]
+            if item['is_deleted'] != (post_image is None) or \
+                    (post_image and not post_image.startswith(item['post_image'])):
+                yield item
+                continue
+
+            current = self._blob_sha_at(ref, path)
+            if current is None:
+                matches = pre_image.strip('0') == ''
+            else:
+                matches = current.startswith(pre_image)
+            if not matches:
+                yield item
+                continue
+            self.unapplied[path] = post_image
+            if post_image is not None:
+                self.known_blobs.add(post_image)
+
+    def _blob_sha_at(self, ref, path):
+        """ The SHA of what's at `path` on `ref`, None if there's nothing
+
+        The directories are read through the tree snapshot, which the
+        recursive tree strategy reads anyway to build the new tree.
+        """
+        tree = self._get_tree(ref)
+        elems = [ x for x in path.split('/') if x != '' ]
+        for name in elems[:-1]:
+            entry = self._tree_entry(tree, name)
+            if entry is None or entry['type'] != 'tree':
+                return None
+            tree = self._get_tree(entry['sha'])
+        entry = self._tree_entry(tree, elems[-1])
+        return None if entry is None else entry['sha']
+
+    @staticmethod
+    def _tree_entry(tree, name):
+        for entry in tree['tree']:
+            if entry['path'] == name:
+                return entry
+        return None
+
+    def _fetch_from_contents(self, files, ref):
+        """ Yields (path, content) using one contents API call per file
+
+        content is None for files that don't exist on `ref`. With a
+        workspace on disk each file is streamed into it, and content is
+        _ON_DISK.
+        """
+        def fetch(path):
             try:
-                fetched = self.engine.get_file(item['path'], self.target_branch)
-                content = fetched['content']
+                if self.files is None:
+                    fetched = self._stream_file(
+                        path, lambda f: self.engine.get_file(path, ref, stream_to=f))
+                    fetched['content'] = _ON_DISK
+                else:
+                    fetched = self.engine.get_file(path, ref)
             except GithubNotFound:
                 # If the file has been deleted from the source then
                 # it won't exist and we can skip. If it's a new file
                 # then it won't exist and will be created by the patch
-                continue
+                return None
+            self.known_blobs.add(fetched['sha'])
+            return fetched['content']
+
+        return self._map_concurrent(fetch, files)
+
+    def _fetch_from_tree(self, files, ref):
+        """ Yields (path, content) from one recursive tree listing plus blobs
+
+        Files that aren't in the tree are yielded as None without making a
+        request. Files that share a blob are only downloaded once. If Github
+        truncated the listing we fall back to the contents API.
+        """
+        tree = self.engine.get_tree(ref, recursive=True)
+        self._remember_listing(tree, ref)
+        if tree.get('truncated'):
+            for item in self._fetch_from_contents(files, ref):
+                yield item
+            return
+
+        blobs = dict((x['path'], x['sha']) for x in tree['tree']
+                     if x['type'] == 'blob')
+        self.known_blobs.update(blobs.values())
+
+        missing = []
+        late = []
+        paths_by_sha = collections.defaultdict(list)
+        downloaded = set()
+
+        def new_shas():
+            for path in files:
+                sha = blobs.get(path)
+                if sha is None:
+                    missing.append(path)
+                elif sha in downloaded:
+                    # Its blob already went by, copy it at the end
+                    late.append((path, paths_by_sha[sha][0]))
+                else:
+                    paths_by_sha[sha].append(path)
+                    if len(paths_by_sha[sha]) == 1:
+                        yield sha
+
+        def fetch(sha):
+            if self.files is None:
+                path = paths_by_sha[sha][0]
+                self._stream_file(
+                    path, lambda f: self.engine.get_blob(sha, stream_to=f))
+                return _ON_DISK
+            return b64decode(self.engine.get_blob(sha)['content'])
+
+        def copy(source, path):
+            if self.files is None:
+                self._copy_file(source, path)
+                return _ON_DISK
+            return self._read_file(source)
+
+        for sha, content in self._map_concurrent(fetch, new_shas()):
+            downloaded.add(sha)
+            first = paths_by_sha[sha][0]
+            yield first, content
+            for path in paths_by_sha[sha][1:]:
+                yield path, copy(first, path)
+
+        for path in missing:
+            yield path, None
+        for path, source in late:
+            yield path, copy(source, path)
+
+    def _fetch_from_graphql(self, files, ref):
+        """ Yields (path, content) fetching batches of files per GraphQL query
+
+        A batch is sent as soon as `graphql_batch_size` paths have arrived,
+        and the batches are fetched `self.workers` at a time.
+        """
+        def batches():
+            batch = []
+            for path in files:
+                batch.append(path)
+                if len(batch) == self.graphql_batch_size:
+                    yield tuple(batch)
+                    batch = []
+            if batch:
+                yield tuple(batch)
+
+        def fetch(batch):
+            return self.engine.get_files(batch, ref,
+                                         batch_size=self.graphql_batch_size)
+
+        for batch, fetched in self._map_concurrent(fetch, batches()):
+            for path in batch:
+                blob = fetched[path]
+                if blob is None:
+                    yield path, None
+                    continue
+                self.known_blobs.add(blob['sha'])
+                yield path, blob['content']
+
+    def _write_file(self, path, content):
+        """ Write a fetched file into the workspace """
+        if self.files is not None:
+            self.files[path] = content
+            return
+        path = os.path.join(self.files_base, path)
+        distutils.dir_util.mkpath(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(content)
+
+    def _stream_file(self, path, download):
+        """ Call download with the workspace file for `path`, open 'w+b'
+
+        The file is removed again if the download fails.
+        """
+        path = os.path.join(self.files_base, path)
+        distutils.dir_util.mkpath(os.path.dirname(path))
+        try:
+            with open(path, 'w+b') as f:
+                return download(f)
+        except Exception:
+            os.remove(path)
+            raise
 
-            path = os.path.join(self.files_base, item['path'])
+    def _copy_file(self, source, path):
+        """ Copy one workspace file to another path """
+        path = os.path.join(self.files_base, path)
+        distutils.dir_util.mkpath(os.path.dirname(path))
+        shutil.copyfile(os.path.join(self.files_base, source), path)
 
-            with open(path, 'w') as f:
-                f.write(content)
+    def _is_large(self, path):
+        """ Whether a workspace file should be streamed rather than read """
+        if self.files is not None:
+            return False
+        return os.path.getsize(os.path.join(self.files_base, path)) > self.stream_size
+
+    def _read_file(self, path):
+        """ Read a patched file back out of the workspace """
+        if self.files is not None:
+            return self.files[path]
+        if not os.path.isabs(path):
+            path = os.path.join(self.files_base, path)
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _map_concurrent(self, func, items):
+        """ Call func on each item using up to `self.workers` threads
+
+        `items` may be any iterable, calls are submitted as items arrive.
+        Yields (item, result) pairs as each call completes. The first
+        exception raised by func cancels the calls that haven't started
+        and is re-raised here.
+        """
+        if self.workers <= 1:
+            for item in items:
+                yield item, func(item)
+            return
+
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        futures = dict()
+        done = Queue.Queue()
+        try:
+            for item in items:
+                future = executor.submit(func, item)
+                futures[future] = item
+                future.add_done_callback(done.put)
+                while not done.empty():
+                    future = done.get()
+                    yield futures.pop(future), future.result()
+            while futures:
+                future = done.get()
+                yield futures.pop(future), future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
 
     def _delete_workspace(self):
         """ Deletes the workspace """
-        shutil.rmtree(self.cwd, ignore_errors=True)
+        if getattr(self, 'patch_buffer', None):
+            self.patch_buffer.close()
+        if getattr(self, 'cwd', None):
+            shutil.rmtree(self.cwd, ignore_errors=True)
 
-    def _make_patch_summary(self):
+    def _iter_patch_summary(self, lines):
         """ Parse the git 'am' style patch file
 
-        Returns:
-            A list of dictionaries representing each file. The
-            dictionary will have the following keys:
+        Each file's record is yielded as soon as its header is complete,
+        and also collected into `self.patch_summary`.
+
+        Params:
+            lines (iterable): The patch, one line at a time
+
+        Yields:
+            A dictionary representing each file. The dictionary will
+            have the following keys:
              - path
              - mode
              - is_deleted
+             - pre_image, post_image: The abbreviated blob SHAs from the
+               index line, or None if there's none or the file is renamed
+               or copied
         """
         header_start_re = re.compile(r'^diff --git a/(.*?) b/.*$')
         new_mode_re = re.compile(r'^new (?:file ){0,1}mode (\d+)$')
         deleted_file_re = re.compile(r'deleted file mode (\d+)')
+        renamed_re = re.compile(r'^(?:rename|copy) from ')
+        index_re = re.compile(r'^index ([0-9a-f]+)\.\.([0-9a-f]+)')
         terminator_re = re.compile(r'^(?:index|\+\+\+|---)')
 
-        patch_summary = []
-        with open(self.patchfile, 'r') as f:
-            curr_file = None
-            curr_mode = None
-            curr_deleted = False
-
-            for line in f:
-                if not curr_file:
-                    match = header_start_re.match(line)
-                    if match:
-                        curr_file = match.group(1)
-                else:
-                    match = new_mode_re.match(line)
-                    if match:
-                        curr_mode = match.group(1)
-
-                    match = deleted_file_re.match(line)
-                    if match:
-                        curr_deleted = True
-
-                    match = terminator_re.match(line)
-                    if match:
-                        obj = dict(path=curr_file,
-                                   mode=curr_mode,
-                                   is_deleted=curr_deleted)
-                        patch_summary.append(obj)
-                        curr_file, curr_mode, curr_deleted = None, None, False
-
-            # In some cases the patch file will end without a terminator_re
-            if curr_file:
-                obj = dict(path=curr_file,
-                           mode=curr_mode,
-                           is_deleted=curr_deleted)
-                patch_summary.append(obj)
-
-        self.patch_summary = patch_summary
+        self.patch_summary = patch_summary = []
+        curr_file = None
+        curr_mode = None
+        curr_deleted = False
+        curr_renamed = False
+
+        for line in lines:
+            if not curr_file:
+                match = header_start_re.match(line)
+                if match:
+                    curr_file = match.group(1)
+            else:
+                match = new_mode_re.match(line)
+                if match:
+                    curr_mode = match.group(1)
+
+                match = deleted_file_re.match(line)
+                if match:
+                    curr_deleted = True
+
+                if renamed_re.match(line):
+                    curr_renamed = True
+
+                match = terminator_re.match(line)
+                if match:
+                    images = index_re.match(line)
+                    if images is None or curr_renamed:
+                        images = (None, None)
+                    else:
+                        images = images.groups()
+                    obj = dict(path=curr_file,
+                               mode=curr_mode,
+                               is_deleted=curr_deleted,
+                               pre_image=images[0],
+                               post_image=images[1])
+                    patch_summary.append(obj)
+                    yield obj
+                    curr_file, curr_mode, curr_deleted = None, None, False
+                    curr_renamed = False
+
+        # In some cases the patch file will end without a terminator_re
+        if curr_file:
+            obj = dict(path=curr_file,
+                       mode=curr_mode,
+                       is_deleted=curr_deleted,
+                       pre_image=None,
+                       post_image=None)
+            patch_summary.append(obj)
+            yield obj
 
     def _build_patch_tree(self):
-        """ Create a nested dict representing the patch """
-        patch_tree = dict()
+        """ Create a PatchTreeNode trie representing the patch """
+        patch_tree = PatchTreeNode()
         for item in self.patch_summary:
-            path = item['path']
-            elems = [ x for x in path.split(os.sep) if x != '' ]
-            retdict = self._build_patch_tree_path(item, elems)
-            patch_tree = self._dict_merge(patch_tree, retdict)
+            patch_tree.insert(item['path'], item)
         self.patch_tree = patch_tree
 
-    def _build_patch_tree_path(self, item, elems):
-        """ Recursive method for building the patch dict """
-        key = elems.pop(0)
-        if len(elems) == 0:
-            return { key: item }
-        return { key: self._build_patch_tree_path(item, elems) }
-
-    def _dict_merge(self, a, b):
-        """ Merge dictionaries recursively """
-        if not isinstance(b, dict):
-            return b
-        result = copy.deepcopy(a)
-        for k, v in b.iteritems():
-            if k in result and isinstance(result[k], dict):
-                    result[k] = self._dict_merge(result[k], v)
-            else:
-                result[k] = copy.deepcopy(v)
-        return result
-
     def _build_tree(self, tree):
         """ Head of the recursion for building out the git tree object """
         if 'patch_tree' not in self.__dict__:
             self._build_patch_tree()
+        self._upload_blobs()
+
+        if self.tree_strategy == 'flat':
+            try:
+                return self._build_flat_tree(tree)
+            except GithubUnprocessableEntity as e:
+                logging.info("Flat tree rejected, rebuilding recursively: %s", e)
 
         new_tree = self._build_tree_recurse(self.patch_tree, tree)
-        return self.engine.create_tree(new_tree)
+        return self._remember_tree(self.engine.create_tree(new_tree))
+
+    def _get_tree(self, sha):
+        """ A tree, or a commit's tree, fetched at most once per pick
+
+        Trees never change, so every tree the pick has seen is kept by
+        SHA in `self.trees`: those fetched, those split out of the
+        recursive listing the 'tree' fetch strategy makes, and those
+        created. Later commits in a range find theirs there too.
+        """
+        tree = self.trees.get(sha)
+        if tree is None:
+            tree = self.trees[sha] = self.engine.get_tree(sha)
+        return tree
+
+    def _remember_tree(self, tree):
+        """ Keep a tree Github gave back, returning it """
+        self.trees[tree['sha']] = tree
+        return tree
+
+    def _remember_listing(self, listing, ref):
+        """ Split a recursive listing of `ref` into each directory's tree """
+        if listing.get('truncated'):
+            return
+        trees = {'': dict(sha=listing['sha'], tree=[])}
+        for entry in listing['tree']:
+            if entry['type'] == 'tree':
+                trees[entry['path']] = dict(sha=entry['sha'], tree=[])
+        for entry in listing['tree']:
+            parent, _, name = entry['path'].rpartition('/')
+            trees[parent]['tree'].append(dict(entry, path=name))
+        for tree in trees.values():
+            self.trees[tree['sha']] = tree
+        self.trees[ref] = trees['']
+
+    def _build_flat_tree(self, tree):
+        """ Build the new tree with a single create_tree call
+
+        Every changed file is listed by its full path on top of `tree` as
+        the base_tree. Deleted files are listed with a null sha, which
+        removes them (and any directory left empty).
+        """
+        entries = list()
+        for item in self.patch_summary:
+            entries.append(dict(
+                path=item['path'],
+                mode=item['mode'] or self.default_file_mode,
+                type='blob',
+                sha=None if item['is_deleted'] else self.blob_shas[item['path']]))
+        return self._remember_tree(
+            self.engine.create_tree(dict(base_tree=tree['sha'], tree=entries)))
 
     def _build_tree_recurse(self, hash_entry, tree):
         """ The recursive workhorse that builds the tree """
         tree_entries = { x['path']: x for x in tree['tree'] }
         for k,v in hash_entry.iteritems():
-            if 'path' in v and isinstance(v['path'], str):
+            if v.is_file:
                 # We're a file
 
                 # For mode changes and new files we want to make
                 # sure to take our defaults from the patch entry
                 tree_entry = dict(
                     path=k,
-                    mode=v.get('mode', self.default_file_mode))
+                    mode=v.item['mode'] or self.default_file_mode)
 
-                entry = self._make_blob(v, tree_entry)
+                entry = self._make_blob(v.item, tree_entry)
             else:
                 # We're a tree
                 if k in tree_entries:
-                    next_tree = self.engine.get_tree(tree_entries[k]['sha'])
+                    next_tree = self._get_tree(tree_entries[k]['sha'])
                 else:
                     next_tree = dict(tree=[])
 
-                # For new directories we make sure we take from the
-                # patch entry
                 tree_entry = dict(
                     path=k,
-                    mode=v.get('mode', self.default_dir_mode))
+                    mode=self.default_dir_mode)
 
                 new_tree = self._build_tree_recurse(v, next_tree)
                 entry = self._make_tree(v, tree_entry, new_tree)
@@ -294,26 +1085,82 @@ class CherryPick(object):
         else:
             return dict(tree=tree_entries.values())
 
+    def _upload_blobs(self):
+        """ Make sure Github has a blob for every patched file
+
+        Each file is hashed locally. Only blobs that aren't in `known_blobs`
+        (which holds everything we downloaded) are uploaded, each distinct
+        blob once, using up to `self.workers` threads.
+        """
+        self.blob_shas = dict()
+        missing = dict()
+        for item in self.patch_summary:
+            if item['is_deleted']:
+                continue
+            path = item['path']
+            if path in self.unapplied:
+                self.blob_shas[path] = self.unapplied[path]
+                continue
+            if self._is_large(path):
+                with open(os.path.join(self.files_base, path), 'rb') as f:
+                    sha = self.engine.blob_sha_file(f)
+            else:
+                sha = self.engine.blob_sha(self._read_file(path))
+            self.blob_shas[path] = sha
+            if sha not in self.known_blobs:
+                missing.setdefault(sha, path)
+
+        for sha, uploaded in self._map_concurrent(
+                lambda sha: self._upload_blob(sha, missing[sha]), missing.keys()):
+            pass
+
+    def _upload_blob(self, sha, path):
+        """ Upload the file at `path`, whose blob is `sha`, unless Github has it
+
+        If another pick sharing our blob bookkeeping is already uploading
+        the same blob we wait for that upload instead.
+        """
+        with self._upload_lock:
+            if sha in self.known_blobs:
+                return sha
+            pending = self._uploading.get(sha)
+            if pending is None:
+                pending = self._uploading[sha] = Future()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            return pending.result()
+
+        try:
+            if self._is_large(path):
+                with open(os.path.join(self.files_base, path), 'rb') as f:
+                    uploaded = self.engine.create_blob(f)['sha']
+            else:
+                uploaded = self.engine.create_blob(self._read_file(path))['sha']
+        except Exception as e:
+            with self._upload_lock:
+                del self._uploading[sha]
+            pending.set_exception(e)
+            raise
+
+        with self._upload_lock:
+            self.known_blobs.add(uploaded)
+            del self._uploading[sha]
+        pending.set_result(uploaded)
+        return uploaded
+
     def _make_blob(self, entry, tree_entry):
-        """ Creates a blob out of the filepath and returns it """
+        """ Returns the tree entry for the uploaded blob """
         # If we're deleted just return None
         if entry['is_deleted']:
             return None
 
-        contents = None
-        filepath = entry['path']
-        if os.path.isabs(filepath):
-            abspath = filepath
-        else:
-            abspath = os.path.join(self.files_base, filepath)
-        with open(abspath, 'rb') as f:
-            contents = f.read()
-
-        blob = self.engine.create_blob(contents)
         return dict(
             path=tree_entry['path'],
             mode=tree_entry['mode'] or self.default_file_mode,
-            sha=blob['sha'],
+            sha=self.blob_shas[entry['path']],
             type='blob')
 
     def _make_tree(self, entry, tree_entry, new_tree):
@@ -321,7 +1168,7 @@ class CherryPick(object):
         if new_tree is None:
             return None
 
-        ret_tree = self.engine.create_tree(new_tree)
+        ret_tree = self._remember_tree(self.engine.create_tree(new_tree))
         return dict(
             path=tree_entry['path'],
             mode=tree_entry['mode'] or self.default_dir_mode,
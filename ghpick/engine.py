@@ -1,6 +1,9 @@
 import re
 import json
+import time
+import shutil
 import logging
+import threading
 import requests
 
 try:
@@ -11,8 +14,15 @@ except AttributeError:
 
 logging.captureWarnings(True)
 
+from hashlib import sha1
 from base64 import b64encode, b64decode
 
+from .ratelimit import RateLimitScheduler
+from .retry import RetryPolicy
+from .metrics import NULL_SINK, instrumented, current_operation, operation
+
+from concurrent.futures import ThreadPoolExecutor
+
 class GithubBadRequest(Exception):
     """ 400 Bad Request.
 
@@ -36,6 +46,22 @@ class GithubNotFound(Exception):
     """ 404 Not Found """
     pass
 
+class GithubForbidden(Exception):
+    """ 403 Forbidden
+
+    Also what Github answers when a rate limit has been hit and waiting
+    for it wasn't possible.
+    """
+    pass
+
+class GithubRateLimited(Exception):
+    """ 429 Too Many Requests """
+    pass
+
+class GithubServiceUnavailable(Exception):
+    """ 502, 503 or 504, from Github or a proxy in front of it """
+    pass
+
 class GithubGeneralException(Exception):
     """ Everything Else """
     pass
@@ -44,6 +70,102 @@ class GitInvalidSha(Exception):
     """ Represents an invalid sha """
     pass
 
+def make_session(pool_connections=10, pool_maxsize=10, pool_block=False,
+                 keep_alive=True):
+    """ Build a pooled requests.Session for use by one or more engines
+
+    A single session may be handed to any number of GithubRequestsEngine
+    (and CherryPick) instances so they all draw from the same pool of
+    keep-alive connections. Credentials are sent per request, so engines
+    using different accounts may safely share a session.
+
+    Params:
+        pool_connections (int): Number of per-host pools to cache
+        pool_maxsize (int): Maximum connections kept open per host
+        pool_block (bool): Block when a host's pool is exhausted instead
+            of opening throwaway connections
+        keep_alive (bool): Set to False to close every connection after use
+
+    Returns:
+        requests.Session
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=pool_block)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
+
+class BlobUploadBody(object):
+    """ The JSON body of a blob upload, base64 encoded as it's read
+
+    `source` is a file, read from its current position to its end, or a
+    buffer such as a memoryview. Requests sends the body with a
+    Content-Length and reads it a block at a time, so only about one
+    block of the source is in memory at once. seek(0) starts the body
+    over, so a failed upload can be sent again.
+    """
+    prefix = '{"content": "'
+    suffix = '", "encoding": "base64"}'
+    # A multiple of 3, so each block's base64 joins up without padding
+    block_size = 3 * 64 * 1024
+
+    def __init__(self, source):
+        if hasattr(source, 'read'):
+            self.file = source
+            self.start = source.tell()
+            source.seek(0, 2)
+            self.size = source.tell() - self.start
+            self.view = None
+        else:
+            self.file = None
+            self.view = memoryview(source)
+            self.size = len(self.view)
+        self.seek(0)
+
+    def __len__(self):
+        return len(self.prefix) + 4 * ((self.size + 2) // 3) + len(self.suffix)
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.block_size), '')
+
+    def _blocks(self):
+        yield self.prefix
+        if self.file is not None:
+            self.file.seek(self.start)
+            for block in iter(lambda: self.file.read(self.block_size), ''):
+                yield b64encode(block)
+        else:
+            for offset in xrange(0, self.size, self.block_size):
+                yield b64encode(self.view[offset:offset + self.block_size].tobytes())
+        yield self.suffix
+
+    def read(self, size=-1):
+        while size < 0 or len(self._pending) < size:
+            block = next(self._remaining, None)
+            if block is None:
+                break
+            self._pending += block
+        if size < 0:
+            size = len(self._pending)
+        data, self._pending = self._pending[:size], self._pending[size:]
+        self._position += len(data)
+        return data
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=0):
+        if offset or whence:
+            raise IOError("a blob upload can only be sent again from the start")
+        self._remaining = self._blocks()
+        self._pending = ''
+        self._position = 0
+
 class GithubRequestsEngine(object):
     """ Perform the requests to Github
 
@@ -53,24 +175,85 @@ class GithubRequestsEngine(object):
     HTTP_EXCEPTIONS = {
         400: GithubBadRequest,
         401: GithubInvalidCredentials,
+        403: GithubForbidden,
         409: GithubMergeConflict,
         404: GithubNotFound,
         422: GithubUnprocessableEntity,
-        500: GithubGeneralException
+        429: GithubRateLimited,
+        500: GithubGeneralException,
+        502: GithubServiceUnavailable,
+        503: GithubServiceUnavailable,
+        504: GithubServiceUnavailable
     }
 
-    def __init__(self, username, password, org, repo, base_url=None):
+    def __init__(self, username, password, org, repo, base_url=None,
+                 session=None, timeout=None, ref_cache_ttl=30,
+                 http_cache=None, rate_limiter=None, retry_policy=None,
+                 metrics=None, object_store=None, **session_options):
+        """ GithubRequestsEngine
+
+        Params:
+            username (string): The username
+            password (string): The password
+            org (string): The Github org (could be the username)
+            repo (string): The repo
+            base_url (string): The full URL for Enterprise.
+            session (requests.Session): A session to share with other
+                engines. See `make_session`. One is created if not given.
+            timeout (float or tuple): (connect, read) timeout per request
+            ref_cache_ttl (float): Seconds a resolved branch name (or a name
+                that resolved to nothing) is remembered by `get_sha`. Tags
+                are remembered for the life of the engine. None never
+                expires, 0 disables the cache.
+            http_cache (ghpick.cache.HttpCache): Where to keep GET responses
+                for conditional requests. See ghpick.cache.
+            rate_limiter (RateLimitScheduler): Paces requests by the rate
+                limit headers. Share one between engines using the same
+                credentials. One is made if not given, False disables it.
+            retry_policy (RetryPolicy): How transient failures are retried.
+                One is made if not given, False disables retrying.
+            metrics (ghpick.metrics.MetricsSink): Where to report each
+                request. Nothing is measured if not given.
+            object_store (ghpick.objectstore.ObjectStore): Where to keep
+                blobs, trees, commits and patches fetched by SHA, and the
+                blobs known to be in the repository, so they're never
+                requested again. See ghpick.objectstore.
+            session_options: pool_connections, pool_maxsize, pool_block and
+                keep_alive, passed to `make_session` when no session is given
+        """
         self.username = username
         self.password = password
         self.org = org
         self.repo = repo
+        self.timeout = timeout
+        self.session = session or make_session(**session_options)
+        self.http_cache = http_cache
+        if rate_limiter is None:
+            rate_limiter = RateLimitScheduler()
+        self.rate_limiter = rate_limiter
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self.retry_policy = retry_policy
+        self.metrics = metrics or NULL_SINK
+        self.object_store = object_store
+
+        # name -> (sha or None, expiry or None)
+        self.ref_cache_ttl = ref_cache_ttl
+        self._ref_cache = dict()
+        self._ref_cache_lock = threading.Lock()
 
         base_url = base_url or "https://api.github.com"
         self.base_url = "{}/repos/{}/{}".format(base_url, org, repo)
+        # Enterprise serves REST from /api/v3 and GraphQL from /api/graphql
+        if base_url.endswith('/v3'):
+            self.graphql_url = base_url[:-len('/v3')] + '/graphql'
+        else:
+            self.graphql_url = base_url + '/graphql'
 
         # Endpoints
         self.diff_media_type = "application/vnd.github.3.diff"
         self.patch_media_type = "application/vnd.github.3.patch"
+        self.raw_media_type = "application/vnd.github.3.raw"
         self.contents_url = "{}/contents".format(self.base_url)
         self.merge_url = "{}/merges".format(self.base_url)
         self.compare_url = "{}/compare".format(self.base_url)
@@ -92,6 +275,28 @@ class GithubRequestsEngine(object):
         else:
             return False
 
+    @staticmethod
+    def blob_sha(contents):
+        """ Computes the SHA git (and Github) gives a blob of `contents` """
+        digest = sha1("blob {}\0".format(len(contents)))
+        digest.update(contents)
+        return digest.hexdigest()
+
+    @staticmethod
+    def blob_sha_file(f, block_size=64 * 1024):
+        """ Like blob_sha, for an open file from its current position on
+
+        The file is read a block at a time rather than all at once.
+        """
+        start = f.tell()
+        f.seek(0, 2)
+        size = f.tell() - start
+        f.seek(start)
+        digest = sha1("blob {}\0".format(size))
+        for block in iter(lambda: f.read(block_size), ''):
+            digest.update(block)
+        return digest.hexdigest()
+
     def _make_payload(self, data):
         """ Make the json payload from a dict """
         payload = None
@@ -108,92 +313,464 @@ class GithubRequestsEngine(object):
         if code not in self.HTTP_EXCEPTIONS:
             return True
 
-        logging.debug("Status code in Exceptions: {}".format(code))
+        logging.debug("Status code in Exceptions: %s", code)
         exc = self.HTTP_EXCEPTIONS[code]
-        logging.debug("Raising %s" % exc)
-        
+        logging.debug("Raising %s", exc)
+
+        # Only the body's length, it may be a whole blob
         request = response.request
-        logging.error("METHOD: {}".format(request.method))
-        logging.error("URL: {}".format(request.url))
-        logging.error("BODY: {}".format(request.body))
+        body = request.body
+        logging.error("%s %s failed with %s, sent %s bytes", request.method,
+                      request.url, code, len(body) if hasattr(body, '__len__') else 0)
         raise exc("Message: {}".format(response.text))
 
     ###### HTTP REQUESTS ######
+    def _request(self, method, url, idempotent=None, **kwargs):
+        """ Send a request over the engine's pooled session
+
+        Idempotent requests, GETs unless told otherwise, are retried on
+        transient failures as the retry policy allows.
+        """
+        kwargs.setdefault('auth', (self.username, self.password))
+        kwargs.setdefault('timeout', self.timeout)
+        kwargs.setdefault('verify', False)
+
+        if idempotent is None:
+            idempotent = method == 'GET'
+        if not idempotent or not self.retry_policy:
+            return self._send(method, url, **kwargs)
+        return self.retry_policy.call(
+            lambda: self._send(method, url, **kwargs),
+            description="{} {}".format(method, url),
+            listener=self._count_event)
+
+    def _send(self, method, url, **kwargs):
+        """ Send a request once
+
+        When rate limited the request is held back and sent again, as
+        the rate limiter allows, instead of failing.
+        """
+        if not self.rate_limiter:
+            return self._exchange(method, url, **kwargs)
+
+        attempt = 0
+        while True:
+            if not self.rate_limiter.acquire():
+                raise GithubForbidden(
+                    "Rate limited for longer than {}s, not sending {} {}".format(
+                        self.rate_limiter.max_wait, method, url))
+            response = None
+            try:
+                response = self._exchange(method, url, **kwargs)
+            finally:
+                retry = self.rate_limiter.release(response, attempt)
+            if not retry:
+                return response
+            self._count_event('rate_limited')
+            response.close()
+            attempt += 1
+
+    def _exchange(self, method, url, **kwargs):
+        """ Make one HTTP request, reporting it to the metrics sink """
+        body = kwargs.get('data')
+        if isinstance(body, BlobUploadBody):
+            # Resending it, after a retry or rate limit, starts over
+            body.seek(0)
+        if not self.metrics.enabled:
+            return self.session.request(method, url, **kwargs)
+
+        status = 'error'
+        response = None
+        started = time.time()
+        try:
+            response = self.session.request(method, url, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            seconds = time.time() - started
+            if isinstance(body, (basestring, BlobUploadBody)):
+                request_bytes = len(body)
+            else:
+                request_bytes = 0
+            response_bytes = 0
+            if response is not None:
+                if kwargs.get('stream'):
+                    response_bytes = int(response.headers.get('Content-Length') or 0)
+                else:
+                    response_bytes = len(response.content)
+            self.metrics.observe(current_operation(), method, status, seconds,
+                                 request_bytes, response_bytes)
+
+    def _count_event(self, name):
+        if self.metrics.enabled:
+            self.metrics.count(name, current_operation())
+
+    def rate_limit_state(self):
+        """ The rate limiter's view of the budget, see RateLimitScheduler.state """
+        if not self.rate_limiter:
+            return None
+        return self.rate_limiter.state()
+
+    def retry_stats(self):
+        """ How often requests were retried, see RetryPolicy.stats """
+        if not self.retry_policy:
+            return None
+        return self.retry_policy.stats()
+
+    def object_store_stats(self):
+        """ How often the object store answered, see ObjectStore.stats """
+        if self.object_store is None:
+            return None
+        return self.object_store.stats()
+
+    def _open_stored(self, kind, key):
+        """ An object store entry opened for reading, or None """
+        if self.object_store is None:
+            return None
+        f = self.object_store.open(kind, key)
+        if f is not None:
+            self._count_event('served_from_store')
+        return f
+
+    def _stored(self, kind, key):
+        """ An object store entry's contents, or None """
+        f = self._open_stored(kind, key)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def _stored_json(self, kind, key):
+        data = self._stored(kind, key)
+        if data is None:
+            return None
+        return json.loads(data)
+
+    def _store(self, kind, key, data):
+        if self.object_store is not None:
+            self.object_store.put(kind, key, data)
+
+    def _store_json(self, kind, key, item):
+        """ Store item as JSON, returning it """
+        self._store(kind, key, json.dumps(item))
+        return item
+
+    def _store_file(self, kind, key, f):
+        """ Store the rest of an open file """
+        if self.object_store is not None:
+            with self.object_store.writer(kind, key) as writer:
+                shutil.copyfileobj(f, writer)
+
+    def _in_repo_key(self, sha):
+        """ Marks blobs the repository is known to have """
+        return '/'.join((self.blobs_url, sha))
+
     def _get(self, url, query_parameters=None, media_type=None):
-        """ Abstract the requests.get call """
+        """ Abstract the GET call """
+        body, _ = self._get_cached(url, query_parameters, media_type)
+
+        try:
+            item = json.loads(body)
+        except:
+            item = body
+
+        return item
+
+    def _get_cached(self, url, query_parameters=None, media_type=None):
+        """ GET, as a conditional request if `http_cache` has the response
+
+        Returns:
+            (the body, the response headers). For a 304 the body is the
+            cached one, and the headers have the cached Link header.
+        """
+        headers = dict()
+        if media_type:
+            headers['Accept'] = media_type
+
+        cache_key = cached = None
+        if self.http_cache is not None:
+            cache_key = self._cache_key(url, query_parameters, media_type)
+            cached = self.http_cache.get(cache_key)
+            if cached is not None:
+                if cached['etag']:
+                    headers['If-None-Match'] = cached['etag']
+                if cached['last_modified']:
+                    headers['If-Modified-Since'] = cached['last_modified']
+
+        response = self._request('GET', url,
+            params=query_parameters,
+            headers=headers)
+
+        if cached is not None and response.status_code == 304:
+            self.http_cache.record_not_modified()
+            headers = requests.structures.CaseInsensitiveDict(response.headers)
+            if cached.get('link') and 'Link' not in headers:
+                headers['Link'] = cached['link']
+            return cached['body'], headers
+
+        self._validate_response(response)
+        if cache_key is not None:
+            self._cache_response(cache_key, response)
+        return response.text, response.headers
+
+    def _cache_key(self, url, query_parameters, media_type):
+        """ Responses differ by URL, query, media type and who's asking """
+        query = sorted((query_parameters or {}).items())
+        return json.dumps([self.username, url, query, media_type])
+
+    def _cache_response(self, cache_key, response):
+        """ Keep a response that can be revalidated later """
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if response.status_code != 200 or not (etag or last_modified):
+            return
+        self.http_cache.put(cache_key, dict(
+            etag=etag,
+            last_modified=last_modified,
+            content_type=response.headers.get('Content-Type'),
+            link=response.headers.get('Link'),
+            body=response.text))
+
+    def _get_lines(self, url, query_parameters=None, media_type=None,
+                   chunk_size=64 * 1024, store_as=None):
+        """ Abstract a streamed GET
+
+        The request is sent, and its status checked, straight away. The
+        body is then read `chunk_size` bytes at a time as it's consumed.
+
+        With `store_as`, a (kind, key) pair, the body is read from the
+        object store if it's there, and stored once it's all been read
+        if it isn't.
+
+        Returns:
+            A generator yielding the raw body one line at a time, with
+            line endings kept.
+        """
+        if store_as:
+            f = self._open_stored(*store_as)
+            if f is not None:
+                return self._split_lines(self._iter_file(f, chunk_size))
+
         headers = dict()
         if media_type:
             headers['Accept'] = media_type
 
-        response = requests.get(url, 
+        response = self._request('GET', url,
             params=query_parameters,
-            auth=(self.username, self.password),
             headers=headers,
-            verify=False)
+            stream=True)
+
+        self._validate_response(response)
+        chunks = self._iter_content(response, chunk_size)
+        if store_as and self.object_store is not None:
+            chunks = self._teed(chunks, store_as)
+        return self._split_lines(chunks)
+
+    def _download(self, url, stream_to, query_parameters=None,
+                  chunk_size=64 * 1024, store_as=None):
+        """ Write a raw GET's body to the file `stream_to` as it arrives
 
+        With `store_as`, a (kind, key) pair, it's also kept in the
+        object store.
+
+        Returns:
+            The number of bytes written
+        """
+        response = self._request('GET', url,
+            params=query_parameters,
+            headers={'Accept': self.raw_media_type},
+            stream=True)
         self._validate_response(response)
+        chunks = self._iter_content(response, chunk_size)
+        if store_as and self.object_store is not None:
+            chunks = self._teed(chunks, store_as)
+        size = 0
+        for chunk in chunks:
+            stream_to.write(chunk)
+            size += len(chunk)
+        return size
 
+    @staticmethod
+    def _iter_content(response, chunk_size):
+        """ A streamed body's chunks, closing the response after """
         try:
-            item = response.json()
-        except:
-            item = response.text
+            for chunk in response.iter_content(chunk_size):
+                yield chunk
+        finally:
+            response.close()
 
-        return item
+    @staticmethod
+    def _iter_file(f, chunk_size):
+        with f:
+            for chunk in iter(lambda: f.read(chunk_size), ''):
+                yield chunk
+
+    def _teed(self, chunks, store_as):
+        """ Pass chunks through, storing them as `store_as` if all go by
+
+        The entry is only started once the first chunk is asked for, so a
+        body that's never read leaves nothing behind in the store.
+        """
+        writer = self.object_store.writer(*store_as)
+        try:
+            for chunk in chunks:
+                writer.write(chunk)
+                yield chunk
+        except BaseException:
+            # Including GeneratorExit, when the reader stops early
+            writer.abort()
+            raise
+        writer.commit()
+
+    @staticmethod
+    def _split_lines(chunks):
+        """ Split a streamed body on \n only, keeping line endings
+
+        The unfinished line is kept as a list of pieces and only joined
+        once its newline arrives, so a very long line costs its length
+        rather than its length times the number of chunks.
+        """
+        pending = []
+        for chunk in chunks:
+            start = 0
+            end = chunk.find('\n')
+            while end != -1:
+                if pending:
+                    pending.append(chunk[start:end + 1])
+                    yield ''.join(pending)
+                    pending = []
+                else:
+                    yield chunk[start:end + 1]
+                start = end + 1
+                end = chunk.find('\n', start)
+            if start < len(chunk):
+                pending.append(chunk[start:])
+        if pending:
+            yield ''.join(pending)
 
     def _patch(self, url, data=None):
-        """ Abstract the requests.patch call """
+        """ Abstract the PATCH call """
         payload = self._make_payload(data)
 
-        response = requests.patch(url,
-            data=payload,
-            auth=(self.username, self.password),
-            verify=False)
+        response = self._request('PATCH', url, data=payload)
         self._validate_response(response)
         item = response.json()
 
         return item
 
-    def _post(self, url, data=None):
-        """ Abstract the requests.post call """
+    def _post(self, url, data=None, idempotent=False):
+        """ Abstract the POST call
+
+        Only pass idempotent for objects that are content addressed, so
+        sending them twice is harmless.
+        """
         payload = self._make_payload(data)
 
-        logging.debug("POST %s" % url)
-        logging.debug("PAYLOAD: %s" % payload)
-        response = requests.post(url,
-            data=payload,
-            auth=(self.username, self.password),
-            verify=False)
+        logging.debug("POST %s", url)
+        logging.debug("PAYLOAD: %s", payload)
+        response = self._request('POST', url, data=payload,
+                                 idempotent=idempotent)
 
         self._validate_response(response)
         item = response.json()
 
         return item
+
+    def connection_stats(self):
+        """ Report how well the session's connection pool is being reused
+
+        The numbers cover every engine sharing this engine's session.
+
+        Returns:
+            A dict with the keys:
+             - pools: Number of per-host pools currently open
+             - requests: Requests sent through those pools
+             - connections: Connections opened by those pools
+             - reused: Requests that went over an already open connection
+        """
+        stats = dict(pools=0, requests=0, connections=0)
+        adapters = set(self.session.adapters.values())
+        for adapter in adapters:
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                stats['pools'] += 1
+                stats['requests'] += pool.num_requests
+                stats['connections'] += pool.num_connections
+        stats['reused'] = max(stats['requests'] - stats['connections'], 0)
+        return stats
     ######
 
+    @instrumented
     def create_blob(self, contents):
         """ Creates a blob
 
         Params:
-            contents (string): The contents to write to the file.
+            contents (string, file or buffer): The contents to write to
+                the file. Files, read from their current position, and
+                buffers such as memoryviews are base64 encoded a block at
+                a time as they're sent instead of all at once.
 
         Returns:
             https://developer.github.com/v3/git/blobs/#response-1
         """
-        payload = dict(content=b64encode(contents), encoding="base64")
-        return self._post(self.blobs_url, data=payload)
-
-    def get_blob(self, sha):
+        sha = None
+        if self.object_store is not None:
+            if isinstance(contents, basestring):
+                sha = self.blob_sha(contents)
+            elif hasattr(contents, 'read'):
+                start = contents.tell()
+                sha = self.blob_sha_file(contents)
+                contents.seek(start)
+            else:
+                sha = self.blob_sha(memoryview(contents))
+            if self._stored('in_repo', self._in_repo_key(sha)) is not None:
+                return dict(sha=sha, url='/'.join((self.blobs_url, sha)))
+
+        if isinstance(contents, basestring):
+            payload = dict(content=b64encode(contents), encoding="base64")
+        else:
+            payload = BlobUploadBody(contents)
+        blob = self._post(self.blobs_url, data=payload, idempotent=True)
+        if sha is not None:
+            self._store('in_repo', self._in_repo_key(blob['sha']), '')
+        return blob
+
+    @instrumented
+    def get_blob(self, sha, stream_to=None):
         """ Retrieve a blob by SHA
 
         Params:
             sha (string): The blob SHA
+            stream_to (file): Write the raw contents here as they arrive
+                instead of returning them base64 encoded
 
         Returns:
             https://developer.github.com/v3/git/blobs/#get-a-blob
+            or, with `stream_to`, dict(sha, size)
         """
         url = '/'.join((self.blobs_url, sha))
-        return self._get(url)
-
+        if stream_to is not None:
+            f = self._open_stored('blob', sha)
+            if f is None:
+                size = self._download(url, stream_to, store_as=('blob', sha))
+                self._store('in_repo', self._in_repo_key(sha), '')
+                return dict(sha=sha, size=size)
+            with f:
+                shutil.copyfileobj(f, stream_to)
+                return dict(sha=sha, size=f.tell())
+
+        content = self._stored('blob', sha)
+        if content is not None:
+            return dict(sha=sha, size=len(content), encoding='base64',
+                        content=b64encode(content))
+        blob = self._get(url)
+        if self.object_store is not None:
+            self._store('blob', sha, b64decode(blob['content']))
+            self._store('in_repo', self._in_repo_key(sha), '')
+        return blob
+
+    @instrumented
     def get_tree(self, sha, recursive=False):
         """ Get the tree pointed at by the tree sha
 
@@ -209,11 +786,18 @@ class GithubRequestsEngine(object):
         url = '/'.join((self.trees_url, sha))
 
         query_parameters = None
+        key = sha
         if recursive:
             query_parameters = dict(recursive=True)
+            key += ':recursive'
 
-        return self._get(url, query_parameters=query_parameters)
+        tree = self._stored_json('tree', key)
+        if tree is None:
+            tree = self._store_json('tree', key,
+                self._get(url, query_parameters=query_parameters))
+        return tree
 
+    @instrumented
     def create_tree(self, tree):
         """ Create the given tree
 
@@ -232,12 +816,16 @@ class GithubRequestsEngine(object):
         Returns the tree from github. See:
         https://developer.github.com/v3/git/trees/#create-a-tree
         """
-        new_tree = self._post(self.trees_url, data=tree)
+        new_tree = self._post(self.trees_url, data=tree, idempotent=True)
         return new_tree
 
+    @instrumented
     def point_branch(self, branch, commit_sha):
         """ Update a branch to point at the commit sha 
 
+        If the update fails transiently the branch is read back, and the
+        update only sent again if it didn't land.
+
         Params:
             branch (string): The name of the branch
             commit_sha (string): The commit SHA to point the branch at
@@ -248,8 +836,26 @@ class GithubRequestsEngine(object):
         sha = self.get_sha(commit_sha)
         url = '/'.join((self.refs_url, 'heads', branch))
         payload = dict(sha=commit_sha)
-        return self._patch(url, data=payload)
-
+        send = lambda: self._patch(url, data=payload)
+        if self.retry_policy:
+            ref = self.retry_policy.reconcile(
+                send, lambda: self._branch_at(branch, commit_sha),
+                transient=(GithubGeneralException, GithubServiceUnavailable),
+                description="update of {}".format(branch),
+                listener=self._count_event)
+        else:
+            ref = send()
+        self._cache_ref(branch, ref['object']['sha'], self.ref_cache_ttl)
+        return ref
+
+    def _branch_at(self, branch, commit_sha):
+        """ Returns the branch's ref if it points at commit_sha, else None """
+        ref = self.get_ref('heads', branch)
+        if ref['object']['sha'] == commit_sha:
+            return ref
+        return None
+
+    @instrumented
     def get_ref(self, namespace, name):
         """ Returns a ref
 
@@ -280,31 +886,205 @@ class GithubRequestsEngine(object):
         if self.is_valid_sha(item):
             return item
 
+        found, sha = self._cached_ref(item)
+        if found:
+            if sha is None:
+                raise GitInvalidSha("{} could not be converted to a SHA-1".format(item))
+            return sha
+
         # Both methods raise exceptions. This is better.
-        for method in (self.get_branch, self.get_tag):
+        # Branches move so they expire, tags are forever.
+        for method, ttl in ((self.get_branch, self.ref_cache_ttl),
+                            (self.get_tag, None)):
+            # Anything but a 404 (a timeout, Github being down) isn't an
+            # answer, and mustn't be remembered as one
             try:
-                return method(item)['object']['sha']
-            except:
-                pass
+                ref = method(item)
+            except GithubNotFound:
+                continue
+            if not isinstance(ref, dict):
+                # Several refs start with the name, none of them is it
+                continue
+            sha = ref['object']['sha']
+            self._cache_ref(item, sha, ttl)
+            return sha
+
+        self._cache_ref(item, None, self.ref_cache_ttl)
         raise GitInvalidSha("{} could not be converted to a SHA-1".format(item))
 
-    def get_file(self, path, commit_sha):
+    def _cached_ref(self, name):
+        """ Look up a name in the ref cache
+
+        Returns:
+            (found, sha). sha is None for a cached failed lookup.
+        """
+        with self._ref_cache_lock:
+            entry = self._ref_cache.get(name)
+            if entry is None:
+                return False, None
+            sha, expires = entry
+            if expires is not None and expires <= time.time():
+                del self._ref_cache[name]
+                return False, None
+        return True, sha
+
+    def _cache_ref(self, name, sha, ttl):
+        """ Remember what a name resolved to for `ttl` seconds """
+        if ttl == 0:
+            return
+        expires = None if ttl is None else time.time() + ttl
+        with self._ref_cache_lock:
+            self._ref_cache[name] = (sha, expires)
+
+    def invalidate_ref(self, name=None):
+        """ Forget a cached ref resolution, or all of them if no name given """
+        with self._ref_cache_lock:
+            if name is None:
+                self._ref_cache.clear()
+            else:
+                self._ref_cache.pop(name, None)
+
+    @instrumented
+    def get_file(self, path, commit_sha, stream_to=None):
         """ Retrieves the file
 
         Args:
             path (string): The path to the file`
             commit_sha (string): The sha, branch, or tag to retrieve the file from
+            stream_to (file): Write the raw contents here as they arrive
+                instead of holding them in memory. It must be open for
+                reading too ('w+b'), the blob SHA is worked out from it.
 
         Returns:
             The contents struct defined at:
             https://developer.github.com/v3/repos/contents/#get-contents
+            or, with `stream_to`, dict(path, sha, size)
         """
         sha = self.get_sha(commit_sha)
         url = '/'.join((self.contents_url, path))
-        fetched = self._get(url, query_parameters=dict(ref=sha))
-        fetched['content'] = b64decode(fetched['content'])
+        path_key = ':'.join((sha, path))
+
+        # The store knows the blob at this path, and maybe has its contents
+        blob_sha = self._stored('path', path_key)
+        if blob_sha is not None:
+            if stream_to is not None:
+                f = self._open_stored('blob', blob_sha)
+                if f is not None:
+                    with f:
+                        shutil.copyfileobj(f, stream_to)
+                        return dict(path=path, sha=blob_sha, size=f.tell())
+            else:
+                content = self._stored('blob', blob_sha)
+                if content is not None:
+                    return dict(path=path, sha=blob_sha, size=len(content),
+                                content=content)
+
+        if stream_to is not None:
+            start = stream_to.tell()
+            size = self._download(url, stream_to, query_parameters=dict(ref=sha))
+            stream_to.seek(start)
+            fetched = dict(path=path, sha=self.blob_sha_file(stream_to), size=size)
+            if self.object_store is not None:
+                stream_to.seek(start)
+                self._store_file('blob', fetched['sha'], stream_to)
+        else:
+            fetched = self._get(url, query_parameters=dict(ref=sha))
+            fetched['content'] = b64decode(fetched['content'])
+            self._store('blob', fetched['sha'], fetched['content'])
+        self._store('path', path_key, fetched['sha'])
+        self._store('in_repo', self._in_repo_key(fetched['sha']), '')
         return fetched
 
+    @instrumented
+    def get_files(self, paths, commit_sha, batch_size=100):
+        """ Retrieves many files at once using GraphQL
+
+        Each batch of `batch_size` paths is one query made of aliased
+        `object(expression: "<sha>:<path>")` fields. Binary files and
+        files too large for GraphQL to return are downloaded as blobs.
+
+        Args:
+            paths (iterable): The paths to retrieve
+            commit_sha (string): The sha, branch, or tag to retrieve them from
+            batch_size (int): Most paths per query, to stay inside
+                GraphQL's cost limits
+
+        Returns:
+            A dict of path -> dict(sha, content), or None for paths that
+            aren't files on `commit_sha`
+        """
+        sha = self.get_sha(commit_sha)
+        files = dict()
+        paths = [ path for path in paths
+                  if not self._stored_file(sha, path, files) ]
+        for start in xrange(0, len(paths), batch_size):
+            fetched = self._query_files(paths[start:start + batch_size], sha)
+            if self.object_store is not None:
+                for path, blob in fetched.items():
+                    if blob is not None:
+                        self._store('blob', blob['sha'], blob['content'])
+                        self._store('path', ':'.join((sha, path)), blob['sha'])
+            files.update(fetched)
+        return files
+
+    def _stored_file(self, sha, path, files):
+        """ Put path's blob from the object store into files, if it's there """
+        blob_sha = self._stored('path', ':'.join((sha, path)))
+        if blob_sha is None:
+            return False
+        content = self._stored('blob', blob_sha)
+        if content is None:
+            return False
+        files[path] = dict(sha=blob_sha, content=content)
+        return True
+
+    def _query_files(self, paths, sha):
+        """ Make a single GraphQL query for `paths` """
+        fields = [ "f{}: object(expression: {}) {{ ...blob }}".format(
+                       n, json.dumps("{}:{}".format(sha, path)))
+                   for n, path in enumerate(paths) ]
+        query = ("query($owner: String!, $name: String!) {\n"
+                 "  repository(owner: $owner, name: $name) {\n    " +
+                 "\n    ".join(fields) +
+                 "\n  }\n}\n"
+                 "fragment blob on Blob { oid isBinary isTruncated text }\n")
+        payload = dict(query=query, variables=dict(owner=self.org, name=self.repo))
+        result = self._post(self.graphql_url, data=payload, idempotent=True)
+
+        repository = (result.get('data') or {}).get('repository')
+        if repository is None:
+            errors = result.get('errors') or []
+            if len(paths) > 1:
+                # Likely over a cost limit, try smaller queries
+                logging.warning("GraphQL query for %d paths failed, splitting it",
+                                len(paths))
+                half = len(paths) // 2
+                files = self._query_files(paths[:half], sha)
+                files.update(self._query_files(paths[half:], sha))
+                return files
+            raise GithubGeneralException("GraphQL: {}".format(
+                '; '.join(e.get('message', '') for e in errors)))
+
+        files = dict()
+        for n, path in enumerate(paths):
+            blob = repository.get("f{}".format(n))
+            if not blob:
+                # Missing, or not a blob
+                files[path] = None
+                continue
+            content = None
+            if not blob['isBinary'] and not blob['isTruncated'] and \
+                    blob['text'] is not None:
+                content = blob['text'].encode('utf-8')
+                if self.blob_sha(content) != blob['oid']:
+                    # Not UTF-8 after all, so the text isn't byte exact
+                    content = None
+            if content is None:
+                content = b64decode(self.get_blob(blob['oid'])['content'])
+            files[path] = dict(sha=blob['oid'], content=content)
+        return files
+
+    @instrumented
     def get_tag(self, tag):
         """ Retrieves a lightweight tag
 
@@ -320,6 +1100,7 @@ class GithubRequestsEngine(object):
         """
         return self.get_ref('tags', tag)
 
+    @instrumented
     def get_branch(self, branch):
         """ Retrieve a branch
 
@@ -332,6 +1113,7 @@ class GithubRequestsEngine(object):
         """
         return self.get_ref('heads', branch)
 
+    @instrumented
     def get_commit(self, sha):
         """ Returns a single commit
 
@@ -344,12 +1126,37 @@ class GithubRequestsEngine(object):
         """
         sha = self.get_sha(sha)
         url = '/'.join((self.commits_url, sha))
-        return self._get(url)
+        commit = self._stored_json('commit', sha)
+        if commit is None:
+            commit = self._store_json('commit', sha, self._get(url))
+        return commit
+
+    @instrumented
+    def get_repo_commit(self, sha):
+        """ Retrieve a commit through the repository commits API
+
+        Unlike `get_commit` the result includes the files the commit
+        changed, and its author and message are under 'commit'.
+
+        Args:
+            sha (string): The sha, branch, or tag
+
+        Returns:
+            https://developer.github.com/v3/repos/commits/#get-a-single-commit
+        """
+        sha = self.get_sha(sha)
+        url = '/'.join((self.repo_commits_url, sha))
+        commit = self._stored_json('repo_commit', sha)
+        if commit is None:
+            commit = self._store_json('repo_commit', sha, self._get(url))
+        return commit
 
+    @instrumented
     def create_commit(self, message, tree_sha, parents, author_info):
         """ Creates a commit
 
-        Creates a commit that points to the given tree.
+        Creates a commit that points to the given tree. Never retried,
+        as a resend could make a second commit.
 
         Args:
             message (string): The message
@@ -365,42 +1172,104 @@ class GithubRequestsEngine(object):
             parents=parents)
         return self._post(self.commits_url, data=payload)
 
-    def commits(self, starting_sha, ending_sha):
+    @instrumented
+    def commits(self, starting_sha, ending_sha, per_page=100):
         """ Returns the list of commits between two shas.
 
         Returns a list of commits between the starting_sha and
-        the destination sha.
+        the destination sha. See `iter_commits`.
 
         Args:
             starting_sha (string): The sha or tag or branch tip to start from
             destination_sha (string): The sha, tag, or branch to search until
 
         Returns:
-            A tuple of commit objects.
+            A list of commit objects, newest first.
             See https://developer.github.com/v3/git/commits/#get-a-commit
         """
+        return list(self.iter_commits(starting_sha, ending_sha, per_page))
+
+    @instrumented
+    def iter_commits(self, starting_sha, ending_sha, per_page=100,
+                     prefetch=True):
+        """ Yields the commits between two shas, newest first
+
+        Pages of `per_page` commits are read as the caller consumes them,
+        following the Link headers, and no page is read past the one
+        holding `starting_sha`. With `prefetch` the next page is requested
+        while the caller works through the current one.
+
+        Args:
+            starting_sha (string): The sha or tag or branch tip to start
+                from. It isn't included.
+            ending_sha (string): The sha, tag, or branch to search until
+            per_page (int): Commits per page, at most 100
+            prefetch (bool): Request the next page in the background
+        """
         starting_sha = self.get_sha(starting_sha)
         ending_sha = self.get_sha(ending_sha)
 
         starting_commit = self.get_commit(starting_sha)
         starting_time = starting_commit['committer']['date']
 
-        commit_list = self._get(self.repo_commits_url, query_parameters=dict(
+        return self._walk_commits(starting_sha, dict(
             sha=ending_sha,
-            since=starting_time))
+            since=starting_time,
+            per_page=per_page), prefetch)
 
-        pared_commit_list = list()
-        for commit in commit_list:
-            if commit['sha'] == starting_commit['sha']:
-                break
-            pared_commit_list.append(commit)
-        return pared_commit_list
-    
-    def compare(self, base_sha, destination_sha, as_diff=False, as_patch=False):
+    def _walk_commits(self, starting_sha, query_parameters, prefetch):
+        def fetch(url, query_parameters=None):
+            with operation('iter_commits'):
+                return self._get_page(url, query_parameters)
+
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            page, next_url = fetch(self.repo_commits_url, query_parameters)
+            while True:
+                more = next_url and not any(
+                    commit['sha'] == starting_sha for commit in page)
+                upcoming = None
+                if more and executor is not None:
+                    upcoming = executor.submit(fetch, next_url)
+
+                for commit in page:
+                    if commit['sha'] == starting_sha:
+                        return
+                    yield commit
+
+                if not more:
+                    return
+                if upcoming is not None:
+                    page, next_url = upcoming.result()
+                else:
+                    page, next_url = fetch(next_url)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    def _get_page(self, url, query_parameters=None):
+        """ GET one page of a list
+
+        Returns:
+            (items, the URL of the next page or None)
+        """
+        body, headers = self._get_cached(url, query_parameters)
+        next_url = None
+        for link in requests.utils.parse_header_links(headers.get('Link') or ''):
+            if link.get('rel') == 'next':
+                next_url = link['url']
+        return json.loads(body), next_url
+
+    @instrumented
+    def compare(self, base_sha, destination_sha, as_diff=False, as_patch=False,
+                stream=False):
         """ Compares two commits
 
         Compare two commits and return a structure defined at
         https://developer.github.com/v3/repos/commits/#compare-two-commits
+
+        With `stream` and `as_diff` or `as_patch` the diff is returned
+        as a generator of lines, read from the network as it's consumed.
         """
         base_sha = self.get_sha(base_sha)
         destination_sha = self.get_sha(destination_sha)
@@ -413,6 +1282,14 @@ class GithubRequestsEngine(object):
         elif as_patch:
             media_type = self.patch_media_type
 
-        return self._get(url, media_type=media_type)
+        if stream and media_type:
+            return self._get_lines(url, media_type=media_type,
+                                   store_as=('compare', compare_string + media_type))
+        if media_type:
+            return self._get(url, media_type=media_type)
+        comparison = self._stored_json('compare', compare_string)
+        if comparison is None:
+            comparison = self._store_json('compare', compare_string, self._get(url))
+        return comparison
 
 
@@ -0,0 +1,193 @@
+""" Request metrics for the engine
+
+Every HTTP exchange the engine makes is reported to a sink, keyed by the
+logical operation that made it (get_tree, create_blob, ...) rather than
+its URL. The default sink is disabled and costs nothing; nothing about a
+request is measured unless the sink is enabled.
+
+    metrics = InMemorySink()
+    cherry = CherryPick(..., metrics=metrics)
+    cherry.patch(sha, branch)
+    print metrics.snapshot()['get_file']['count']
+    print to_prometheus(metrics.snapshot())
+"""
+import bisect
+import functools
+import threading
+import contextlib
+
+_local = threading.local()
+
+def current_operation():
+    """ The innermost operation running on this thread, or 'other' """
+    operations = getattr(_local, 'operations', None)
+    return operations[-1] if operations else 'other'
+
+@contextlib.contextmanager
+def operation(name):
+    """ Attribute the requests made inside the block to `name` """
+    operations = _local.__dict__.setdefault('operations', [])
+    operations.append(name)
+    try:
+        yield
+    finally:
+        operations.pop()
+
+def instrumented(func):
+    """ Attribute the requests a method makes to the method's name """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with operation(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+class MetricsSink(object):
+    """ Where the engine reports its requests
+
+    Subclasses set `enabled` and implement observe and count. The engine
+    skips all measuring when `enabled` is False.
+    """
+    enabled = False
+
+    def observe(self, operation, method, status, seconds, request_bytes,
+                response_bytes):
+        """ Record one HTTP exchange
+
+        Params:
+            operation (string): The engine method that sent it
+            method (string): GET, POST or PATCH
+            status (int or string): The status code, or 'error' when no
+                response came back
+            seconds (float): Time until the response headers arrived
+            request_bytes (int): Size of the body sent
+            response_bytes (int): Size of the body received. Streamed
+                responses report their Content-Length, if any.
+        """
+        pass
+
+    def count(self, name, operation, value=1):
+        """ Count an event, i.e. 'retries' or 'rate_limited' """
+        pass
+
+class InMemorySink(MetricsSink):
+    """ Keeps counts and latency histograms per operation in memory """
+    enabled = True
+
+    # Upper bounds of the latency histogram buckets, in seconds
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = dict()
+
+    def _entry(self, operation):
+        entry = self._operations.get(operation)
+        if entry is None:
+            entry = self._operations[operation] = dict(
+                count=0,
+                seconds=0.0,
+                # One more than buckets, for +Inf
+                histogram=[0] * (len(self.buckets) + 1),
+                request_bytes=0,
+                response_bytes=0,
+                methods=dict(),
+                statuses=dict(),
+                events=dict())
+        return entry
+
+    def observe(self, operation, method, status, seconds, request_bytes,
+                response_bytes):
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            entry = self._entry(operation)
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['histogram'][bucket] += 1
+            entry['request_bytes'] += request_bytes
+            entry['response_bytes'] += response_bytes
+            entry['methods'][method] = entry['methods'].get(method, 0) + 1
+            entry['statuses'][status] = entry['statuses'].get(status, 0) + 1
+
+    def count(self, name, operation, value=1):
+        with self._lock:
+            events = self._entry(operation)['events']
+            events[name] = events.get(name, 0) + value
+
+    def snapshot(self):
+        """ Returns a copy of everything recorded so far
+
+        A dict of operation -> dict with the keys count, seconds,
+        histogram (requests per bucket, not cumulative, the last for
+        anything slower than the largest bucket), request_bytes,
+        response_bytes, methods (method -> count), statuses (status ->
+        count) and events (name -> count).
+        """
+        with self._lock:
+            snapshot = dict()
+            for operation, entry in self._operations.items():
+                copied = dict(entry)
+                for key in ('histogram', 'methods', 'statuses', 'events'):
+                    copied[key] = type(entry[key])(entry[key])
+                snapshot[operation] = copied
+            return snapshot
+
+    def reset(self):
+        with self._lock:
+            self._operations.clear()
+
+NULL_SINK = MetricsSink()
+
+def _labels(**labels):
+    return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in sorted(labels.items()))
+
+def to_prometheus(snapshot, prefix='ghpick', buckets=InMemorySink.buckets):
+    """ Render an InMemorySink snapshot in the Prometheus text format
+
+    Returns:
+        The exposition text, one metric family after another
+    """
+    lines = []
+
+    def family(name, kind, help):
+        lines.append('# HELP {}_{} {}'.format(prefix, name, help))
+        lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+
+    def sample(name, labels, value):
+        lines.append('{}_{}{{{}}} {}'.format(prefix, name, labels, value))
+
+    operations = sorted(snapshot.items())
+
+    family('requests_total', 'counter', 'Requests sent to Github')
+    for operation, entry in operations:
+        for status, count in sorted(entry['statuses'].items()):
+            sample('requests_total', _labels(operation=operation, status=status), count)
+
+    family('request_duration_seconds', 'histogram',
+           'Time until Github started responding')
+    for operation, entry in operations:
+        cumulative = 0
+        for bound, count in zip(buckets + ('+Inf',), entry['histogram']):
+            cumulative += count
+            sample('request_duration_seconds_bucket',
+                   _labels(operation=operation, le=bound), cumulative)
+        sample('request_duration_seconds_sum', _labels(operation=operation),
+               repr(entry['seconds']))
+        sample('request_duration_seconds_count', _labels(operation=operation),
+               entry['count'])
+
+    for name, help in (('request_bytes', 'Bytes sent to Github'),
+                       ('response_bytes', 'Bytes received from Github')):
+        family(name + '_total', 'counter', help)
+        for operation, entry in operations:
+            sample(name + '_total', _labels(operation=operation), entry[name])
+
+    events = sorted(set(name for _, entry in operations for name in entry['events']))
+    for name in events:
+        family(name + '_total', 'counter', 'Requests {}'.format(name.replace('_', ' ')))
+        for operation, entry in operations:
+            if name in entry['events']:
+                sample(name + '_total', _labels(operation=operation),
+                       entry['events'][name])
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,295 @@
+""" A persistent store for what Github gives back by SHA
+
+Blobs, trees and commits never change once they have a SHA, so the
+engine can keep them on disk and never ask for them again. Pass a store
+to the engine (or CherryPick) as `object_store`:
+
+    store = ObjectStore('/var/cache/ghpick', max_bytes=2 * 1024 ** 3)
+    cherry = CherryPick(..., object_store=store)
+
+Every entry is a file named after the hash of its kind and key, written
+to a temporary name and renamed into place, so several processes may
+share a directory. Recency is the file's mtime: reading an entry touches
+it, and when the store grows past `max_bytes` the least recently used
+entries are removed until it's back under `low_water` of that. The
+store's size is kept in a file next to the entries, updated under a lock
+file as each entry is committed, so the limit holds for every process
+sharing the store together rather than for each on its own. Entries still
+being written are counted too, and a sweep removes those that haven't
+been written to for `tmp_grace` seconds, left by a writer that died.
+"""
+import os
+import time
+import errno
+import shutil
+import hashlib
+import tempfile
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    # Not on POSIX, sweeps from several processes may overlap
+    fcntl = None
+
+class ObjectWriter(object):
+    """ Writes one entry, which only appears in the store once committed
+
+    Use it as a context manager to commit when the block finishes and
+    discard the entry if it raises.
+    """
+
+    def __init__(self, store, kind, key):
+        self.store = store
+        self.kind = kind
+        self.key = key
+        self.file = tempfile.NamedTemporaryFile(dir=store.path, suffix='.tmp',
+                                                delete=False)
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        self.file.close()
+        self.store._commit(self.kind, self.key, self.file.name, self.size)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.file.name)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+class ObjectStore(object):
+    """ An LRU store of immutable objects in a directory
+
+    Entries are byte strings stored under a kind ('blob', 'tree', ...)
+    and a key, usually a SHA.
+    """
+    # Seconds after its last write that an unfinished entry is abandoned
+    tmp_grace = 3600
+
+    def __init__(self, path, max_bytes=1024 * 1024 * 1024, low_water=0.8):
+        """ ObjectStore
+
+        Params:
+            path (string): The directory to keep the objects in. Created
+                if it doesn't exist.
+            max_bytes (int): Sweep the least recently used entries once
+                the store is bigger than this
+            low_water (float): The fraction of max_bytes a sweep stops at
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self._lock = threading.Lock()
+        self.hits = dict()
+        self.misses = dict()
+        self.stored = 0
+        self.evicted = 0
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _filename(self, kind, key):
+        name = hashlib.sha1('{}:{}'.format(kind, key)).hexdigest()
+        return os.path.join(self.path, name[:2], name[2:])
+
+    def _record(self, counts, kind):
+        with self._lock:
+            counts[kind] = counts.get(kind, 0) + 1
+
+    def open(self, kind, key):
+        """ Returns the entry opened for reading, or None if there's none """
+        filename = self._filename(kind, key)
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            self._record(self.misses, kind)
+            return None
+        try:
+            os.utime(filename, None)
+        except OSError:
+            # Swept since we opened it, our handle still reads it
+            pass
+        self._record(self.hits, kind)
+        return f
+
+    def get(self, kind, key):
+        """ Returns the entry's contents, or None if there's none """
+        f = self.open(kind, key)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def put(self, kind, key, data):
+        """ Store an entry """
+        with self.writer(kind, key) as writer:
+            writer.write(data)
+
+    def writer(self, kind, key):
+        """ Returns an ObjectWriter to store an entry a piece at a time """
+        return ObjectWriter(self, kind, key)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """ Hold the store's lock file, shared with every other process """
+        with open(os.path.join(self.path, 'lock'), 'a') as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _read_size(self):
+        """ The bytes stored, as last written, or None if never counted """
+        try:
+            with open(os.path.join(self.path, 'size')) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return None
+
+    def _write_size(self, size):
+        """ Replace the size file in one go, for readers without the lock """
+        new = os.path.join(self.path, 'size.new')
+        with open(new, 'w') as f:
+            f.write(str(size))
+        os.rename(new, os.path.join(self.path, 'size'))
+
+    def _commit(self, kind, key, tmp, size):
+        filename = self._filename(kind, key)
+        try:
+            os.mkdir(os.path.dirname(filename))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        with self._locked():
+            try:
+                # Another process may have stored the same entry already
+                replaced = os.path.getsize(filename)
+            except OSError:
+                replaced = 0
+            try:
+                os.rename(tmp, filename)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # Swept as abandoned, the entry just isn't stored
+                return
+            with self._lock:
+                self.stored += 1
+
+            total = self._read_size()
+            if total is None or total + size - replaced > self.max_bytes:
+                self._evict()
+            else:
+                self._write_size(total + size - replaced)
+
+    def _files(self):
+        """ Returns [(mtime, size, filename)] for every entry """
+        files = []
+        for directory in os.listdir(self.path):
+            directory = os.path.join(self.path, directory)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                filename = os.path.join(directory, name)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, filename))
+        return files
+
+    def _unfinished(self):
+        """ Returns the size of the entries being written
+
+        Those abandoned for longer than `tmp_grace` are removed instead.
+        """
+        total = 0
+        abandoned = time.time() - self.tmp_grace
+        for name in os.listdir(self.path):
+            if not name.endswith('.tmp'):
+                continue
+            filename = os.path.join(self.path, name)
+            try:
+                st = os.stat(filename)
+                if st.st_mtime < abandoned:
+                    os.remove(filename)
+                else:
+                    total += st.st_size
+            except OSError:
+                continue
+        return total
+
+    def _sweep(self):
+        """ Count the store, evicting the oldest entries if it's too big """
+        with self._locked():
+            self._evict()
+
+    def _evict(self):
+        """ The body of _sweep, called holding the lock file """
+        files = self._files()
+        stored = sum(x[1] for x in files)
+        # Unfinished entries count, but can't be evicted
+        unfinished = self._unfinished()
+        evicted = 0
+        if stored + unfinished > self.max_bytes:
+            for mtime, size, filename in sorted(files):
+                if stored + unfinished <= self.max_bytes * self.low_water:
+                    break
+                try:
+                    os.remove(filename)
+                except OSError:
+                    continue
+                stored -= size
+                evicted += 1
+        self._write_size(stored)
+        with self._lock:
+            self.evicted += evicted
+
+    def stats(self):
+        """ Returns a dict of hits, misses, hit_rate, stored, evicted and bytes
+
+        hits and misses are totals, `kinds` breaks them down by kind as
+        kind -> dict(hits, misses). stored and evicted are this process's,
+        bytes is the size of the store's committed entries, from every
+        process, or None if it hasn't been counted yet.
+        """
+        size = self._read_size()
+        with self._lock:
+            hits = sum(self.hits.values())
+            misses = sum(self.misses.values())
+            kinds = dict((kind, dict(hits=self.hits.get(kind, 0),
+                                     misses=self.misses.get(kind, 0)))
+                         for kind in set(self.hits) | set(self.misses))
+            return dict(hits=hits,
+                        misses=misses,
+                        hit_rate=float(hits) / (hits + misses) if hits + misses else 0.0,
+                        kinds=kinds,
+                        stored=self.stored,
+                        evicted=self.evicted,
+                        bytes=size)
+
+    def clear(self):
+        """ Remove every entry """
+        with self._locked():
+            for name in os.listdir(self.path):
+                path = os.path.join(self.path, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+            self._write_size(0)
@@ -0,0 +1,214 @@
+""" Pace engine requests to stay inside Github's rate limits
+
+Github reports the primary budget on every response (X-RateLimit-Limit,
+X-RateLimit-Remaining, X-RateLimit-Reset) and answers 403 or 429, often
+with Retry-After, when a secondary limit is tripped. The scheduler reads
+those headers and:
+
+ - spreads the remaining budget evenly until the reset once it runs low
+   (a token bucket refilled at remaining / seconds-until-reset),
+ - halves the number of requests allowed in flight when a secondary
+   limit is hit and lets it grow back one at a time while they succeed,
+ - holds requests back until Retry-After or the reset instead of
+   failing them, unless that's more than `max_wait` away.
+
+One scheduler may be shared by every engine using the same credentials.
+"""
+import time
+import logging
+import threading
+
+from .retry import parse_retry_after
+
+class RateLimitScheduler(object):
+    """ Decide when each request may go out """
+
+    def __init__(self, max_concurrency=None, low_water=100, reserve=0,
+                 max_wait=15 * 60, max_retries=5, increase_after=20,
+                 default_retry_after=60, clock=time.time, sleep=time.sleep):
+        """ RateLimitScheduler
+
+        Params:
+            max_concurrency (int): Most requests in flight at once. None
+                leaves it unlimited until a secondary limit is hit.
+            low_water (int): Start pacing once this few requests remain
+            reserve (int): Requests to never spend, i.e. for other tools
+            max_wait (float): Longest a request is held back, in seconds.
+                Rate limited responses needing longer are returned as is,
+                and acquire() refuses requests that would wait longer.
+            max_retries (int): Times to resend a rate limited request
+            increase_after (int): Successes needed to allow one more
+                request in flight after a secondary limit
+            default_retry_after (float): Seconds to back off from a
+                secondary limit that doesn't say how long
+        """
+        self.max_concurrency = max_concurrency
+        self.low_water = low_water
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.increase_after = increase_after
+        self.default_retry_after = default_retry_after
+        self.clock = clock
+        self.sleep = sleep
+
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.concurrency = max_concurrency
+        self.active = 0
+        self.peak_active = 0
+        self.successes = 0
+        self.blocked_until = 0
+        self.next_slot = 0
+
+        self.requests = 0
+        self.delayed = 0
+        self.total_delay = 0.0
+        self.rate_limited = 0
+        self.secondary_limits = 0
+        self.refused = 0
+
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """ Wait until a request may be sent
+
+        Returns:
+            True once it may be sent. False, straight away, if that would
+            mean waiting longer than `max_wait`, i.e. for a reset that's
+            further off. The request mustn't be sent, or released.
+        """
+        with self._cond:
+            while self.concurrency is not None and self.active >= self.concurrency:
+                self._cond.wait()
+            delay = self._reserve_slot()
+            if delay is None:
+                self.refused += 1
+                return False
+            self.active += 1
+            self.peak_active = max(self.peak_active, self.active)
+            self.requests += 1
+            if delay > 0:
+                self.delayed += 1
+                self.total_delay += delay
+
+        if delay > 0:
+            logging.debug("Rate limit: holding request for %.2fs", delay)
+            self.sleep(delay)
+        return True
+
+    def _reserve_slot(self):
+        """ Returns how long the caller must wait before sending
+
+        None, reserving nothing, if that's longer than `max_wait`.
+        """
+        now = self.clock()
+        start = max(now, self.blocked_until)
+        interval = None
+
+        if self.remaining is not None and self.reset is not None and \
+                self.remaining <= self.low_water:
+            spendable = self.remaining - self.reserve
+            if spendable <= 0:
+                # Nothing left, wait for the reset
+                start = max(start, self.reset)
+            else:
+                interval = max(self.reset - now, 0) / float(spendable)
+                start = max(start, self.next_slot)
+
+        if start - now > self.max_wait:
+            return None
+        if interval is not None:
+            self.next_slot = start + interval
+            self.remaining -= 1
+        return start - now
+
+    def release(self, response, attempt=0):
+        """ Record a response (None if the request failed to send)
+
+        Returns:
+            True if the request was rate limited and should be sent again
+            once acquire() allows it.
+        """
+        with self._cond:
+            self.active -= 1
+            retry = False
+            if response is not None:
+                retry = self._observe(response, attempt)
+            self._cond.notify_all()
+        return retry
+
+    def _observe(self, response, attempt):
+        headers = response.headers
+        now = self.clock()
+        # GraphQL and search have budgets of their own, pace by the core one
+        if 'X-RateLimit-Remaining' in headers and \
+                headers.get('X-RateLimit-Resource', 'core') == 'core':
+            self.remaining = int(headers['X-RateLimit-Remaining'])
+            self.reset = float(headers.get('X-RateLimit-Reset') or now)
+            self.limit = int(headers.get('X-RateLimit-Limit') or 0) or self.limit
+
+        if response.status_code not in (403, 429):
+            self._succeeded()
+            return False
+
+        retry_after = headers.get('Retry-After')
+        if self.remaining == 0 and response.status_code == 403 and not retry_after:
+            # Primary limit spent
+            until = self.reset or now + self.default_retry_after
+        elif retry_after or response.status_code == 429 or \
+                'secondary rate limit' in (response.text or '').lower():
+            self.secondary_limits += 1
+            self._throttle()
+            wait = parse_retry_after(retry_after, now)
+            until = now + (self.default_retry_after if wait is None else wait)
+        else:
+            # An ordinary 403
+            return False
+
+        self.rate_limited += 1
+        if until - now > self.max_wait or attempt >= self.max_retries:
+            return False
+        self.blocked_until = max(self.blocked_until, until)
+        logging.warning("Rate limited by Github, waiting %.0fs", until - now)
+        return True
+
+    def _throttle(self):
+        """ Halve how many requests may be in flight """
+        current = self.concurrency or self.active + 1
+        self.concurrency = max(current // 2, 1)
+        self.successes = 0
+
+    def _succeeded(self):
+        """ Let concurrency creep back up after a secondary limit """
+        if self.concurrency is None or self.concurrency == self.max_concurrency:
+            return
+        self.successes += 1
+        if self.successes < self.increase_after:
+            return
+        self.successes = 0
+        self.concurrency += 1
+        if self.max_concurrency is None and self.concurrency > self.peak_active:
+            self.concurrency = None
+
+    def state(self):
+        """ A snapshot of the budget and throttling """
+        with self._cond:
+            now = self.clock()
+            return dict(
+                limit=self.limit,
+                remaining=self.remaining,
+                reset=self.reset,
+                concurrency=self.concurrency,
+                active=self.active,
+                throttled=self.blocked_until > now or (
+                    self.concurrency is not None and
+                    self.concurrency != self.max_concurrency),
+                blocked_for=max(self.blocked_until - now, 0),
+                requests=self.requests,
+                delayed=self.delayed,
+                total_delay=self.total_delay,
+                rate_limited=self.rate_limited,
+                secondary_limits=self.secondary_limits,
+                refused=self.refused)
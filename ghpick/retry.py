@@ -0,0 +1,225 @@
+""" Retry transient failures of engine requests
+
+A cherry pick makes a hundred or more calls, and a single 502 or reset
+connection among them shouldn't throw away the rest. Requests are only
+resent when doing so can't change the outcome:
+
+ - GETs, and the blob and tree POSTs. Blobs and trees are content
+   addressed, so creating one twice gives back the same object.
+ - Branch updates, but only after reading the ref back shows the first
+   attempt didn't land (see RetryPolicy.reconcile).
+
+Commits are never resent. Github stamps each with the time it was made,
+so a resend after an ambiguous failure could make a second one.
+
+Delays grow exponentially with jitter, and each call gives up once its
+deadline has passed.
+"""
+import sys
+import time
+import random
+import logging
+import threading
+import email.utils
+
+import requests
+
+def parse_retry_after(value, now=None):
+    """ Seconds to wait from a Retry-After header
+
+    Params:
+        value (string): Delay-seconds or an HTTP-date, as RFC 7231 allows
+        now (float): The current epoch time, for dates
+
+    Returns:
+        The seconds, never less than 0, or None if the value is missing
+        or can't be parsed.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    if now is None:
+        now = time.time()
+    return max(email.utils.mktime_tz(parsed) - now, 0)
+
+class RetryPolicy(object):
+    """ Decide whether and when a failed request is sent again """
+
+    retry_statuses = frozenset((500, 502, 503, 504))
+
+    errors = (requests.exceptions.ConnectionError,
+              requests.exceptions.Timeout,
+              requests.exceptions.ChunkedEncodingError)
+
+    def __init__(self, max_attempts=4, base_delay=0.5, max_delay=8,
+                 deadline=60, jitter=0.5, clock=time.time, sleep=time.sleep,
+                 random=random.random):
+        """ RetryPolicy
+
+        Params:
+            max_attempts (int): Most times a call is sent, including the first
+            base_delay (float): Seconds to wait before the first retry. Each
+                further retry waits twice as long as the one before.
+            max_delay (float): Longest wait between attempts, in seconds
+            deadline (float): Seconds after which a call stops being
+                retried. None retries until max_attempts is reached.
+            jitter (float): Fraction of each delay that's randomized, so
+                many failing calls don't all come back at once
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.jitter = jitter
+        self.clock = clock
+        self.sleep = sleep
+        self.random = random
+
+        self.retries = 0
+        self.retried_calls = 0
+        self.recovered = 0
+        self.gave_up = 0
+        self.reconciled = 0
+        self._lock = threading.Lock()
+
+    def delay(self, attempt, retry_after=None):
+        """ Seconds to wait after the `attempt`th attempt (from 0) failed
+
+        A Retry-After header that can't be parsed is ignored.
+        """
+        delay = min(self.base_delay * (2 ** attempt), self.max_delay)
+        delay -= delay * self.jitter * self.random()
+        retry_after = parse_retry_after(retry_after, self.clock())
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _wait(self, attempt, started, listener, retry_after=None):
+        """ Sleep before the next attempt
+
+        Returns:
+            False, without sleeping, if the call is out of attempts or the
+            wait would run past its deadline.
+        """
+        if attempt + 1 >= self.max_attempts:
+            return False
+        delay = self.delay(attempt, retry_after)
+        if self.deadline is not None and \
+                self.clock() + delay - started > self.deadline:
+            return False
+        with self._lock:
+            self.retries += 1
+            if attempt == 0:
+                self.retried_calls += 1
+        if listener:
+            listener('retries')
+        self.sleep(delay)
+        return True
+
+    def _count(self, name, listener):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+        if listener:
+            listener(name)
+
+    def call(self, send, description='', listener=None):
+        """ Send an idempotent request until it stops failing transiently
+
+        Params:
+            send (callable): Sends the request and returns the response
+            description (string): For logging, i.e. "GET <url>"
+            listener (callable): Called with the name of each count the
+                call adds to, i.e. 'retries', as it happens
+
+        Returns:
+            The last response. It may still have a retryable status if the
+            policy gave up, leaving the caller to raise for it.
+        """
+        started = self.clock()
+        attempt = 0
+        while True:
+            try:
+                response = send()
+            except self.errors as e:
+                if not self._wait(attempt, started, listener):
+                    self._count('gave_up', listener)
+                    raise
+                logging.warning("Retrying %s after %s", description, e)
+            else:
+                if response.status_code not in self.retry_statuses:
+                    if attempt:
+                        self._count('recovered', listener)
+                    return response
+                if not self._wait(attempt, started, listener,
+                                  response.headers.get('Retry-After')):
+                    self._count('gave_up', listener)
+                    return response
+                logging.warning("Retrying %s after status %s",
+                                description, response.status_code)
+                response.close()
+            attempt += 1
+
+    def reconcile(self, send, check, transient, description='', listener=None):
+        """ Send a request that mustn't be blindly repeated
+
+        After a transient failure `check` is asked whether the request
+        took effect anyway. Only if it didn't is the request sent again.
+
+        Params:
+            send (callable): Sends the request and returns its result, or
+                raises on failure
+            check (callable): Returns the result the request would have if
+                it took effect, or None if it didn't
+            transient (tuple): Exceptions from `send` worth reconciling, on
+                top of connection errors and timeouts
+            listener (callable): As for `call`
+
+        Returns:
+            What `send` or `check` returned
+        """
+        started = self.clock()
+        attempt = 0
+        while True:
+            try:
+                result = send()
+            except self.errors + tuple(transient) as e:
+                exc_info = sys.exc_info()
+                try:
+                    result = check()
+                except self.errors + tuple(transient):
+                    result = None
+                if result is not None:
+                    logging.warning("%s landed despite %s", description, e)
+                    self._count('reconciled', listener)
+                    return result
+                if not self._wait(attempt, started, listener):
+                    self._count('gave_up', listener)
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                logging.warning("Retrying %s after %s", description, e)
+            else:
+                if attempt:
+                    self._count('recovered', listener)
+                return result
+            attempt += 1
+
+    def stats(self):
+        """ Returns a dict of counts
+
+         - retries: Attempts sent after a failure
+         - retried_calls: Calls that needed at least one retry
+         - recovered: Calls that succeeded after retrying
+         - reconciled: Calls found to have succeeded despite failing
+         - gave_up: Calls that failed after all their attempts
+        """
+        with self._lock:
+            return dict(retries=self.retries,
+                        retried_calls=self.retried_calls,
+                        recovered=self.recovered,
+                        reconciled=self.reconciled,
+                        gave_up=self.gave_up)
@@ -0,0 +1,517 @@
+""" A long running daemon that picks commits sent to it over HTTP
+
+Picking from a fresh process each time loses every connection, cached
+ref, known blob and tree when the process exits. PickService keeps a
+pool of worker processes instead, each holding one CherryPick per
+repository (and so its engine, session and caches) for its whole life,
+and takes jobs over a small JSON API on a local port or a Unix socket:
+
+    POST /jobs           {"org": ..., "repo": ..., "sha": ...,
+                          "branches": [...], "message": ...}
+                         Queues a job, answers 202 with the job
+    GET  /jobs           Every job the service remembers
+    GET  /jobs/<id>      One job. With ?wait=<seconds> the answer waits
+                         until the job has finished or the time is up.
+
+Jobs on the same target branch run one after another, in the order they
+arrived. Jobs on different branches run at once, up to `processes` of
+them. A job with several branches picks onto all of them with
+CherryPick.pick_onto and waits until every one of its branches is free.
+
+A job whose process dies (killed for running out of memory, say), or
+that runs longer than `job_timeout`, is marked failed and its branches
+are freed for the jobs behind it.
+
+Usage:
+    service = PickService(username=username, password=password,
+                          processes=4, object_store='/var/cache/ghpick')
+    service.serve_forever(socket_path='/var/run/ghpick.sock')
+
+Or from the shell, with the password in $GHPICK_PASSWORD:
+    python -m ghpick.service --username ima_user --socket /var/run/ghpick.sock
+"""
+import os
+import json
+import time
+import errno
+import signal
+import logging
+import argparse
+import itertools
+import threading
+import collections
+import multiprocessing
+import multiprocessing.queues
+import urlparse
+
+import BaseHTTPServer
+import SocketServer
+
+from .cherry import CherryPick
+from .engine import GithubMergeConflict, make_session
+from .metrics import InMemorySink
+from .objectstore import ObjectStore
+
+# The worker process's own state, see _init_worker
+_worker = dict()
+
+def _init_worker(pick_options, object_store, started, max_known_blobs):
+    """ Set up a pool process to keep its picks between jobs
+
+    `started` is a queue to report each job's (id, pid, time) on when
+    the process starts it. A pick's known blobs are forgotten, between
+    jobs, once there are more than `max_known_blobs` of them.
+    """
+    _worker['started'] = started
+    _worker['max_known_blobs'] = max_known_blobs
+    options = dict(pick_options)
+    options.setdefault('session', make_session())
+    if object_store is not None:
+        options['object_store'] = ObjectStore(object_store)
+    _worker['options'] = options
+    # (org, repo) -> CherryPick
+    _worker['picks'] = dict()
+
+def _run_job(spec):
+    """ Pick one job in a pool process
+
+    Never raises, failures are reported in the returned dict: results
+    (branch -> dict(sha) or dict(error, conflict)), error for a job that
+    failed as a whole, and timings.
+    """
+    started = time.time()
+    outcome = dict(results=dict(), error=None, worker=os.getpid())
+    metrics = InMemorySink()
+    try:
+        _worker['started'].put((spec['id'], os.getpid(), started))
+        key = (spec['org'], spec['repo'])
+        cherry = _worker['picks'].get(key)
+        if cherry is None:
+            cherry = _worker['picks'][key] = CherryPick(
+                org=spec['org'], repo=spec['repo'], **_worker['options'])
+        # Another process may have moved the branches since we last looked
+        for branch in spec['branches']:
+            cherry.engine.invalidate_ref(branch)
+        # Every tree listing adds to them, so they'd grow for the life of
+        # the process. Blobs in the object store are still known after.
+        if len(cherry.known_blobs) > _worker['max_known_blobs']:
+            cherry.known_blobs.clear()
+        cherry.engine.metrics = metrics
+
+        if len(spec['branches']) == 1:
+            picked = dict()
+            branch = spec['branches'][0]
+            try:
+                cherry.patch(spec['sha'], branch)
+                picked[branch] = cherry.commit(spec['message'])
+            except Exception as e:
+                picked[branch] = e
+            finally:
+                cherry._delete_workspace()
+        else:
+            picked = cherry.pick_onto(spec['sha'], spec['branches'], spec['message'])
+        for branch, result in picked.items():
+            if isinstance(result, Exception):
+                outcome['results'][branch] = dict(
+                    error=str(result),
+                    conflict=isinstance(result, GithubMergeConflict))
+            else:
+                outcome['results'][branch] = dict(sha=result['sha'])
+    except Exception as e:
+        logging.exception("Job %s failed", spec['id'])
+        outcome['error'] = '{}: {}'.format(e.__class__.__name__, e)
+
+    requests = metrics.snapshot().values()
+    outcome['timings'] = dict(
+        started=started,
+        run=time.time() - started,
+        requests=sum(x['count'] for x in requests),
+        request_seconds=sum(x['seconds'] for x in requests))
+    return outcome
+
+class PickService(object):
+    """ Queues pick jobs and runs them on a pool of warm processes
+
+    A job is a dict with the keys:
+     - id
+     - org, repo, sha, branches, message: What was asked for
+     - status: queued, running, done (every branch picked) or failed
+     - results: branch -> dict(sha) of the new commit, or
+       dict(error, conflict) for a branch that wasn't picked
+     - error: Why the whole job failed, if it did
+     - worker: The pid of the process that ran it
+     - timings: submitted, started and finished (epoch seconds), queued
+       and run (seconds), and requests and request_seconds, the requests
+       the job sent to Github and the time spent waiting on them
+    """
+
+    # Seconds between checks that running jobs' processes are alive
+    watch_interval = 0.5
+    # Known blob SHAs each process keeps per repository between jobs
+    max_known_blobs = 100 * 1000
+
+    def __init__(self, username, password, base_url=None, processes=4,
+                 object_store=None, keep_jobs=1000, job_timeout=None,
+                 **pick_options):
+        """ PickService
+
+        Params:
+            username (string): The username
+            password (string): The password
+            base_url (string): The full URL for Enterprise.
+            processes (int): Most jobs running at once
+            object_store (string): A directory for an ObjectStore shared
+                by every process. Nothing is stored if not given.
+            keep_jobs (int): How many finished jobs to remember
+            job_timeout (float): Seconds a job may run before its process
+                is killed and the job failed. No limit if not given.
+            pick_options: Passed through to each CherryPick, i.e. workers,
+                applier, fetch_strategy and the engine options. A metrics
+                sink is replaced, every job is measured on its own.
+        """
+        pick_options = dict(pick_options, username=username,
+                            password=password, base_url=base_url)
+        # Before there are any threads to fork
+        # Written straight to the pipe, there's no feeder thread to lose
+        # the report if the process is killed right after it
+        self._started = multiprocessing.queues.SimpleQueue()
+        self.pool = multiprocessing.Pool(processes, _init_worker,
+                                         (pick_options, object_store,
+                                          self._started, self.max_known_blobs))
+        self.processes = processes
+        self.keep_jobs = keep_jobs
+        self.job_timeout = job_timeout
+        # id -> (job, AsyncResult) for the jobs handed to the pool
+        self._running = dict()
+        # id -> job, oldest first
+        self.jobs = collections.OrderedDict()
+        self._queue = []
+        # (org, repo, branch) for every running job's branches
+        self._busy = set()
+        self._ids = itertools.count(1)
+        self._changed = threading.Condition(threading.Lock())
+        self.server = None
+        self._thread = None
+        self._closing = threading.Event()
+        self._watchdog = threading.Thread(target=self._watch)
+        self._watchdog.daemon = True
+        self._watchdog.start()
+
+    @staticmethod
+    def _branch_keys(job):
+        return set((job['org'], job['repo'], branch) for branch in job['branches'])
+
+    def submit(self, org, repo, sha, branches, message=None):
+        """ Queue a pick of `sha` onto each of `branches`
+
+        Returns:
+            A copy of the job
+        """
+        if isinstance(branches, basestring):
+            branches = [branches]
+        if not branches:
+            raise ValueError("A job needs at least one branch")
+        with self._changed:
+            job = dict(id=str(next(self._ids)),
+                       org=org,
+                       repo=repo,
+                       sha=sha,
+                       branches=list(branches),
+                       message=message,
+                       status='queued',
+                       results=dict(),
+                       error=None,
+                       worker=None,
+                       timings=dict(submitted=time.time()))
+            self.jobs[job['id']] = job
+            self._queue.append(job)
+            self._dispatch()
+            return self._copy(job)
+
+    def _dispatch(self):
+        """ Start every queued job whose branches are free
+
+        A job waits for earlier queued jobs sharing a branch with it, so
+        each branch's jobs run in the order they arrived. Called holding
+        the lock.
+        """
+        waiting = set()
+        for job in list(self._queue):
+            keys = self._branch_keys(job)
+            if keys & (self._busy | waiting):
+                waiting |= keys
+                continue
+            self._queue.remove(job)
+            self._busy |= keys
+            job['status'] = 'running'
+            # Until the worker says when it really started
+            job['timings']['started'] = time.time()
+            spec = dict((k, job[k]) for k in
+                        ('id', 'org', 'repo', 'sha', 'branches', 'message'))
+            result = self.pool.apply_async(
+                _run_job, (spec,),
+                callback=lambda outcome, job=job: self._finished(job, outcome))
+            self._running[job['id']] = (job, result)
+
+    def _watch(self):
+        """ Fail the jobs whose process died or ran out of time
+
+        The pool replaces a process that dies, but the job it was running
+        never comes back, and would hold its branches for good.
+        """
+        while not self._closing.wait(self.watch_interval):
+            # Only read here, so it can't empty between the two calls
+            while not self._started.empty():
+                job_id, pid, started = self._started.get()
+                with self._changed:
+                    entry = self._running.get(job_id)
+                    if entry is not None:
+                        entry[0]['worker'] = pid
+                        entry[0]['timings']['started'] = started
+
+            with self._changed:
+                running = [ job for job, result in self._running.values()
+                            if job['worker'] is not None and not result.ready() ]
+            for job in running:
+                if not self._alive(job['worker']):
+                    self._lost(job, "The process running the job died")
+                elif self.job_timeout is not None and \
+                        time.time() - job['timings']['started'] > self.job_timeout:
+                    self._kill(job['worker'])
+                    self._lost(job, "The job ran for longer than {} seconds".format(
+                        self.job_timeout))
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno != errno.ESRCH
+        return True
+
+    @staticmethod
+    def _kill(pid):
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def _lost(self, job, error):
+        """ Fail a job that will never report back """
+        logging.error("Job %s failed: %s", job['id'], error)
+        self._finished(job, dict(error=error, timings=dict(
+            run=time.time() - job['timings']['started'])))
+
+    def _finished(self, job, outcome):
+        """ Record a job's outcome and start whatever it held up """
+        with self._changed:
+            if self._running.pop(job['id'], None) is None:
+                # Already failed by the watchdog
+                return
+            timings = job['timings']
+            timings.update(outcome.pop('timings'))
+            timings['finished'] = time.time()
+            timings['queued'] = timings['started'] - timings['submitted']
+            job.update(outcome)
+            if job['error'] is None and \
+                    all('sha' in x for x in job['results'].values()):
+                job['status'] = 'done'
+            else:
+                job['status'] = 'failed'
+            self._busy -= self._branch_keys(job)
+            self._forget_old_jobs()
+            self._dispatch()
+            self._changed.notify_all()
+
+    def _forget_old_jobs(self):
+        finished = [ x for x in self.jobs.values()
+                     if x['status'] in ('done', 'failed') ]
+        for job in finished[:max(len(finished) - self.keep_jobs, 0)]:
+            del self.jobs[job['id']]
+
+    @staticmethod
+    def _copy(job):
+        return json.loads(json.dumps(job))
+
+    def get(self, job_id, wait=None):
+        """ Returns a copy of the job, or None if there's no such job
+
+        Params:
+            wait (float): Seconds to wait for the job to finish
+        """
+        deadline = None if wait is None else time.time() + wait
+        with self._changed:
+            while True:
+                job = self.jobs.get(job_id)
+                if job is None:
+                    return None
+                if job['status'] in ('done', 'failed') or deadline is None:
+                    return self._copy(job)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return self._copy(job)
+                self._changed.wait(remaining)
+
+    def list(self):
+        """ Returns a copy of every job, oldest first """
+        with self._changed:
+            return [ self._copy(x) for x in self.jobs.values() ]
+
+    def listen(self, port=0, host='127.0.0.1', socket_path=None):
+        """ Serve the API from a background thread
+
+        Params:
+            port (int): The port to listen on, any free one if 0
+            host (string): The address to listen on
+            socket_path (string): Listen on this Unix socket instead
+
+        Returns:
+            The port or the socket path being listened on
+        """
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self.server = _UnixHTTPServer(socket_path, _ServiceHandler)
+            address = socket_path
+        else:
+            self.server = _HTTPServer((host, port), _ServiceHandler)
+            address = self.server.server_address[1]
+        self.server.service = self
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return address
+
+    def serve_forever(self, **listen_options):
+        """ listen() and block until interrupted, then close() """
+        self.listen(**listen_options)
+        try:
+            while self._thread.is_alive():
+                # A join with a timeout, so signals get through
+                self._thread.join(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self, wait=True):
+        """ Stop serving, optionally letting the running jobs finish
+
+        Jobs still queued are dropped.
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            if isinstance(self.server, _UnixHTTPServer):
+                os.remove(self.server.server_address)
+            self.server = None
+        with self._changed:
+            del self._queue[:]
+            while wait and self._running:
+                self._changed.wait(self.watch_interval)
+        self._closing.set()
+        self._watchdog.join()
+        # Not close(), the pool would wait for any job a dead process lost
+        self.pool.terminate()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class _UnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class _ServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ The JSON API, see the module's docstring """
+    required = ('org', 'repo', 'sha', 'branches')
+
+    def log_message(self, format, *args):
+        # Unix socket clients have no address to log
+        logging.debug("%s", format % args)
+
+    def _respond(self, status, payload):
+        body = json.dumps(payload)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        url = urlparse.urlparse(self.path)
+        parts = [ x for x in url.path.split('/') if x ]
+        if parts == ['jobs']:
+            return self._respond(200, service.list())
+        if len(parts) == 2 and parts[0] == 'jobs':
+            query = dict(urlparse.parse_qsl(url.query))
+            try:
+                wait = float(query['wait']) if 'wait' in query else None
+            except ValueError:
+                return self._respond(400, dict(message='wait must be a number'))
+            job = service.get(parts[1], wait=wait)
+            if job is not None:
+                return self._respond(200, job)
+        self._respond(404, dict(message='Not Found'))
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self._respond(404, dict(message='Not Found'))
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length))
+        except ValueError:
+            return self._respond(400, dict(message='The body must be JSON'))
+        if not isinstance(body, dict):
+            return self._respond(400, dict(message='The body must be a JSON object'))
+        missing = [ x for x in self.required if not body.get(x) ]
+        if missing:
+            return self._respond(400, dict(
+                message='Missing {}'.format(', '.join(missing))))
+        job = self.server.service.submit(body['org'], body['repo'], body['sha'],
+                                         body['branches'], body.get('message'))
+        self._respond(202, job)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--username', required=True)
+    parser.add_argument('--base-url')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--socket', help='Listen on a Unix socket instead')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--job-timeout', type=float,
+                        help='Seconds before a running job is killed')
+    parser.add_argument('--object-store',
+                        help='A directory to keep fetched objects in')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Files each pick downloads or uploads at once')
+    parser.add_argument('--applier', default='git')
+    parser.add_argument('--fetch-strategy', default='contents')
+    parser.add_argument('--tree-strategy', default='recursive')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    service = PickService(username=args.username,
+                          password=os.environ.get('GHPICK_PASSWORD'),
+                          base_url=args.base_url,
+                          processes=args.processes,
+                          object_store=args.object_store,
+                          job_timeout=args.job_timeout,
+                          workers=args.workers,
+                          applier=args.applier,
+                          fetch_strategy=args.fetch_strategy,
+                          tree_strategy=args.tree_strategy)
+    if args.socket:
+        service.serve_forever(socket_path=args.socket)
+    else:
+        service.serve_forever(port=args.port, host=args.host)
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,7 @@ setup(
     name = "okta-ghpick",
     version = "1.0.3",
     packages = ["ghpick"],
-    install_requires = ['requests>=2.7.0', 'sh>=1.11'],
+    install_requires = ['requests>=2.7.0', 'sh>=1.11', 'futures>=3.0.0'],
     tests_require = ['vcrpy>=1.6.0','mock>=1.0.1','contextlib2>=0.4.0'],
 
     # metadata for upload to PyPI
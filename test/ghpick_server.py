@@ -0,0 +1,267 @@
+import re
+import json
+import hashlib
+import urlparse
+import threading
+
+from base64 import b64encode, b64decode
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one go, not a packet per header line
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else None
+        self.server.requests.append(dict(
+            method=self.command,
+            path=self.path,
+            headers=dict(self.headers),
+            body=body))
+
+        status, headers, payload = self.server.handler(
+            self.command, self.path, self.headers, body)
+        if not isinstance(payload, basestring):
+            payload = json.dumps(payload)
+            headers.setdefault('Content-Type', 'application/json')
+
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PATCH = _respond
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class LocalGithub(object):
+    """ A stand-in Github API served from a local thread
+
+    `handler` is called with (method, path, headers, body) and returns
+    (status, headers, payload). Dict and list payloads are sent as JSON.
+    """
+    def __init__(self, handler):
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.handler = handler
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       args=(0.01,))
+        self.thread.daemon = True
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+class FakeGithub(object):
+    """ Just enough of the Github API, kept in dicts, for whole picks
+
+    Trees are flat: every entry's path is relative to the root.
+
+    Attributes:
+        blobs: sha -> contents
+        trees: sha -> list of entries
+        commits: sha -> dict(tree, parents, message, author)
+        refs: 'heads/name' or 'tags/name' -> commit sha
+        patches: 'base...head' -> patch text
+        graphql_text_limit: Blobs larger than this come back from GraphQL
+            truncated, like Github does for big files
+        graphql_max_fields: Queries with more objects than this fail
+    """
+    prefix = '/repos/whiskeyriver/ghpick_test'
+    object_re = re.compile(r'(\w+): object\(expression: ("(?:[^"\\]|\\.)*")\)')
+    graphql_text_limit = None
+    graphql_max_fields = None
+
+    def __init__(self):
+        self.blobs = dict()
+        self.trees = dict()
+        self.commits = dict()
+        self.refs = dict()
+        self.patches = dict()
+        self.lock = threading.Lock()
+
+    def add_blob(self, content):
+        sha = hashlib.sha1("blob {}\0".format(len(content)) + content).hexdigest()
+        self.blobs[sha] = content
+        return sha
+
+    def add_tree(self, entries):
+        sha = hashlib.sha1(json.dumps(sorted(entries))).hexdigest()
+        self.trees[sha] = [ dict(path=path, mode=mode, type='blob', sha=blob)
+                            for path, mode, blob in entries ]
+        return sha
+
+    def add_commit(self, files, parents=(), message='commit'):
+        """ files is path -> contents """
+        tree = self.add_tree([ (path, '100644', self.add_blob(content))
+                               for path, content in files.items() ])
+        sha = hashlib.sha1(tree + ''.join(parents) + message).hexdigest()
+        self.commits[sha] = dict(tree=tree, parents=list(parents),
+                                 message=message, author=dict(name='Author'))
+        return sha
+
+    def commit_json(self, sha):
+        commit = self.commits[sha]
+        return dict(sha=sha,
+                    tree=dict(sha=commit['tree']),
+                    parents=[ dict(sha=p) for p in commit['parents'] ],
+                    message=commit['message'],
+                    author=commit['author'],
+                    committer=dict(date='2015-07-06T19:44:13Z'))
+
+    def repo_commit_json(self, sha):
+        """ A commit as the commits and compare APIs give it """
+        commit = self.commit_json(sha)
+        return dict(sha=sha,
+                    parents=commit['parents'],
+                    commit=dict((k, commit[k]) for k in
+                                ('tree', 'message', 'author', 'committer')),
+                    files=self.files_json(commit['parents'][0]['sha'], sha)
+                    if commit['parents'] else [])
+
+    def files_json(self, base, head):
+        """ The files changed between two commits, as Github lists them """
+        old = dict((x['path'], x['sha']) for x in self.tree_json(base)['tree'])
+        new = dict((x['path'], x['sha']) for x in self.tree_json(head)['tree'])
+        files = []
+        for path in sorted(set(old) | set(new)):
+            if path not in new:
+                files.append(dict(filename=path, status='removed', sha=old[path]))
+            elif path not in old:
+                files.append(dict(filename=path, status='added', sha=new[path]))
+            elif old[path] != new[path]:
+                files.append(dict(filename=path, status='modified', sha=new[path]))
+        return files
+
+    def comparison_json(self, base, head):
+        commits = []
+        sha = head
+        while sha != base:
+            commits.append(self.repo_commit_json(sha))
+            sha = self.commits[sha]['parents'][0]
+        return dict(base_commit=self.repo_commit_json(base),
+                    total_commits=len(commits),
+                    commits=commits[::-1],
+                    files=[])
+
+    def tree_json(self, sha):
+        if sha in self.commits:
+            sha = self.commits[sha]['tree']
+        return dict(sha=sha, tree=self.trees[sha], truncated=False)
+
+    def __call__(self, method, path, headers, body):
+        with self.lock:
+            try:
+                return self.route(method, path, headers,
+                                  json.loads(body) if body else None)
+            except KeyError:
+                return 404, {}, dict(message='Not Found')
+
+    def route(self, method, path, headers, body):
+        url = urlparse.urlparse(path)
+        query = dict(urlparse.parse_qsl(url.query))
+        if url.path == '/graphql':
+            return self.graphql(body)
+        parts = url.path[len(self.prefix) + 1:].split('/')
+
+        if parts[:2] == ['git', 'refs']:
+            name = '/'.join(parts[2:])
+            if method == 'PATCH':
+                self.refs[name] = body['sha']
+            return 200, {}, dict(ref='refs/' + name,
+                                 object=dict(sha=self.refs[name], type='commit'))
+        if parts[:2] == ['git', 'blobs']:
+            if method == 'POST':
+                sha = self.add_blob(b64decode(body['content']))
+                return 201, {}, dict(sha=sha)
+            content = self.blobs[parts[2]]
+            if headers.get('Accept', '').endswith('.raw'):
+                return 200, {'Content-Type': 'application/octet-stream'}, content
+            return 200, {}, dict(sha=parts[2], encoding='base64',
+                                 content=b64encode(content), size=len(content))
+        if parts[:2] == ['git', 'trees']:
+            if method == 'POST':
+                base = dict((x['path'], x) for x in
+                            self.trees[body['base_tree']]) if 'base_tree' in body else {}
+                for entry in body['tree']:
+                    if entry['sha'] is None:
+                        base.pop(entry['path'], None)
+                    else:
+                        base[entry['path']] = entry
+                sha = self.add_tree([ (x['path'], x['mode'], x['sha'])
+                                      for x in base.values() ])
+                return 201, {}, self.tree_json(sha)
+            return 200, {}, self.tree_json(parts[2])
+        if parts[:2] == ['git', 'commits']:
+            if method == 'POST':
+                sha = hashlib.sha1(json.dumps(body, sort_keys=True)).hexdigest()
+                self.commits[sha] = dict(tree=body['tree'], parents=body['parents'],
+                                         message=body['message'], author=body['author'])
+                return 201, {}, self.commit_json(sha)
+            return 200, {}, self.commit_json(parts[2])
+        if parts[0] == 'commits':
+            return 200, {}, self.repo_commit_json(parts[1])
+        if parts[0] == 'contents':
+            file_path = '/'.join(parts[1:])
+            for entry in self.tree_json(query['ref'])['tree']:
+                if entry['path'] == file_path:
+                    if headers.get('Accept', '').endswith('.raw'):
+                        return 200, {'Content-Type': 'application/octet-stream'}, \
+                            self.blobs[entry['sha']]
+                    return 200, {}, dict(path=file_path, sha=entry['sha'],
+                                         encoding='base64',
+                                         content=b64encode(self.blobs[entry['sha']]))
+            raise KeyError(file_path)
+        if parts[0] == 'compare':
+            if 'vnd.github.3.' not in headers.get('Accept', ''):
+                return 200, {}, self.comparison_json(*parts[1].split('...'))
+            return 200, {'Content-Type': 'text/plain'}, self.patches[parts[1]]
+        raise KeyError(path)
+
+    def graphql(self, body):
+        """ Answers the aliased object(expression:) queries of get_files """
+        fields = self.object_re.findall(body['query'])
+        if self.graphql_max_fields and len(fields) > self.graphql_max_fields:
+            return 200, {}, dict(data=None, errors=[dict(
+                type='MAX_NODE_LIMIT_EXCEEDED', message='Too many objects')])
+        repository = dict()
+        for alias, expression in fields:
+            ref, path = json.loads(expression).split(':', 1)
+            repository[alias] = None
+            for entry in self.tree_json(ref)['tree']:
+                if entry['path'] == path:
+                    content = self.blobs[entry['sha']]
+                    binary = '\0' in content
+                    truncated = self.graphql_text_limit is not None and \
+                        len(content) > self.graphql_text_limit
+                    text = None
+                    if not binary:
+                        text = content.decode('utf-8', 'replace')
+                        if truncated:
+                            text = text[:self.graphql_text_limit]
+                    repository[alias] = dict(oid=entry['sha'], isBinary=binary,
+                                             isTruncated=truncated, text=text)
+        return 200, {}, dict(data=dict(repository=repository))
@@ -0,0 +1,123 @@
+import unittest
+
+from ghpick.applier import apply_patch, parse_patch, split_lines
+from ghpick.applier import PatchUnsupported
+from ghpick.engine import GithubMergeConflict
+
+PATCH = """From d0448fd31e341842e7fa2ca76acd5dfed3366c73 Mon Sep 17 00:00:00 2001
+From: Ryan Parr <parrr@usxxparrrm1.corp.emc.com>
+Date: Mon, 6 Jul 2015 18:39:29 -0700
+Subject: [PATCH] Big commit.
+
+---
+ deleted.txt  | 1 -
+ modified.txt | 4 +++-
+ new.txt      | 2 ++
+ 3 files changed, 5 insertions(+), 2 deletions(-)
+
+diff --git a/deleted.txt b/deleted.txt
+deleted file mode 100644
+index 2d030d7..0000000
+--- a/deleted.txt
++++ /dev/null
+@@ -1 +0,0 @@
+-delete me
+diff --git a/modified.txt b/modified.txt
+index 18df4c8..2e09960 100644
+--- a/modified.txt
++++ b/modified.txt
+@@ -1,3 +1,3 @@
+ one
+-two
++TWO
+ three
+@@ -8,2 +8,3 @@
+ eight
+-nine
+\\ No newline at end of file
++nine
++ten
+diff --git a/new.txt b/new.txt
+new file mode 100755
+index 0000000..3b18e51
+--- /dev/null
++++ b/new.txt
+@@ -0,0 +1,2 @@
++hello
++world
+diff --git a/script.sh b/script.sh
+old mode 100644
+new mode 100755
+-- 
+2.3.2
+"""
+
+MODIFIED = "one\ntwo\nthree\nfour\nfive\nsix\nseven\neight\nnine"
+
+class TestApplier(unittest.TestCase):
+    def files(self):
+        return {
+            'deleted.txt': 'delete me\n',
+            'modified.txt': MODIFIED,
+            'script.sh': '#!/bin/sh\n',
+        }
+
+    def test_split_lines(self):
+        self.assertEqual(split_lines('a\r\nb\x0bc\nd'), ['a\r\n', 'b\x0bc\n', 'd'])
+        self.assertEqual(split_lines(''), [])
+
+    def test_parse_patch(self):
+        patches = parse_patch(split_lines(PATCH))
+        self.assertEqual([ p.new_path for p in patches ],
+                         ['deleted.txt', 'modified.txt', 'new.txt', 'script.sh'])
+        self.assertTrue(patches[0].is_deleted)
+        self.assertEqual(len(patches[1].hunks), 2)
+        self.assertEqual(patches[1].hunks[1].old_lines, ['eight\n', 'nine'])
+        self.assertTrue(patches[2].is_new)
+        self.assertEqual(patches[2].new_mode, '100755')
+        self.assertEqual(patches[3].old_mode, '100644')
+        self.assertEqual(patches[3].new_mode, '100755')
+        self.assertEqual(patches[3].hunks, [])
+
+    def test_apply_patch(self):
+        files = self.files()
+        result = apply_patch(PATCH, files)
+        self.assertIsNone(result['deleted.txt'])
+        self.assertEqual(result['modified.txt'],
+            "one\nTWO\nthree\nfour\nfive\nsix\nseven\neight\nnine\nten\n")
+        self.assertEqual(result['new.txt'], 'hello\nworld\n')
+        self.assertEqual(result['script.sh'], '#!/bin/sh\n')
+        # The input is left alone
+        self.assertEqual(files, self.files())
+
+    def test_hunk_offset(self):
+        files = self.files()
+        files['modified.txt'] = 'zero\nzero\n' + MODIFIED
+        result = apply_patch(PATCH, files)
+        self.assertEqual(result['modified.txt'],
+            "zero\nzero\none\nTWO\nthree\nfour\nfive\nsix\nseven\neight\nnine\nten\n")
+
+    def test_conflict(self):
+        files = self.files()
+        files['modified.txt'] = MODIFIED.replace('two', 'deux')
+        del files['deleted.txt']
+        with self.assertRaises(GithubMergeConflict) as ctx:
+            apply_patch(PATCH, files)
+        message = str(ctx.exception)
+        self.assertIn('deleted.txt: does not exist', message)
+        self.assertIn('patch failed: modified.txt:1', message)
+        self.assertIn('Rejected hunk #1: @@ -1,3 +1,3 @@', message)
+        self.assertEqual(len(ctx.exception.rejects), 1)
+
+    def test_new_file_exists(self):
+        files = self.files()
+        files['new.txt'] = 'already here\n'
+        with self.assertRaises(GithubMergeConflict):
+            apply_patch(PATCH, files)
+
+    def test_binary_unsupported(self):
+        patch = ("diff --git a/logo.png b/logo.png\n"
+                 "index 2d030d7..18df4c8 100644\n"
+                 "Binary files a/logo.png and b/logo.png differ\n")
+        with self.assertRaises(PatchUnsupported):
+            apply_patch(patch, {'logo.png': '\x89PNG'})
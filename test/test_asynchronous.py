@@ -0,0 +1,62 @@
+import unittest
+
+from ghpick.asynchronous import AsyncGithubRequestsEngine, AsyncCherryPick
+from ghpick.engine import GithubNotFound, GithubMergeConflict
+from ghpick_server import LocalGithub, FakeGithub
+
+PATCH = """diff --git a/README.md b/README.md
+index 1111111..2222222 100644
+--- a/README.md
++++ b/README.md
+@@ -1,2 +1,2 @@
+ title
+-one
++two
+"""
+
+class TestAsync(unittest.TestCase):
+    def setUp(self):
+        self.github = FakeGithub()
+        root = self.github.add_commit({'README.md': 'title\none\n'})
+        fix = self.github.add_commit({'README.md': 'title\ntwo\n'}, [root], 'fix')
+        self.fix = fix
+        self.github.patches['{}...{}'.format(root, fix)] = PATCH
+        for i in range(8):
+            self.github.refs['heads/rel_{}'.format(i)] = root
+        diverged = self.github.add_commit({'README.md': 'title\nnope\n'})
+        self.github.refs['heads/diverged'] = diverged
+
+    def options(self, server):
+        return dict(username='test', password='test',
+                    org='whiskeyriver', repo='ghpick_test',
+                    base_url=server.base_url)
+
+    def test_engine(self):
+        with LocalGithub(self.github) as server:
+            with AsyncGithubRequestsEngine(max_concurrency=4,
+                                           **self.options(server)) as engine:
+                futures = [ engine.get_branch('rel_{}'.format(i)) for i in range(8) ]
+                missing = engine.get_branch('missing')
+                shas = set(f.result()['object']['sha'] for f in futures)
+                self.assertEqual(len(shas), 1)
+                self.assertIsInstance(missing.exception(), GithubNotFound)
+                self.assertEqual(engine.get_commit(self.fix).result()['message'], 'fix')
+
+    def test_cherry_pick(self):
+        with LocalGithub(self.github) as server:
+            with AsyncCherryPick(max_concurrency=4, applier='python',
+                                 tree_strategy='flat',
+                                 **self.options(server)) as picker:
+                branches = [ 'rel_{}'.format(i) for i in range(8) ]
+                futures = dict((b, picker.pick(self.fix, b)) for b in branches)
+                conflict = picker.pick(self.fix, 'diverged')
+
+                for branch, future in futures.items():
+                    commit = future.result()
+                    self.assertEqual(self.github.refs['heads/' + branch], commit['sha'])
+                    tree = self.github.trees[commit['tree']['sha']]
+                    self.assertEqual(self.github.blobs[tree[0]['sha']], 'title\ntwo\n')
+                self.assertIsInstance(conflict.exception(), GithubMergeConflict)
+                # Every pick's requests went through the one rate limiter
+                self.assertEqual(picker.rate_limiter.state()['requests'],
+                                 len(server.requests))
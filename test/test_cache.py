@@ -0,0 +1,124 @@
+import time
+import shutil
+import tempfile
+import unittest
+
+from ghpick.cache import MemoryCache, DiskCache
+from ghpick.engine import GithubRequestsEngine
+from ghpick_server import LocalGithub
+
+class TestConditionalGets(unittest.TestCase):
+    etag = '"8c8168ca4b58634496bff58016c7a131"'
+    sha = '0dc54282f1a68c5bf9c455df85d7d627decf0fc2'
+
+    def handler(self, method, path, headers, body):
+        if headers.get('if-none-match') == self.etag:
+            return 304, {'ETag': self.etag}, ''
+        return 200, {'ETag': self.etag}, dict(object=dict(sha=self.sha))
+
+    def make_engine(self, server, cache):
+        return GithubRequestsEngine(
+            username='test',
+            password='test',
+            org='whiskeyriver',
+            repo='ghpick_test',
+            base_url=server.base_url,
+            http_cache=cache)
+
+    def check_cache(self, make_cache):
+        with LocalGithub(self.handler) as server:
+            engine = self.make_engine(server, make_cache())
+            for _ in range(3):
+                self.assertEqual(engine.get_branch('master')['object']['sha'], self.sha)
+
+            self.assertNotIn('if-none-match', server.requests[0]['headers'])
+            self.assertEqual(server.requests[2]['headers']['if-none-match'], self.etag)
+            stats = engine.http_cache.stats()
+            self.assertEqual(stats['misses'], 1)
+            self.assertEqual(stats['hits'], 2)
+            self.assertEqual(stats['not_modified'], 2)
+            self.assertEqual(stats['entries'], 1)
+            return server
+
+    def test_memory_cache(self):
+        self.check_cache(MemoryCache)
+
+    def test_disk_cache(self):
+        path = tempfile.mkdtemp()
+        try:
+            self.check_cache(lambda: DiskCache(path))
+            # A new process would find it too
+            cache = DiskCache(path)
+            self.assertEqual(cache.stats()['entries'], 1)
+        finally:
+            shutil.rmtree(path)
+
+    def commits_handler(self, method, path, headers, body):
+        if '/git/commits/' in path:
+            return 200, {}, dict(sha=path.split('/')[-1],
+                                 committer=dict(date='2015-07-06T19:44:13Z'))
+        page = 2 if 'page=2' in path else 1
+        etag = '"page{}"'.format(page)
+        if headers.get('if-none-match') == etag:
+            # Github may leave the Link header off a 304
+            return 304, {'ETag': etag}, ''
+        response_headers = {'ETag': etag}
+        if page == 1:
+            response_headers['Link'] = '<{}/repos/whiskeyriver/ghpick_test/commits' \
+                '?page=2>; rel="next"'.format(self.base_url)
+        return 200, response_headers, [ dict(sha='{:040x}'.format(page * 10 + n))
+                                        for n in range(2) ]
+
+    def test_paged_commits(self):
+        start = '0' * 40
+        with LocalGithub(self.commits_handler) as server:
+            self.base_url = server.base_url
+            engine = self.make_engine(server, MemoryCache())
+            first = [ c['sha'] for c in engine.commits(start, self.sha) ]
+            again = [ c['sha'] for c in engine.commits(start, self.sha) ]
+
+        self.assertEqual(len(first), 4)
+        self.assertEqual(again, first)
+        pages = [ r for r in server.requests if '/commits?' in r['path'] ]
+        self.assertEqual(len(pages), 4)
+        self.assertEqual([ r['headers'].get('if-none-match') for r in pages[2:] ],
+                         ['"page1"', '"page2"'])
+        self.assertEqual(engine.http_cache.stats()['not_modified'], 2)
+
+class TestLRU(unittest.TestCase):
+    def entry(self, body):
+        return dict(etag='"x"', last_modified=None, content_type=None, body=body)
+
+    def check_lru(self, cache):
+        cache.put('a', self.entry('a' * 40))
+        cache.put('b', self.entry('b' * 40))
+        cache.get('a')
+        cache.put('c', self.entry('c' * 40))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+        # Too big to ever fit
+        cache.put('d', self.entry('d' * 1000))
+        self.assertIsNone(cache.get('d'))
+
+    def test_memory_lru(self):
+        self.check_lru(MemoryCache(max_bytes=100))
+
+    def test_disk_lru(self):
+        path = tempfile.mkdtemp()
+        try:
+            cache = DiskCache(path, max_bytes=300)
+            # Make recency visible to mtime based eviction
+            original_save = cache._save
+            def save(key, entry):
+                time.sleep(0.01)
+                original_save(key, entry)
+            cache._save = save
+            original_load = cache._load
+            def load(key):
+                time.sleep(0.01)
+                return original_load(key)
+            cache._load = load
+            self.check_lru(cache)
+        finally:
+            shutil.rmtree(path)
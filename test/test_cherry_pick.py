@@ -3,11 +3,26 @@ import os
 import unittest
 import filecmp
 
+import mock
+
 from ghpick.cherry import CherryPick
+from ghpick.applier import split_lines
+from ghpick.engine import GithubRequestsEngine
+from ghpick.engine import GithubNotFound, GithubGeneralException
+from ghpick.engine import GithubUnprocessableEntity, GithubMergeConflict
 from ghpick_vcr import gvcr
+from ghpick_server import LocalGithub, FakeGithub
 
 from pprint import pprint as pp
 
+def serve_file(content, stream_to=None):
+    """ What engine.get_file gives back, streamed to a file or not """
+    sha = GithubRequestsEngine.blob_sha(content)
+    if stream_to is None:
+        return dict(content=content, sha=sha)
+    stream_to.write(content)
+    return dict(sha=sha)
+
 class TestCherryPick(unittest.TestCase):
     patch_dir = os.path.join(
         os.path.dirname(__file__),
@@ -125,3 +140,627 @@ class TestCherryPick(unittest.TestCase):
                 'path': 'NewFile.txt'
             }
         ]
+
+class TestConcurrentFetch(unittest.TestCase):
+    def setUp(self):
+        self.cherry = CherryPick(
+            username='test',
+            password='test',
+            org='whiskeyriver',
+            repo='ghpick_test',
+            workers=4)
+        self.cherry.engine = mock.Mock()
+        self.cherry.engine.get_sha.return_value = 'a' * 40
+        self.cherry.target_branch = 'test_branch'
+        self.cherry._prepare_workspace()
+        self.cherry.patch_summary = [
+            dict(path='dir/file_{}.txt'.format(i), mode=None, is_deleted=False)
+            for i in range(20)
+        ]
+
+    def tearDown(self):
+        self.cherry._delete_workspace()
+
+    def test_fetch_files(self):
+        def get_file(path, ref, stream_to):
+            if path == 'dir/file_3.txt':
+                raise GithubNotFound(path)
+            stream_to.write(path)
+            return dict(sha=GithubRequestsEngine.blob_sha(path))
+        self.cherry.engine.get_file.side_effect = get_file
+
+        self.cherry._fetch_files()
+
+        for item in self.cherry.patch_summary:
+            path = os.path.join(self.cherry.files_base, item['path'])
+            if item['path'] == 'dir/file_3.txt':
+                self.assertFalse(os.path.isfile(path))
+            else:
+                with open(path) as f:
+                    self.assertEqual(f.read(), item['path'])
+        self.cherry.engine.get_sha.assert_called_once_with('test_branch')
+
+    def test_fetch_fails_fast(self):
+        self.cherry.engine.get_file.side_effect = GithubGeneralException('boom')
+        with self.assertRaises(GithubGeneralException):
+            self.cherry._fetch_files()
+
+    def test_fetch_from_tree(self):
+        self.cherry.fetch_strategy = 'tree'
+        self.cherry.patch_summary = [
+            dict(path=path, mode=None, is_deleted=False)
+            for path in ('dir/a.txt', 'dir/copy_of_a.txt', 'b.txt', 'new.txt')
+        ]
+        self.cherry.engine.get_tree.return_value = dict(sha='0' * 40, truncated=False, tree=[
+            dict(path='dir', type='tree', sha='1' * 40),
+            dict(path='dir/a.txt', type='blob', sha='a' * 40),
+            dict(path='dir/copy_of_a.txt', type='blob', sha='a' * 40),
+            dict(path='b.txt', type='blob', sha='b' * 40),
+        ])
+        blobs = {'a' * 40: 'AAA', 'b' * 40: 'BBB'}
+        self.cherry.engine.get_blob.side_effect = \
+            lambda sha, stream_to: stream_to.write(blobs[sha])
+
+        self.cherry._fetch_files()
+
+        self.assertEqual(self.cherry.engine.get_blob.call_count, 2)
+        self.assertFalse(self.cherry.engine.get_file.called)
+        base = self.cherry.files_base
+        for path, content in (('dir/a.txt', 'AAA'),
+                              ('dir/copy_of_a.txt', 'AAA'),
+                              ('b.txt', 'BBB')):
+            with open(os.path.join(base, path)) as f:
+                self.assertEqual(f.read(), content)
+        self.assertFalse(os.path.isfile(os.path.join(base, 'new.txt')))
+
+    def test_fetch_from_graphql(self):
+        self.cherry.fetch_strategy = 'graphql'
+        self.cherry.graphql_batch_size = 8
+
+        def get_files(paths, ref, batch_size):
+            return dict((path, None if path == 'dir/file_3.txt' else
+                         dict(sha=GithubRequestsEngine.blob_sha(path), content=path))
+                        for path in paths)
+        self.cherry.engine.get_files.side_effect = get_files
+
+        self.cherry._fetch_files()
+
+        batches = [ len(c[0][0]) for c in self.cherry.engine.get_files.call_args_list ]
+        self.assertEqual(sorted(batches), [4, 8, 8])
+        self.assertFalse(self.cherry.engine.get_file.called)
+        for item in self.cherry.patch_summary:
+            path = os.path.join(self.cherry.files_base, item['path'])
+            if item['path'] == 'dir/file_3.txt':
+                self.assertFalse(os.path.isfile(path))
+            else:
+                with open(path) as f:
+                    self.assertEqual(f.read(), item['path'])
+        self.assertIn(GithubRequestsEngine.blob_sha('dir/file_0.txt'),
+                      self.cherry.known_blobs)
+
+    def test_upload_only_new_blobs(self):
+        self.cherry.engine.blob_sha = GithubRequestsEngine.blob_sha
+        self.cherry.engine.create_blob.side_effect = \
+            lambda contents: dict(sha=GithubRequestsEngine.blob_sha(contents))
+        self.cherry.patch_summary = [
+            dict(path='same.txt', mode=None, is_deleted=False),
+            dict(path='changed.txt', mode=None, is_deleted=False),
+            dict(path='also_changed.txt', mode=None, is_deleted=False),
+            dict(path='gone.txt', mode=None, is_deleted=True),
+        ]
+        for path, content in (('same.txt', 'unchanged'),
+                              ('changed.txt', 'new'),
+                              ('also_changed.txt', 'new')):
+            self.cherry._write_file(path, content)
+        self.cherry.known_blobs.add(GithubRequestsEngine.blob_sha('unchanged'))
+
+        self.cherry._upload_blobs()
+
+        self.cherry.engine.create_blob.assert_called_once_with('new')
+        self.assertEqual(self.cherry.blob_shas['same.txt'],
+                         GithubRequestsEngine.blob_sha('unchanged'))
+        self.assertNotIn('gone.txt', self.cherry.blob_shas)
+
+class TestFlatTree(unittest.TestCase):
+    def setUp(self):
+        self.cherry = CherryPick(
+            username='test',
+            password='test',
+            org='whiskeyriver',
+            repo='ghpick_test',
+            tree_strategy='flat')
+        self.cherry.engine = mock.Mock()
+        self.cherry.patch_summary = [
+            dict(path='a/b/c/d/e/changed.txt', mode=None, is_deleted=False),
+            dict(path='added.sh', mode='100755', is_deleted=False),
+            dict(path='a/removed.txt', mode=None, is_deleted=True),
+        ]
+        self.cherry._build_patch_tree()
+        self.cherry._upload_blobs = mock.Mock()
+        self.cherry.blob_shas = {
+            'a/b/c/d/e/changed.txt': '1' * 40,
+            'added.sh': '2' * 40,
+        }
+        self.target_tree = dict(sha='f' * 40, tree=[])
+
+    def test_single_create_tree(self):
+        self.cherry.engine.create_tree.return_value = dict(sha='e' * 40)
+        tree = self.cherry._build_tree(self.target_tree)
+
+        self.assertEqual(tree['sha'], 'e' * 40)
+        self.assertFalse(self.cherry.engine.get_tree.called)
+        self.cherry.engine.create_tree.assert_called_once_with(dict(
+            base_tree='f' * 40,
+            tree=[
+                dict(path='a/b/c/d/e/changed.txt', mode='100644',
+                     type='blob', sha='1' * 40),
+                dict(path='added.sh', mode='100755', type='blob', sha='2' * 40),
+                dict(path='a/removed.txt', mode='100644', type='blob', sha=None),
+            ]))
+
+    def test_falls_back_to_recursive(self):
+        # One rejected flat tree, then the e, d, c, b and a subtrees and root
+        created = [dict(sha=str(i) * 40) for i in range(1, 7)]
+        self.cherry.engine.create_tree.side_effect = \
+            [GithubUnprocessableEntity('nope')] + created
+
+        tree = self.cherry._build_tree(self.target_tree)
+
+        self.assertEqual(self.cherry.engine.create_tree.call_count, 7)
+        self.assertEqual(tree, created[-1])
+
+class TestInMemoryApply(unittest.TestCase):
+    patch = (
+        "diff --git a/README.md b/README.md\n"
+        "index 18df4c8..2e09960 100644\n"
+        "--- a/README.md\n"
+        "+++ b/README.md\n"
+        "@@ -1,2 +1,2 @@\n"
+        " # ghpick_test\n"
+        "-old line\n"
+        "+new line\n"
+        "diff --git a/NewFile.txt b/NewFile.txt\n"
+        "new file mode 100644\n"
+        "index 0000000..3b18e51\n"
+        "--- /dev/null\n"
+        "+++ b/NewFile.txt\n"
+        "@@ -0,0 +1 @@\n"
+        "+new file\n")
+
+    def make_cherry(self, applier):
+        cherry = CherryPick(
+            username='test',
+            password='test',
+            org='whiskeyriver',
+            repo='ghpick_test',
+            applier=applier)
+        cherry.engine = mock.Mock()
+        cherry.engine.get_repo_commit.return_value = dict(
+            sha='t' * 40, parents=[dict(sha='p' * 40)],
+            commit=dict(author=dict(name='a'), message='fix'))
+        cherry.engine.compare.side_effect = \
+            lambda *args, **kwargs: iter(split_lines(self.patch))
+        cherry.engine.get_sha.return_value = 'b' * 40
+
+        def get_file(path, ref, stream_to=None):
+            if path != 'README.md':
+                raise GithubNotFound(path)
+            return serve_file('# ghpick_test\nold line\n', stream_to)
+        cherry.engine.get_file.side_effect = get_file
+        return cherry
+
+    @mock.patch('tempfile.mkdtemp')
+    def test_patch_in_memory(self, mkdtemp):
+        cherry = self.make_cherry('python')
+        self.assertTrue(cherry.patch('t' * 40, 'test_branch'))
+        self.assertFalse(mkdtemp.called)
+        self.assertEqual(cherry._read_file('README.md'), '# ghpick_test\nnew line\n')
+        self.assertEqual(cherry._read_file('NewFile.txt'), 'new file\n')
+
+    def test_matches_git_apply(self):
+        python = self.make_cherry('python')
+        python.patch('t' * 40, 'test_branch')
+        git = self.make_cherry('git')
+        git.patch('t' * 40, 'test_branch')
+        try:
+            for path in ('README.md', 'NewFile.txt'):
+                self.assertEqual(python._read_file(path), git._read_file(path))
+        finally:
+            git._delete_workspace()
+
+    def test_large_files_uploaded_from_disk(self):
+        cherry = self.make_cherry('git')
+        cherry.stream_size = 0
+        cherry.engine.blob_sha_file = GithubRequestsEngine.blob_sha_file
+        uploaded = dict()
+        def create_blob(f):
+            content = f.read()
+            uploaded[GithubRequestsEngine.blob_sha(content)] = content
+            return dict(sha=GithubRequestsEngine.blob_sha(content))
+        cherry.engine.create_blob.side_effect = create_blob
+        try:
+            cherry.patch('t' * 40, 'test_branch')
+            cherry._upload_blobs()
+        finally:
+            cherry._delete_workspace()
+        self.assertEqual(sorted(uploaded.values()),
+                         ['# ghpick_test\nnew line\n', 'new file\n'])
+        self.assertEqual(sorted(cherry.blob_shas.values()), sorted(uploaded))
+
+    def test_conflict(self):
+        cherry = self.make_cherry('python')
+        cherry.engine.get_file.side_effect = \
+            lambda path, ref: dict(content='something else\n', sha='r' * 40)
+        with self.assertRaises(GithubMergeConflict):
+            cherry.patch('t' * 40, 'test_branch')
+
+    def test_fetch_starts_before_patch_downloaded(self):
+        cherry = self.make_cherry('python')
+        events = []
+
+        def stream(*args, **kwargs):
+            for line in split_lines(self.patch):
+                if line.startswith('diff --git'):
+                    events.append(line.split()[-1])
+                yield line
+        cherry.engine.compare.side_effect = stream
+        get_file = cherry.engine.get_file.side_effect
+
+        def record_fetch(path, ref):
+            events.append('fetch ' + path)
+            return get_file(path, ref)
+        cherry.engine.get_file.side_effect = record_fetch
+
+        cherry.patch('t' * 40, 'test_branch')
+        self.assertEqual(events, ['b/README.md', 'fetch README.md',
+                                  'b/NewFile.txt', 'fetch NewFile.txt'])
+
+class TestPatchTree(unittest.TestCase):
+    def test_build_patch_tree(self):
+        cherry = CherryPick(username='test', password='test',
+                            org='whiskeyriver', repo='ghpick_test')
+        cherry.patch_summary = [
+            dict(path='b/path/x.txt', mode=None, is_deleted=False),
+            dict(path='a.txt', mode='100755', is_deleted=False),
+            dict(path='b/path/mode', mode=None, is_deleted=True),
+        ]
+        cherry._build_patch_tree()
+
+        root = cherry.patch_tree
+        self.assertEqual([ k for k, v in root.iteritems() ], ['a.txt', 'b'])
+        self.assertEqual(root.children['a.txt'].item, cherry.patch_summary[1])
+        # Directories named like summary keys are still directories
+        path = root.children['b'].children['path']
+        self.assertFalse(path.is_file)
+        self.assertEqual([ (k, v.item) for k, v in path.iteritems() ], [
+            ('mode', cherry.patch_summary[2]),
+            ('x.txt', cherry.patch_summary[0])])
+
+class TestTreeSnapshot(unittest.TestCase):
+    trees = {
+        'R': [dict(path='a.txt', type='blob', mode='100644', sha='A'),
+              dict(path='d', type='tree', mode='040000', sha='D')],
+        'D': [dict(path='x.txt', type='blob', mode='100644', sha='X'),
+              dict(path='e', type='tree', mode='040000', sha='E')],
+        'E': [dict(path='z.txt', type='blob', mode='100644', sha='Z')],
+    }
+    listing = [dict(path='a.txt', type='blob', mode='100644', sha='A'),
+               dict(path='d', type='tree', mode='040000', sha='D'),
+               dict(path='d/x.txt', type='blob', mode='100644', sha='X'),
+               dict(path='d/e', type='tree', mode='040000', sha='E'),
+               dict(path='d/e/z.txt', type='blob', mode='100644', sha='Z')]
+
+    def setUp(self):
+        self.cherry = CherryPick(username='test', password='test',
+                                 org='whiskeyriver', repo='ghpick_test',
+                                 applier='python')
+        engine = self.cherry.engine = mock.Mock()
+        engine.blob_sha = GithubRequestsEngine.blob_sha
+        engine.create_blob.side_effect = \
+            lambda contents: dict(sha=GithubRequestsEngine.blob_sha(contents))
+
+        def get_tree(sha, recursive=False):
+            if recursive:
+                return dict(sha='R', truncated=False, tree=self.listing)
+            sha = 'R' if sha == 'base' else sha
+            return dict(sha=sha, tree=self.trees[sha])
+        engine.get_tree.side_effect = get_tree
+        created = iter(range(100))
+        engine.create_tree.side_effect = lambda tree: dict(
+            sha='new{}'.format(next(created)), tree=tree['tree'])
+
+        self.cherry._start_pick()
+        self.cherry.patch_summary = [
+            dict(path=path, mode=None, is_deleted=False)
+            for path in ('d/x.txt', 'd/y.txt', 'd/e/z.txt')
+        ]
+        self.cherry.files = dict((x['path'], 'new\n') for x in self.cherry.patch_summary)
+
+    def test_each_tree_fetched_once(self):
+        tree = self.cherry._build_tree(self.cherry._get_tree('base'))
+        self.cherry._get_tree('base')
+
+        fetched = [ c[0][0] for c in self.cherry.engine.get_tree.call_args_list ]
+        self.assertEqual(fetched, ['base', 'D', 'E'])
+        # Trees we made are kept for the next commit in a range
+        self.assertEqual(self.cherry.trees[tree['sha']], tree)
+        self.assertEqual(len(self.cherry.trees), 6)
+
+    def test_trees_from_recursive_listing(self):
+        self.cherry._remember_listing(
+            self.cherry.engine.get_tree('base', recursive=True), 'base')
+        self.cherry._build_tree(self.cherry._get_tree('base'))
+
+        self.assertEqual(self.cherry.engine.get_tree.call_count, 1)
+        self.assertEqual(sorted(x['path'] for x in self.cherry.trees['D']['tree']),
+                         ['e', 'x.txt'])
+        self.assertEqual(self.cherry.trees['base'], self.cherry.trees['R'])
+
+class TestPickRange(unittest.TestCase):
+    patches = {
+        'c1': ("diff --git a/README.md b/README.md\n"
+               "index 1111111..2222222 100644\n"
+               "--- a/README.md\n"
+               "+++ b/README.md\n"
+               "@@ -1 +1 @@\n"
+               "-one\n"
+               "+two\n"),
+        'c2': ("diff --git a/README.md b/README.md\n"
+               "index 2222222..3333333 100644\n"
+               "--- a/README.md\n"
+               "+++ b/README.md\n"
+               "@@ -1 +1 @@\n"
+               "-two\n"
+               "+three\n"
+               "diff --git a/other.txt b/other.txt\n"
+               "index 4444444..5555555 100644\n"
+               "--- a/other.txt\n"
+               "+++ b/other.txt\n"
+               "@@ -1 +1 @@\n"
+               "-other\n"
+               "+changed\n"),
+    }
+
+    def setUp(self):
+        self.cherry = CherryPick(
+            username='test',
+            password='test',
+            org='whiskeyriver',
+            repo='ghpick_test',
+            applier='python',
+            tree_strategy='flat')
+        engine = self.cherry.engine = mock.Mock()
+        engine.blob_sha = GithubRequestsEngine.blob_sha
+        engine.get_sha.return_value = 'base'
+        engine.get_tree.return_value = dict(sha='tree0', tree=[])
+        # Oldest first, like the compare API
+        self.comparison = dict(
+            base_commit=dict(sha='c0'),
+            total_commits=2,
+            commits=[
+                dict(sha='c1', parents=[dict(sha='c0')],
+                     commit=dict(message='first', author=dict(name='a'))),
+                dict(sha='c2', parents=[dict(sha='c1')],
+                     commit=dict(message='second', author=dict(name='a'))),
+            ])
+        def compare(base, head, as_patch=False, **kwargs):
+            if as_patch:
+                return iter(split_lines(self.patches[head]))
+            return self.comparison
+        engine.compare.side_effect = compare
+        self.contents = {'README.md': 'one\n', 'other.txt': 'other\n'}
+        engine.get_file.side_effect = lambda path, ref: dict(
+            content=self.contents[path],
+            sha=GithubRequestsEngine.blob_sha(self.contents[path]))
+        engine.create_blob.side_effect = \
+            lambda contents: dict(sha=GithubRequestsEngine.blob_sha(contents))
+        engine.create_tree.side_effect = \
+            lambda tree: dict(sha='tree_on_' + tree['base_tree'], tree=[])
+        engine.create_commit.side_effect = \
+            lambda message, tree, parents, author: dict(sha='new_' + message)
+
+    def test_pick_range(self):
+        created = self.cherry.pick_range('c0', 'c2', 'rel_1.0')
+        engine = self.cherry.engine
+
+        self.assertEqual([ c['sha'] for c in created ], ['new_first', 'new_second'])
+        self.assertEqual(sorted(c[0][0] for c in engine.get_file.call_args_list),
+                         ['README.md', 'other.txt'])
+        for call in engine.get_file.call_args_list:
+            self.assertEqual(call[0][1], 'base')
+        commits = engine.create_commit.call_args_list
+        self.assertEqual(commits[0][0][1:3], ('tree_on_tree0', ['base']))
+        self.assertEqual(commits[1][0][1:3], ('tree_on_tree_on_tree0', ['new_first']))
+        engine.point_branch.assert_called_once_with('rel_1.0', 'new_second')
+        self.assertEqual(self.cherry._read_file('README.md'), 'three\n')
+        # Every commit came from the one compare call
+        self.assertFalse(engine.commits.called)
+        self.assertFalse(engine.get_commit.called)
+        self.assertFalse(engine.get_repo_commit.called)
+
+    def test_more_commits_than_compare_lists(self):
+        self.comparison['total_commits'] = 300
+        self.comparison['commits'] = self.comparison['commits'][:1]
+        # Newest first, like the commits API
+        self.cherry.engine.commits.return_value = [
+            dict(sha='c2', parents=[dict(sha='c1')],
+                 commit=dict(message='second', author=dict(name='a'))),
+            dict(sha='c1', parents=[dict(sha='c0')],
+                 commit=dict(message='first', author=dict(name='a'))),
+        ]
+        created = self.cherry.pick_range('c0', 'c2', 'rel_1.0')
+        self.assertEqual([ c['sha'] for c in created ], ['new_first', 'new_second'])
+        self.cherry.engine.commits.assert_called_once_with('c0', 'c2')
+
+    def test_conflict_names_commit(self):
+        self.contents['other.txt'] = 'diverged\n'
+        with self.assertRaises(GithubMergeConflict) as ctx:
+            self.cherry.pick_range('c0', 'c2', 'rel_1.0')
+        self.assertEqual(ctx.exception.sha, 'c2')
+        self.assertEqual(ctx.exception.index, 2)
+        self.assertIn('c2 (2 of 2)', str(ctx.exception))
+        self.assertFalse(self.cherry.engine.point_branch.called)
+
+    def test_patch_after_load_metadata(self):
+        self.cherry.load_metadata('c0', 'c2')
+        self.cherry.patch('c1', 'rel_1.0')
+        engine = self.cherry.engine
+
+        engine.compare.assert_called_with('c0', 'c1', as_patch=True, stream=True)
+        self.assertEqual(self.cherry._read_file('README.md'), 'two\n')
+        self.assertEqual(self.cherry.commit()['sha'], 'new_first')
+        self.assertFalse(engine.get_repo_commit.called)
+
+    def test_pick_onto_after_load_metadata(self):
+        self.cherry.load_metadata('c0', 'c2')
+        results = self.cherry.pick_onto('c1', ['rel_1.0'])
+        engine = self.cherry.engine
+
+        self.assertEqual(results['rel_1.0'], dict(sha='new_first'))
+        engine.compare.assert_called_with('c0', 'c1', as_patch=True, stream=True)
+        self.assertFalse(engine.get_repo_commit.called)
+
+class TestPickOnto(unittest.TestCase):
+    patch = ("diff --git a/README.md b/README.md\n"
+             "index 1111111..2222222 100644\n"
+             "--- a/README.md\n"
+             "+++ b/README.md\n"
+             "@@ -1,2 +1,2 @@\n"
+             " title\n"
+             "-one\n"
+             "+two\n")
+
+    branches = {
+        'rel_1': 'title\none\n',
+        'rel_2': 'title\none\n',
+        'rel_3': 'title\ndiverged\n',
+    }
+
+    def make_cherry(self, applier):
+        cherry = CherryPick(
+            username='test',
+            password='test',
+            org='whiskeyriver',
+            repo='ghpick_test',
+            applier=applier,
+            tree_strategy='flat')
+        engine = cherry.engine = mock.Mock()
+        engine.blob_sha = GithubRequestsEngine.blob_sha
+        engine.get_sha.side_effect = lambda ref: ref
+        engine.get_repo_commit.side_effect = lambda sha: dict(
+            sha=sha, parents=[dict(sha='p' * 40)],
+            commit=dict(author=dict(name='a'), message='fix'))
+        engine.compare.side_effect = \
+            lambda *args, **kwargs: iter(split_lines(self.patch))
+        engine.get_file.side_effect = lambda path, ref, stream_to=None: \
+            serve_file(self.branches[ref], stream_to)
+        engine.get_tree.side_effect = lambda ref: dict(sha='tree_' + ref, tree=[])
+        engine.create_blob.side_effect = \
+            lambda contents: dict(sha=GithubRequestsEngine.blob_sha(contents))
+        engine.create_tree.side_effect = \
+            lambda tree: dict(sha='new_' + tree['base_tree'], tree=[])
+        engine.create_commit.side_effect = \
+            lambda message, tree, parents, author: dict(sha='commit_' + tree)
+        # Made up front, as the branches' threads would race to create it
+        engine.point_branch.side_effect = \
+            lambda branch, sha: dict(object=dict(sha=sha))
+        return cherry
+
+    def check_pick_onto(self, applier):
+        cherry = self.make_cherry(applier)
+        results = cherry.pick_onto('t' * 40, sorted(self.branches))
+
+        self.assertEqual(results['rel_1'], dict(sha='commit_new_tree_rel_1'))
+        self.assertEqual(results['rel_2'], dict(sha='commit_new_tree_rel_2'))
+        self.assertIsInstance(results['rel_3'], GithubMergeConflict)
+        self.assertEqual(cherry.engine.compare.call_count, 1)
+        cherry.engine.get_repo_commit.assert_called_once_with('t' * 40)
+        self.assertFalse(cherry.engine.get_commit.called)
+        cherry.engine.create_blob.assert_called_once_with('title\ntwo\n')
+        self.assertEqual(sorted(c[0][0] for c in cherry.engine.point_branch.call_args_list),
+                         ['rel_1', 'rel_2'])
+
+    def test_pick_onto_in_memory(self):
+        self.check_pick_onto('python')
+
+    def test_pick_onto_git_apply(self):
+        self.check_pick_onto('git')
+
+class TestUnappliedFiles(unittest.TestCase):
+    old = {'README.md': 'title\n1\n2\n3\none\n4\n5\n6\n',
+           'gone.txt': 'bye\n', 'other.txt': 'other\n'}
+    new = {'README.md': 'title\n1\n2\n3\ntwo\n4\n5\n6\n',
+           'added.txt': 'hello\n', 'other.txt': 'other\n'}
+
+    def setUp(self):
+        self.github = FakeGithub()
+        self.root = self.github.add_commit(self.old)
+        self.fix = self.github.add_commit(self.new, [self.root], 'fix')
+        self.github.patches['{}...{}'.format(self.root, self.fix)] = \
+            self.make_patch()
+        self.github.refs['heads/rel_1'] = self.root
+        self.github.refs['heads/rel_2'] = self.github.add_commit(
+            dict(self.old, **{'README.md': 'Title\n1\n2\n3\none\n4\n5\n6\n'}))
+
+    def make_patch(self):
+        sha = lambda content: GithubRequestsEngine.blob_sha(content)[:7]
+        return (
+            "diff --git a/README.md b/README.md\n"
+            "index {}..{} 100644\n"
+            "--- a/README.md\n"
+            "+++ b/README.md\n"
+            "@@ -2,7 +2,7 @@\n"
+            " 1\n 2\n 3\n"
+            "-one\n"
+            "+two\n"
+            " 4\n 5\n 6\n"
+            "diff --git a/added.txt b/added.txt\n"
+            "new file mode 100644\n"
+            "index 0000000..{}\n"
+            "--- /dev/null\n"
+            "+++ b/added.txt\n"
+            "@@ -0,0 +1 @@\n"
+            "+hello\n"
+            "diff --git a/gone.txt b/gone.txt\n"
+            "deleted file mode 100644\n"
+            "index {}..0000000\n"
+            "--- a/gone.txt\n"
+            "+++ /dev/null\n"
+            "@@ -1 +0,0 @@\n"
+            "-bye\n").format(sha(self.old['README.md']), sha(self.new['README.md']),
+                             sha(self.new['added.txt']), sha(self.old['gone.txt']))
+
+    def pick(self, branch, applier):
+        with LocalGithub(self.github) as server:
+            cherry = CherryPick(username='test', password='test',
+                                org='whiskeyriver', repo='ghpick_test',
+                                base_url=server.base_url, applier=applier,
+                                tree_strategy='flat')
+            cherry.patch(self.fix, branch)
+            commit = cherry.commit()
+        tree = self.github.trees[commit['tree']['sha']]
+        files = dict((x['path'], self.github.blobs[x['sha']]) for x in tree)
+        # The API each request went to, i.e. 'contents' or 'blobs'
+        requests = [ (r['method'], r['path'].split('/')[5 if '/git/' in r['path'] else 4])
+                     for r in server.requests ]
+        return cherry, files, requests
+
+    def check_untouched_branch(self, applier):
+        cherry, files, requests = self.pick('rel_1', applier)
+        self.assertEqual(files, self.new)
+        self.assertEqual(sorted(cherry.unapplied), ['README.md', 'added.txt', 'gone.txt'])
+        self.assertNotIn(('GET', 'contents'), requests)
+        self.assertNotIn(('POST', 'blobs'), requests)
+
+    def test_untouched_branch_in_memory(self):
+        self.check_untouched_branch('python')
+
+    def test_untouched_branch_git_apply(self):
+        self.check_untouched_branch('git')
+
+    def test_only_changed_files_applied(self):
+        cherry, files, requests = self.pick('rel_2', 'git')
+        self.assertEqual(files, dict(self.new, **{'README.md': 'Title\n1\n2\n3\ntwo\n4\n5\n6\n'}))
+        self.assertEqual(sorted(cherry.unapplied), ['added.txt', 'gone.txt'])
+        self.assertEqual(requests.count(('GET', 'contents')), 1)
+        self.assertEqual(requests.count(('POST', 'blobs')), 1)
@@ -1,11 +1,33 @@
+import json
+import urlparse
+import tempfile
 import unittest
+import threading
+
+import mock
 
 from ghpick.engine import GithubRequestsEngine
 from ghpick.engine import GithubInvalidCredentials
+from ghpick.engine import GitInvalidSha
+from ghpick.engine import GithubServiceUnavailable
+from ghpick.engine import make_session
+from ghpick.engine import BlobUploadBody
+from ghpick.retry import RetryPolicy
 from ghpick_vcr import gvcr
+from ghpick_server import LocalGithub, FakeGithub
 
 from base64 import b64encode, b64decode
 
+def make_engine(server, **options):
+    """ An engine talking to a LocalGithub """
+    return GithubRequestsEngine(
+        username='test',
+        password='test',
+        org='whiskeyriver',
+        repo='ghpick_test',
+        base_url=server.base_url,
+        **options)
+
 class TestEngine(unittest.TestCase):
     @classmethod
     def setUp(cls):
@@ -88,3 +110,313 @@ class TestEngine(unittest.TestCase):
         sha = self.engine.get_sha('master')
         self.assertEqual(sha, '0dc54282f1a68c5bf9c455df85d7d627decf0fc2')
 
+
+class TestEngineSession(unittest.TestCase):
+    def handler(self, method, path, headers, body):
+        sha = '0dc54282f1a68c5bf9c455df85d7d627decf0fc2'
+        return 200, {}, dict(ref='refs/heads/master', object=dict(sha=sha))
+
+    def test_connections_are_reused(self):
+        with LocalGithub(self.handler) as server:
+            engine = make_engine(server)
+            for _ in range(3):
+                engine.get_branch('master')
+            stats = engine.connection_stats()
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['reused'], 2)
+
+    def test_shared_session(self):
+        session = make_session(pool_maxsize=2)
+        with LocalGithub(self.handler) as server:
+            first = make_engine(server, session=session)
+            second = make_engine(server, session=session)
+            first.get_branch('master')
+            second.get_branch('master')
+            self.assertIs(first.session, second.session)
+            self.assertEqual(second.connection_stats()['reused'], 1)
+
+class TestRefCache(unittest.TestCase):
+    master_sha = '0dc54282f1a68c5bf9c455df85d7d627decf0fc2'
+    tag_sha = 'dbf4eb1e4eada9ebfd6f4e587456d51d7d569364'
+    moved_sha = '27a222596d26ce4097a1d42b1b449505d3d192a2'
+
+    failures = 0
+
+    def handler(self, method, path, headers, body):
+        refs = '/repos/whiskeyriver/ghpick_test/git/refs/'
+        if self.failures:
+            self.failures -= 1
+            return 503, {}, dict(message='Unavailable')
+        if path == refs + 'tags/v1':
+            return 200, {}, [ dict(object=dict(sha=self.tag_sha)) ]
+        if method == 'PATCH':
+            return 200, {}, dict(object=json.loads(body))
+        if path == refs + 'heads/master':
+            return 200, {}, dict(object=dict(sha=self.master_sha))
+        if path == refs + 'tags/v1.0':
+            return 200, {}, dict(object=dict(sha=self.tag_sha))
+        return 404, {}, dict(message='Not Found')
+
+    def test_branch_and_tag_resolved_once(self):
+        with LocalGithub(self.handler) as server:
+            engine = make_engine(server)
+            for _ in range(3):
+                self.assertEqual(engine.get_sha('master'), self.master_sha)
+                self.assertEqual(engine.get_sha('v1.0'), self.tag_sha)
+            # master: 1 branch hit. v1.0: a branch miss and a tag hit.
+            self.assertEqual(len(server.requests), 3)
+
+    def test_negative_lookup_cached(self):
+        with LocalGithub(self.handler) as server:
+            engine = make_engine(server)
+            for _ in range(2):
+                with self.assertRaises(GitInvalidSha):
+                    engine.get_sha('nope')
+            self.assertEqual(len(server.requests), 2)
+
+    def test_errors_not_cached(self):
+        self.failures = 1
+        with LocalGithub(self.handler) as server:
+            engine = make_engine(server, retry_policy=False)
+            with self.assertRaises(GithubServiceUnavailable):
+                engine.get_sha('master')
+            self.assertEqual(engine.get_sha('master'), self.master_sha)
+
+    def test_partial_tag_match(self):
+        with LocalGithub(self.handler) as server:
+            engine = make_engine(server)
+            with self.assertRaises(GitInvalidSha):
+                engine.get_sha('v1')
+
+    def test_expired_branch_refetched(self):
+        with LocalGithub(self.handler) as server:
+            engine = make_engine(server, ref_cache_ttl=0)
+            engine.get_sha('master')
+            engine.get_sha('master')
+            self.assertEqual(len(server.requests), 2)
+
+    def test_point_branch_updates_cache(self):
+        with LocalGithub(self.handler) as server:
+            engine = make_engine(server)
+            engine.get_sha('master')
+            engine.point_branch('master', self.moved_sha)
+            self.assertEqual(engine.get_sha('master'), self.moved_sha)
+            self.assertEqual(len(server.requests), 2)
+
+class TestBlobSha(unittest.TestCase):
+    def test_blob_sha(self):
+        sha = GithubRequestsEngine.blob_sha('This is a blob')
+        self.assertEqual(sha, '7ad71a06ce2c995f4c7d61a6f0f1ed3edca66e8f')
+
+class TestStreamedCompare(unittest.TestCase):
+    patch = "From abc\ndiff --git a/x b/x\r\n" + "+" + "y" * 100000 + "\nlast"
+
+    def handler(self, method, path, headers, body):
+        return 200, {'Content-Type': 'text/plain'}, self.patch
+
+    def test_compare_stream(self):
+        with LocalGithub(self.handler) as server:
+            engine = make_engine(server)
+            lines = engine.compare('a' * 40, 'b' * 40, as_patch=True, stream=True)
+            self.assertEqual(server.requests[0]['headers']['accept'],
+                             engine.patch_media_type)
+            self.assertEqual(list(lines), [
+                "From abc\n",
+                "diff --git a/x b/x\r\n",
+                "+" + "y" * 100000 + "\n",
+                "last"])
+
+    def test_long_line_over_many_chunks(self):
+        chunks = ['head\nx'] + ['y' * 1000] * 5000 + ['z\n', '', 'a\nb\n', 'tail']
+        self.assertEqual(list(GithubRequestsEngine._split_lines(chunks)), [
+            "head\n",
+            "x" + "y" * 5000000 + "z\n",
+            "a\n",
+            "b\n",
+            "tail"])
+
+class TestStreamedBlobs(unittest.TestCase):
+    # Not a multiple of BlobUploadBody.block_size, nor of 3
+    content = ''.join(chr(i % 256) for i in range(BlobUploadBody.block_size * 2 + 1000))
+
+    def setUp(self):
+        self.github = FakeGithub()
+        self.failures = 0
+
+    def handler(self, method, path, headers, body):
+        if self.failures:
+            self.failures -= 1
+            return 503, {}, dict(message='Unavailable')
+        return self.github(method, path, headers, body)
+
+    def test_body(self):
+        body = BlobUploadBody(memoryview(self.content))
+        sent = ''.join(body)
+        self.assertEqual(len(sent), len(body))
+        self.assertEqual(json.loads(sent),
+                         dict(content=b64encode(self.content), encoding='base64'))
+        body.seek(0)
+        self.assertEqual(body.read(), sent)
+
+    def test_create_blob_from_file(self):
+        f = tempfile.TemporaryFile()
+        f.write('skipped' + self.content)
+        f.seek(len('skipped'))
+        with LocalGithub(self.handler) as server:
+            blob = make_engine(server).create_blob(f)
+        self.assertEqual(blob['sha'], GithubRequestsEngine.blob_sha(self.content))
+        self.assertEqual(self.github.blobs[blob['sha']], self.content)
+
+    def test_upload_sent_again_when_retried(self):
+        self.failures = 1
+        policy = RetryPolicy(sleep=lambda seconds: None)
+        with LocalGithub(self.handler) as server:
+            blob = make_engine(server, retry_policy=policy).create_blob(
+                memoryview(self.content))
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(self.github.blobs[blob['sha']], self.content)
+
+    def test_failed_upload_logs_length_only(self):
+        self.failures = 1
+        with LocalGithub(self.handler) as server:
+            engine = make_engine(server, retry_policy=False)
+            with mock.patch('ghpick.engine.logging') as logging:
+                with self.assertRaises(GithubServiceUnavailable):
+                    engine.create_blob(memoryview(self.content))
+        args = logging.error.call_args[0]
+        self.assertEqual(args[1:4], ('POST', engine.blobs_url, 503))
+        self.assertEqual(args[4], len(BlobUploadBody(memoryview(self.content))))
+
+    def test_download(self):
+        sha = self.github.add_blob(self.content)
+        commit = self.github.add_commit({'big.bin': self.content})
+        with LocalGithub(self.handler) as server:
+            engine = make_engine(server)
+            blob_file = tempfile.TemporaryFile()
+            self.assertEqual(engine.get_blob(sha, stream_to=blob_file),
+                             dict(sha=sha, size=len(self.content)))
+            contents_file = tempfile.TemporaryFile()
+            fetched = engine.get_file('big.bin', commit, stream_to=contents_file)
+            self.assertEqual(server.requests[0]['headers']['accept'],
+                             engine.raw_media_type)
+        self.assertEqual(fetched, dict(path='big.bin', sha=sha, size=len(self.content)))
+        for f in (blob_file, contents_file):
+            f.seek(0)
+            self.assertEqual(f.read(), self.content)
+
+class TestGetFiles(unittest.TestCase):
+    files = {
+        'README.md': 'Read me\n',
+        'dir/unicode.txt': 'caf\xc3\xa9\n',
+        'latin1.txt': 'caf\xe9\n',
+        'logo.png': '\x89PNG\r\n\x00\x00',
+        'big.txt': 'x' * 100,
+    }
+
+    def setUp(self):
+        self.github = FakeGithub()
+        self.github.graphql_text_limit = 50
+        self.sha = self.github.add_commit(self.files)
+
+    def requests(self, server):
+        return [ (r['method'], r['path'].split('/')[-1]) for r in server.requests ]
+
+    def test_get_files(self):
+        paths = sorted(self.files) + ['missing.txt']
+        with LocalGithub(self.github) as server:
+            files = make_engine(server).get_files(paths, self.sha)
+
+        self.assertEqual(files['missing.txt'], None)
+        for path, content in self.files.items():
+            self.assertEqual(files[path], dict(
+                sha=GithubRequestsEngine.blob_sha(content), content=content))
+
+        # Binary, truncated and non UTF-8 files come from the blobs API
+        rest = sorted(sha for method, sha in self.requests(server) if method == 'GET')
+        self.assertEqual(rest, sorted(GithubRequestsEngine.blob_sha(self.files[path])
+                                      for path in ('big.txt', 'latin1.txt', 'logo.png')))
+        self.assertEqual(self.requests(server).count(('POST', 'graphql')), 1)
+
+    def test_batches(self):
+        with LocalGithub(self.github) as server:
+            files = make_engine(server).get_files(
+                ['README.md', 'dir/unicode.txt'] * 3, self.sha, batch_size=2)
+        self.assertEqual(self.requests(server), [('POST', 'graphql')] * 3)
+        self.assertEqual(files['README.md']['content'], 'Read me\n')
+
+    def test_splits_queries_over_the_limit(self):
+        self.github.graphql_max_fields = 2
+        with LocalGithub(self.github) as server:
+            files = make_engine(server).get_files(
+                ['README.md', 'dir/unicode.txt', 'README.md'], self.sha)
+        # 3 fails, then 1 and 2
+        self.assertEqual(self.requests(server), [('POST', 'graphql')] * 3)
+        self.assertEqual(files['dir/unicode.txt']['content'], 'caf\xc3\xa9\n')
+
+    def test_graphql_url(self):
+        engine = GithubRequestsEngine('u', 'p', 'o', 'r')
+        self.assertEqual(engine.graphql_url, 'https://api.github.com/graphql')
+        engine = GithubRequestsEngine('u', 'p', 'o', 'r',
+                                      base_url='https://ghe.example.com/api/v3')
+        self.assertEqual(engine.graphql_url, 'https://ghe.example.com/api/graphql')
+
+class TestIterCommits(unittest.TestCase):
+    shas = [ '{:040x}'.format(n) for n in range(1, 1001) ]
+
+    def setUp(self):
+        self.page_requested = dict()
+
+    def handler(self, method, path, headers, body):
+        url = urlparse.urlparse(path)
+        query = dict(urlparse.parse_qsl(url.query))
+        if '/git/commits/' in url.path:
+            return 200, {}, dict(sha=url.path.split('/')[-1],
+                                 committer=dict(date='2015-07-06T19:44:13Z'))
+        page = int(query.get('page', 1))
+        per_page = int(query['per_page'])
+        self.page_requested.setdefault(page, threading.Event()).set()
+        commits = self.shas[(page - 1) * per_page:page * per_page]
+        headers = {}
+        if page * per_page < len(self.shas):
+            headers['Link'] = '<{}{}?sha={}&per_page={}&page={}>; rel="next"'.format(
+                self.base_url, url.path, query['sha'], per_page, page + 1)
+        return 200, headers, [ dict(sha=sha) for sha in commits ]
+
+    def make_engine(self, server):
+        # For the handler's Link headers
+        self.base_url = server.base_url
+        return make_engine(server)
+
+    def pages(self, server):
+        return [ r['path'] for r in server.requests if '/commits?' in r['path'] ]
+
+    def test_follows_pages_until_start(self):
+        with LocalGithub(self.handler) as server:
+            commits = self.make_engine(server).commits(self.shas[950], self.shas[0])
+        self.assertEqual([ c['sha'] for c in commits ], self.shas[:950])
+        # 950 is on the 10th page of 100, and no page after it is read
+        self.assertEqual(len(self.pages(server)), 10)
+        self.assertIn('since=2015-07-06T19%3A44%3A13Z', self.pages(server)[0])
+
+    def test_lazy_with_prefetch(self):
+        with LocalGithub(self.handler) as server:
+            engine = self.make_engine(server)
+            commits = engine.iter_commits(self.shas[150], self.shas[0], per_page=50)
+            self.assertEqual(self.pages(server), [])
+
+            self.assertEqual(next(commits)['sha'], self.shas[0])
+            # Page 2 is on its way while page 1 is still being read
+            self.assertTrue(self.page_requested.setdefault(
+                2, threading.Event()).wait(5))
+            rest = [ c['sha'] for c in commits ]
+        self.assertEqual(rest, self.shas[1:150])
+        self.assertEqual(len(self.pages(server)), 4)
+
+    def test_without_prefetch(self):
+        with LocalGithub(self.handler) as server:
+            engine = self.make_engine(server)
+            commits = engine.iter_commits(self.shas[10], self.shas[0],
+                                          per_page=5, prefetch=False)
+            self.assertEqual([ c['sha'] for c in commits ], self.shas[:10])
+        self.assertEqual(len(self.pages(server)), 3)
@@ -0,0 +1,90 @@
+import unittest
+
+from ghpick.engine import GithubRequestsEngine
+from ghpick.metrics import InMemorySink, MetricsSink, operation, to_prometheus
+from ghpick.retry import RetryPolicy
+from ghpick_server import LocalGithub, FakeGithub
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.github = FakeGithub()
+        self.sha = self.github.add_commit({'README.md': 'Read me\n'})
+        self.github.refs['heads/master'] = self.sha
+        self.metrics = InMemorySink()
+
+    def make_engine(self, server, **options):
+        return GithubRequestsEngine(
+            username='test',
+            password='test',
+            org='whiskeyriver',
+            repo='ghpick_test',
+            base_url=server.base_url,
+            metrics=self.metrics,
+            **options)
+
+    def test_keyed_by_operation(self):
+        with LocalGithub(self.github) as server:
+            engine = self.make_engine(server)
+            engine.get_tree('master')
+            engine.create_blob('new contents')
+            engine.get_file('README.md', self.sha)
+            with operation('custom'):
+                engine._get(engine.trees_url + '/' + self.sha)
+
+        snapshot = self.metrics.snapshot()
+        # The branch lookup goes to the innermost call making it, get_ref
+        self.assertEqual(sorted(snapshot),
+                         ['create_blob', 'custom', 'get_file', 'get_ref', 'get_tree'])
+        blob = snapshot['create_blob']
+        self.assertEqual(blob['count'], 1)
+        self.assertEqual(blob['methods'], {'POST': 1})
+        self.assertEqual(blob['statuses'], {201: 1})
+        self.assertEqual(blob['request_bytes'], len(server.requests[2]['body']))
+        self.assertGreater(snapshot['get_tree']['response_bytes'], 0)
+        self.assertEqual(sum(snapshot['get_file']['histogram']), 1)
+
+    def test_failures_and_retries(self):
+        responses = [(502, {}, 'Bad Gateway')]
+
+        def handler(method, path, headers, body):
+            if responses:
+                return responses.pop()
+            return self.github(method, path, headers, body)
+
+        with LocalGithub(handler) as server:
+            engine = self.make_engine(
+                server, retry_policy=RetryPolicy(sleep=lambda s: None))
+            engine.get_commit(self.sha)
+
+        entry = self.metrics.snapshot()['get_commit']
+        self.assertEqual(entry['statuses'], {502: 1, 200: 1})
+        self.assertEqual(entry['events'], {'retries': 1, 'recovered': 1})
+
+    def test_prometheus(self):
+        self.metrics.observe('get_tree', 'GET', 200, 0.02, 0, 100)
+        self.metrics.observe('get_tree', 'GET', 404, 60, 0, 10)
+        self.metrics.count('retries', 'get_tree')
+        text = to_prometheus(self.metrics.snapshot())
+        lines = text.splitlines()
+
+        self.assertIn('# TYPE ghpick_requests_total counter', lines)
+        self.assertIn('ghpick_requests_total{operation="get_tree",status="200"} 1', lines)
+        self.assertIn('ghpick_request_duration_seconds_bucket{le="0.01",operation="get_tree"} 0', lines)
+        self.assertIn('ghpick_request_duration_seconds_bucket{le="0.025",operation="get_tree"} 1', lines)
+        self.assertIn('ghpick_request_duration_seconds_bucket{le="+Inf",operation="get_tree"} 2', lines)
+        self.assertIn('ghpick_request_duration_seconds_count{operation="get_tree"} 2', lines)
+        self.assertIn('ghpick_response_bytes_total{operation="get_tree"} 110', lines)
+        self.assertIn('ghpick_retries_total{operation="get_tree"} 1', lines)
+
+    def test_disabled_by_default(self):
+        class Recorder(MetricsSink):
+            calls = []
+
+            def observe(self, *args):
+                self.calls.append(args)
+
+        with LocalGithub(self.github) as server:
+            engine = self.make_engine(server)
+            engine.metrics = Recorder()
+            engine.get_commit(self.sha)
+        self.assertEqual(Recorder.calls, [])
@@ -0,0 +1,207 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+from ghpick.objectstore import ObjectStore
+from ghpick.cherry import CherryPick
+from ghpick.engine import GithubRequestsEngine
+from ghpick_server import LocalGithub, FakeGithub
+
+def _fill(path, worker):
+    store = ObjectStore(path, max_bytes=4000)
+    for i in range(50):
+        store.put('blob', '{}-{}'.format(worker, i), str(worker) * 100)
+        store.get('blob', '{}-{}'.format((worker + 1) % 4, i))
+
+class TestObjectStore(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_put_get(self):
+        store = ObjectStore(self.path)
+        self.assertEqual(store.get('blob', 'a' * 40), None)
+        store.put('blob', 'a' * 40, 'contents')
+        self.assertEqual(store.get('blob', 'a' * 40), 'contents')
+        self.assertEqual(store.get('tree', 'a' * 40), None)
+        # Another process would find it too
+        self.assertEqual(ObjectStore(self.path).get('blob', 'a' * 40), 'contents')
+
+        stats = store.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+        self.assertEqual(stats['kinds']['tree'], dict(hits=0, misses=1))
+        self.assertAlmostEqual(stats['hit_rate'], 1 / 3.0)
+
+    def test_aborted_writer_leaves_nothing(self):
+        store = ObjectStore(self.path)
+        with self.assertRaises(ValueError):
+            with store.writer('blob', 'a' * 40) as writer:
+                writer.write('part')
+                raise ValueError()
+        self.assertEqual(store.get('blob', 'a' * 40), None)
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_abandoned_writes_swept(self):
+        store = ObjectStore(self.path)
+        abandoned = store.writer('blob', 'a')
+        abandoned.write('a' * 100)
+        abandoned.file.flush()
+        old = time.time() - store.tmp_grace - 1
+        os.utime(abandoned.file.name, (old, old))
+        writing = store.writer('blob', 'b')
+        writing.write('b' * 10)
+        writing.file.flush()
+
+        store._sweep()
+        self.assertFalse(os.path.exists(abandoned.file.name))
+        self.assertTrue(os.path.exists(writing.file.name))
+        self.assertEqual(store.stats()['bytes'], 0)
+        writing.commit()
+        self.assertEqual(store.get('blob', 'b'), 'b' * 10)
+        self.assertEqual(store.stats()['bytes'], 10)
+
+    def test_same_entry_stored_twice(self):
+        store = ObjectStore(self.path)
+        store.put('blob', 'a', 'a' * 100)
+        ObjectStore(self.path).put('blob', 'a', 'a' * 100)
+        self.assertEqual(store.stats()['bytes'], 100)
+
+    def test_lru(self):
+        store = ObjectStore(self.path, max_bytes=300, low_water=0.7)
+        for key in 'abc':
+            store.put('blob', key, key * 100)
+            # Recency is by mtime, keep them apart
+            os.utime(store._filename('blob', key), (time.time() - ord('z') + ord(key),) * 2)
+        self.assertEqual(store.get('blob', 'a'), 'a' * 100)
+        store.put('blob', 'd', 'd' * 100)
+
+        self.assertEqual(store.get('blob', 'a'), 'a' * 100)
+        self.assertEqual(store.get('blob', 'b'), None)
+        self.assertEqual(store.get('blob', 'c'), None)
+        self.assertEqual(store.get('blob', 'd'), 'd' * 100)
+        self.assertEqual(store.stats()['evicted'], 2)
+        self.assertEqual(store.stats()['bytes'], 200)
+
+    def test_processes_share_a_store(self):
+        workers = [ multiprocessing.Process(target=_fill, args=(self.path, n))
+                    for n in range(4) ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            self.assertEqual(worker.exitcode, 0)
+
+        # Together, not each on their own, with no sweep afterwards
+        on_disk = sum(os.path.getsize(os.path.join(directory, name))
+                      for directory, _, names in os.walk(self.path)
+                      if directory != self.path for name in names)
+        self.assertLessEqual(on_disk, 4000)
+        store = ObjectStore(self.path, max_bytes=4000)
+        self.assertEqual(store.stats()['bytes'], on_disk)
+        self.assertEqual(store.get('blob', '3-49'), '3' * 100)
+
+class TestEngineObjectStore(unittest.TestCase):
+    patch = ("diff --git a/README.md b/README.md\n"
+             "index 1111111..2222222 100644\n"
+             "--- a/README.md\n"
+             "+++ b/README.md\n"
+             "@@ -1,2 +1,2 @@\n"
+             " title\n"
+             "-one\n"
+             "+two\n")
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.github = FakeGithub()
+        self.root = self.github.add_commit({'README.md': 'title\none\n',
+                                            'other.txt': 'other\n'})
+        self.fix = self.github.add_commit({'README.md': 'title\ntwo\n',
+                                           'other.txt': 'other\n'},
+                                          [self.root], 'fix')
+        self.github.patches['{}...{}'.format(self.root, self.fix)] = self.patch
+        self.github.refs['heads/rel_1'] = self.root
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def make_engine(self, server):
+        return GithubRequestsEngine(
+            username='test',
+            password='test',
+            org='whiskeyriver',
+            repo='ghpick_test',
+            base_url=server.base_url,
+            object_store=ObjectStore(self.path))
+
+    def read_everything(self, engine):
+        readme = engine.get_file('README.md', self.root)
+        streamed = tempfile.TemporaryFile()
+        engine.get_blob(readme['sha'], stream_to=streamed)
+        streamed.seek(0)
+        return dict(
+            tree=engine.get_tree(self.root),
+            commit=engine.get_commit(self.fix),
+            repo_commit=engine.get_repo_commit(self.fix),
+            readme=readme['content'],
+            streamed=streamed.read(),
+            other=engine.get_files(['other.txt'], self.root)['other.txt'],
+            patch=''.join(engine.compare(self.root, self.fix,
+                                         as_patch=True, stream=True)))
+
+    def test_second_engine_served_from_store(self):
+        with LocalGithub(self.github) as server:
+            cold = self.read_everything(self.make_engine(server))
+            sent = len(server.requests)
+            engine = self.make_engine(server)
+            warm = self.read_everything(engine)
+            self.assertEqual(len(server.requests), sent)
+
+        self.assertEqual(warm['readme'], 'title\none\n')
+        self.assertEqual(warm['streamed'], 'title\none\n')
+        self.assertEqual(warm['other']['content'], 'other\n')
+        self.assertEqual(warm['patch'], self.patch)
+        for key in ('tree', 'commit', 'repo_commit', 'patch'):
+            self.assertEqual(warm[key], cold[key])
+        self.assertEqual(engine.object_store_stats()['misses'], 0)
+
+    def test_unread_stream_leaves_nothing(self):
+        with LocalGithub(self.github) as server:
+            lines = self.make_engine(server).compare(self.root, self.fix,
+                                                     as_patch=True, stream=True)
+            self.assertEqual(os.listdir(self.path), [])
+            del lines
+            self.assertEqual(os.listdir(self.path), [])
+
+    def test_blobs_in_repo_not_uploaded(self):
+        with LocalGithub(self.github) as server:
+            engine = self.make_engine(server)
+            first = engine.create_blob('new\n')
+            engine.get_file('README.md', self.root)
+            sent = len(server.requests)
+            self.assertEqual(engine.create_blob('new\n')['sha'], first['sha'])
+            self.assertEqual(engine.create_blob(memoryview('title\none\n'))['sha'],
+                             GithubRequestsEngine.blob_sha('title\none\n'))
+            self.assertEqual(len(server.requests), sent)
+
+    def test_warm_pick(self):
+        options = dict(username='test', password='test', org='whiskeyriver',
+                       repo='ghpick_test', tree_strategy='flat')
+        with LocalGithub(self.github) as server:
+            for _ in range(2):
+                self.github.refs['heads/rel_1'] = self.root
+                cherry = CherryPick(base_url=server.base_url,
+                                    object_store=ObjectStore(self.path), **options)
+                sent = len(server.requests)
+                cherry.patch(self.fix, 'rel_1')
+                commit = cherry.commit()
+            # The branch, the tree and commit to create and the branch update
+            self.assertEqual([ r['method'] for r in server.requests[sent:] ],
+                             ['GET', 'POST', 'POST', 'PATCH'])
+        tree = self.github.trees[commit['tree']['sha']]
+        readme = [ x for x in tree if x['path'] == 'README.md' ][0]
+        self.assertEqual(self.github.blobs[readme['sha']], 'title\ntwo\n')
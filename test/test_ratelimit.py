@@ -0,0 +1,120 @@
+import unittest
+
+from ghpick.engine import GithubRequestsEngine, GithubForbidden
+from ghpick.ratelimit import RateLimitScheduler
+from ghpick_server import LocalGithub
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class TestRateLimit(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = RateLimitScheduler(clock=self.clock, sleep=self.clock.sleep,
+                                            low_water=10, increase_after=2)
+        self.responses = []
+
+    def handler(self, method, path, headers, body):
+        return self.responses.pop(0)
+
+    def make_engine(self, server):
+        return GithubRequestsEngine(
+            username='test',
+            password='test',
+            org='whiskeyriver',
+            repo='ghpick_test',
+            base_url=server.base_url,
+            rate_limiter=self.scheduler)
+
+    def ok(self, remaining=4000, reset=4600):
+        return 200, {'X-RateLimit-Limit': '5000',
+                     'X-RateLimit-Remaining': str(remaining),
+                     'X-RateLimit-Reset': str(reset)}, dict(object=dict(sha='a' * 40))
+
+    def test_secondary_limit_delays_and_throttles(self):
+        self.responses = [
+            (429, {'Retry-After': '30'}, dict(message='slow down')),
+            self.ok(), self.ok(), self.ok()]
+        with LocalGithub(self.handler) as server:
+            engine = self.make_engine(server)
+            engine.get_branch('master')
+            self.assertEqual(self.clock.sleeps, [30.0])
+            state = engine.rate_limit_state()
+            self.assertEqual(state['secondary_limits'], 1)
+            self.assertEqual(state['concurrency'], 1)
+            self.assertTrue(state['throttled'])
+            self.assertEqual(state['remaining'], 4000)
+
+            # Two more successes and it's back to unthrottled
+            engine.get_branch('master')
+            engine.get_branch('master')
+            state = engine.rate_limit_state()
+            self.assertIsNone(state['concurrency'])
+            self.assertFalse(state['throttled'])
+        self.assertEqual(len(server.requests), 4)
+
+    def test_retry_after_date(self):
+        # FakeClock starts 30 seconds before this
+        self.responses = [
+            (429, {'Retry-After': 'Thu, 01 Jan 1970 00:17:10 GMT'}, dict(message='slow down')),
+            (429, {'Retry-After': 'whenever'}, dict(message='slow down')),
+            self.ok()]
+        with LocalGithub(self.handler) as server:
+            self.make_engine(server).get_branch('master')
+        self.assertEqual(self.clock.sleeps, [30.0, 60.0])
+
+    def test_paces_when_budget_low(self):
+        self.responses = [self.ok(remaining=5, reset=1050)] + [self.ok(remaining=5, reset=1050)] * 3
+        with LocalGithub(self.handler) as server:
+            engine = self.make_engine(server)
+            for _ in range(4):
+                engine.get_branch('master')
+        # 50 seconds left for 5 requests spreads them 10 seconds apart
+        self.assertEqual(len(self.clock.sleeps), 2)
+        self.assertAlmostEqual(self.clock.sleeps[0], 10.0)
+
+    def test_waits_for_reset(self):
+        self.responses = [
+            (403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '1060'},
+             dict(message='API rate limit exceeded')),
+            self.ok()]
+        with LocalGithub(self.handler) as server:
+            self.make_engine(server).get_branch('master')
+        self.assertEqual(self.clock.sleeps, [60.0])
+
+    def test_too_long_to_wait(self):
+        self.scheduler.max_wait = 10
+        self.responses = [
+            (403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '5000'},
+             dict(message='API rate limit exceeded'))]
+        with LocalGithub(self.handler) as server:
+            with self.assertRaises(GithubForbidden):
+                self.make_engine(server).get_branch('master')
+        self.assertEqual(self.scheduler.state()['rate_limited'], 1)
+
+    def test_refuses_to_wait_past_max_wait(self):
+        self.scheduler.max_wait = 900
+        self.responses = [
+            (403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '4600'},
+             dict(message='API rate limit exceeded'))]
+        with LocalGithub(self.handler) as server:
+            engine = self.make_engine(server)
+            with self.assertRaises(GithubForbidden):
+                engine.get_branch('master')
+            # The next request is refused rather than held for the hour
+            with self.assertRaises(GithubForbidden):
+                engine.get_branch('master')
+        self.assertEqual(self.clock.sleeps, [])
+        self.assertEqual(len(server.requests), 1)
+        state = self.scheduler.state()
+        self.assertEqual(state['refused'], 1)
+        self.assertEqual(state['active'], 0)
@@ -0,0 +1,150 @@
+import mock
+import unittest
+
+import requests
+
+from ghpick.engine import GithubRequestsEngine, GithubServiceUnavailable
+from ghpick.retry import RetryPolicy
+from ghpick_server import LocalGithub
+
+class TestRetryPolicy(unittest.TestCase):
+    def setUp(self):
+        self.now = [0.0]
+        self.sleeps = []
+        self.policy = RetryPolicy(max_attempts=4, base_delay=1, max_delay=3,
+                                  deadline=10, jitter=0.5,
+                                  clock=lambda: self.now[0],
+                                  sleep=self.sleep, random=lambda: 1.0)
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now[0] += seconds
+
+    def test_backoff_is_exponential_jittered_and_capped(self):
+        self.assertEqual([ self.policy.delay(n) for n in range(4) ],
+                         [0.5, 1.0, 1.5, 1.5])
+        self.assertEqual(self.policy.delay(0, retry_after='5'), 5.0)
+
+    def test_retry_after_date(self):
+        self.now[0] = 1445412480 - 7
+        self.assertEqual(self.policy.delay(0, retry_after='Wed, 21 Oct 2015 07:28:00 GMT'),
+                         7.0)
+        # Passed already, or nonsense: back off as usual
+        self.now[0] += 60
+        self.assertEqual(self.policy.delay(0, retry_after='Wed, 21 Oct 2015 07:28:00 GMT'),
+                         0.5)
+        self.assertEqual(self.policy.delay(1, retry_after='soon'), 1.0)
+
+    def test_connection_errors_are_retried(self):
+        failures = [requests.exceptions.ConnectionError('reset')] * 2
+        response = mock.Mock(status_code=200)
+
+        def send():
+            if failures:
+                raise failures.pop()
+            return response
+
+        self.assertIs(self.policy.call(send), response)
+        self.assertEqual(self.sleeps, [0.5, 1.0])
+        self.assertEqual(self.policy.stats(), dict(
+            retries=2, retried_calls=1, recovered=1, reconciled=0, gave_up=0))
+
+    def test_gives_up_at_deadline(self):
+        def send():
+            self.now[0] += 4
+            raise requests.exceptions.Timeout('slow')
+
+        with self.assertRaises(requests.exceptions.Timeout):
+            self.policy.call(send)
+        # 4 + 0.5 + 4 + 1.0 leaves no room for another 4 second attempt's wait
+        self.assertEqual(self.sleeps, [0.5, 1.0])
+        self.assertEqual(self.policy.stats()['gave_up'], 1)
+
+class TestEngineRetries(unittest.TestCase):
+    def setUp(self):
+        self.sleeps = []
+        self.policy = RetryPolicy(sleep=self.sleeps.append, random=lambda: 0)
+        self.responses = []
+        self.ref = 'a' * 40
+
+    def handler(self, method, path, headers, body):
+        if method == 'GET' and '/git/refs/' in path:
+            return 200, {}, dict(ref='refs/heads/master', object=dict(sha=self.ref))
+        response = self.responses.pop(0)
+        if method == 'PATCH' and response[0] == 200:
+            self.ref = response[2]['object']['sha']
+        return response
+
+    def make_engine(self, server):
+        return GithubRequestsEngine(
+            username='test',
+            password='test',
+            org='whiskeyriver',
+            repo='ghpick_test',
+            base_url=server.base_url,
+            rate_limiter=False,
+            retry_policy=self.policy)
+
+    def methods(self, server):
+        return [ r['method'] for r in server.requests ]
+
+    def test_get_retried(self):
+        self.responses = [(502, {}, 'Bad Gateway'),
+                          (200, {}, dict(sha='b' * 40))]
+        with LocalGithub(self.handler) as server:
+            blob = self.make_engine(server).get_blob('b' * 40)
+        self.assertEqual(blob['sha'], 'b' * 40)
+        self.assertEqual(self.methods(server), ['GET', 'GET'])
+        self.assertEqual(self.sleeps, [0.5])
+
+    def test_retry_after_date_retried(self):
+        self.responses = [(503, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'},
+                           'Unavailable'),
+                          (200, {}, dict(sha='b' * 40))]
+        with LocalGithub(self.handler) as server:
+            blob = self.make_engine(server).get_blob('b' * 40)
+        self.assertEqual(blob['sha'], 'b' * 40)
+        self.assertEqual(self.methods(server), ['GET', 'GET'])
+
+    def test_blob_post_retried(self):
+        self.responses = [(503, {}, 'Unavailable'),
+                          (201, {}, dict(sha='b' * 40))]
+        with LocalGithub(self.handler) as server:
+            self.make_engine(server).create_blob('hello')
+        self.assertEqual(self.methods(server), ['POST', 'POST'])
+        self.assertEqual(server.requests[0]['body'], server.requests[1]['body'])
+
+    def test_commit_never_retried(self):
+        self.responses = [(502, {}, 'Bad Gateway')]
+        with LocalGithub(self.handler) as server:
+            with self.assertRaises(GithubServiceUnavailable):
+                self.make_engine(server).create_commit(
+                    'message', 't' * 40, ['p' * 40], dict(name='a'))
+        self.assertEqual(self.methods(server), ['POST'])
+        self.assertEqual(self.policy.stats()['retries'], 0)
+
+    def test_branch_update_that_landed_is_not_resent(self):
+        new = 'c' * 40
+
+        def landed_then_failed(method, path, headers, body):
+            if method == 'PATCH':
+                self.ref = new
+                return 502, {}, 'Bad Gateway'
+            return self.handler(method, path, headers, body)
+
+        with LocalGithub(landed_then_failed) as server:
+            ref = self.make_engine(server).point_branch('master', new)
+        self.assertEqual(ref['object']['sha'], new)
+        self.assertEqual(self.methods(server), ['PATCH', 'GET'])
+        self.assertEqual(self.policy.stats()['reconciled'], 1)
+
+    def test_branch_update_that_failed_is_resent(self):
+        new = 'c' * 40
+        self.responses = [(500, {}, dict(message='Server Error')),
+                          (200, {}, dict(ref='refs/heads/master', object=dict(sha=new)))]
+        with LocalGithub(self.handler) as server:
+            engine = self.make_engine(server)
+            ref = engine.point_branch('master', new)
+        self.assertEqual(ref['object']['sha'], new)
+        self.assertEqual(self.methods(server), ['PATCH', 'GET', 'PATCH'])
+        self.assertEqual(engine.retry_stats()['recovered'], 1)
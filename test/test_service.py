@@ -0,0 +1,214 @@
+import os
+import json
+import Queue
+import time
+import signal
+import socket
+import shutil
+import httplib
+import tempfile
+import unittest
+import threading
+
+import requests
+
+from ghpick.service import PickService, _init_worker, _run_job, _worker
+from ghpick_server import LocalGithub, FakeGithub
+
+README = """diff --git a/README.md b/README.md
+index 1111111..2222222 100644
+--- a/README.md
++++ b/README.md
+@@ -1,2 +1,2 @@
+ title
+-one
++two
+"""
+
+OTHER = """diff --git a/other.txt b/other.txt
+index 3333333..4444444 100644
+--- a/other.txt
++++ b/other.txt
+@@ -1 +1 @@
+-other
++changed
+"""
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+class TestPickService(unittest.TestCase):
+    # Seconds each compare takes, so that jobs overlap
+    delay = 0.3
+
+    def setUp(self):
+        # Compares wait for this, to hold a job while it's running
+        self.release = threading.Event()
+        self.release.set()
+        self.github = FakeGithub()
+        root = self.github.add_commit({'README.md': 'title\none\n',
+                                       'other.txt': 'other\n'})
+        self.fix = self.github.add_commit({'README.md': 'title\ntwo\n',
+                                           'other.txt': 'other\n'}, [root], 'fix')
+        self.other = self.github.add_commit({'README.md': 'title\none\n',
+                                             'other.txt': 'changed\n'}, [root], 'other')
+        self.github.patches['{}...{}'.format(root, self.fix)] = README
+        self.github.patches['{}...{}'.format(root, self.other)] = OTHER
+        self.github.refs['heads/rel_1'] = root
+        self.github.refs['heads/rel_2'] = root
+        self.github.refs['heads/diverged'] = self.github.add_commit(
+            {'README.md': 'title\nnope\n', 'other.txt': 'other\n'})
+
+    def handler(self, method, path, headers, body):
+        if '/compare/' in path:
+            self.release.wait(30)
+            time.sleep(self.delay)
+        return self.github(method, path, headers, body)
+
+    def make_service(self, server, **options):
+        return PickService(username='test', password='test',
+                           base_url=server.base_url, processes=2,
+                           applier='python', tree_strategy='flat', **options)
+
+    def submit(self, port, sha, branches):
+        response = requests.post('http://127.0.0.1:{}/jobs'.format(port), data=json.dumps(
+            dict(org='whiskeyriver', repo='ghpick_test', sha=sha, branches=branches)))
+        self.assertEqual(response.status_code, 202)
+        return response.json()
+
+    def wait(self, port, job):
+        return requests.get('http://127.0.0.1:{}/jobs/{}'.format(port, job['id']),
+                            params=dict(wait=30)).json()
+
+    def files(self, branch):
+        commit = self.github.commits[self.github.refs['heads/' + branch]]
+        return dict((x['path'], self.github.blobs[x['sha']])
+                    for x in self.github.trees[commit['tree']])
+
+    def test_branches_in_order_and_in_parallel(self):
+        with LocalGithub(self.handler) as server:
+            with self.make_service(server) as service:
+                port = service.listen()
+                first = self.submit(port, self.fix, ['rel_1'])
+                second = self.submit(port, self.other, ['rel_1'])
+                elsewhere = self.submit(port, self.fix, ['rel_2'])
+                self.assertEqual(second['status'], 'queued')
+                first, second, elsewhere = [ self.wait(port, x)
+                                             for x in (first, second, elsewhere) ]
+
+        for job in (first, second, elsewhere):
+            self.assertEqual(job['status'], 'done')
+            self.assertGreater(job['timings']['requests'], 0)
+        # The second waits for the first and is picked on top of it
+        self.assertGreaterEqual(second['timings']['started'],
+                                first['timings']['finished'])
+        self.assertGreater(second['timings']['queued'], self.delay)
+        self.assertEqual(self.files('rel_1'), {'README.md': 'title\ntwo\n',
+                                               'other.txt': 'changed\n'})
+        self.assertEqual(self.github.refs['heads/rel_1'], second['results']['rel_1']['sha'])
+        # Another branch doesn't wait
+        self.assertLess(elsewhere['timings']['started'], first['timings']['finished'])
+
+    def test_several_branches_and_conflicts(self):
+        with LocalGithub(self.handler) as server:
+            with self.make_service(server) as service:
+                job = service.submit('whiskeyriver', 'ghpick_test', self.fix,
+                                     ['rel_1', 'diverged'])
+                job = service.get(job['id'], wait=30)
+
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(job['results']['rel_1']['sha'], self.github.refs['heads/rel_1'])
+        self.assertTrue(job['results']['diverged']['conflict'])
+        self.assertEqual(self.files('rel_1')['README.md'], 'title\ntwo\n')
+
+    def test_unix_socket(self):
+        self.delay = 0
+        path = tempfile.mkdtemp()
+        try:
+            with LocalGithub(self.handler) as server:
+                with self.make_service(server) as service:
+                    address = service.listen(socket_path=path + '/ghpick.sock')
+                    connection = UnixHTTPConnection(address)
+                    connection.request('POST', '/jobs', json.dumps(
+                        dict(org='whiskeyriver', repo='ghpick_test', sha=self.fix,
+                             branches=['rel_1'])))
+                    job = json.loads(connection.getresponse().read())
+                    connection.request('GET', '/jobs/{}?wait=30'.format(job['id']))
+                    job = json.loads(connection.getresponse().read())
+                    connection.request('GET', '/jobs')
+                    jobs = json.loads(connection.getresponse().read())
+        finally:
+            shutil.rmtree(path)
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(jobs, [job])
+
+    def test_bad_requests(self):
+        with LocalGithub(self.handler) as server:
+            with self.make_service(server) as service:
+                url = 'http://127.0.0.1:{}/jobs'.format(service.listen())
+                self.assertEqual(requests.post(url, data='nope').status_code, 400)
+                missing = requests.post(url, data=json.dumps(dict(org='o', repo='r')))
+                self.assertEqual(missing.status_code, 400)
+                self.assertEqual(missing.json()['message'], 'Missing sha, branches')
+                self.assertEqual(requests.get(url + '/404').status_code, 404)
+
+    def check_lost_job(self, stop, **options):
+        self.delay = 0
+        self.release.clear()
+        with LocalGithub(self.handler) as server:
+            with self.make_service(server, **options) as service:
+                lost = service.submit('whiskeyriver', 'ghpick_test', self.fix, ['rel_1'])
+                after = service.submit('whiskeyriver', 'ghpick_test', self.other, ['rel_1'])
+                for _ in range(100):
+                    pid = service.get(lost['id'])['worker']
+                    if pid:
+                        break
+                    time.sleep(0.1)
+                stop(pid)
+                lost = service.get(lost['id'], wait=10)
+                self.release.set()
+                after = service.get(after['id'], wait=30)
+
+        self.assertEqual(lost['status'], 'failed')
+        self.assertEqual(after['status'], 'done')
+        self.assertEqual(self.files('rel_1')['other.txt'], 'changed\n')
+        return lost
+
+    def test_killed_worker(self):
+        lost = self.check_lost_job(lambda pid: os.kill(pid, signal.SIGKILL))
+        self.assertIn('died', lost['error'])
+
+    def test_job_timeout(self):
+        lost = self.check_lost_job(lambda pid: None, job_timeout=1)
+        self.assertIn('longer than 1 seconds', lost['error'])
+
+class TestWorker(unittest.TestCase):
+    def test_known_blobs_bounded(self):
+        github = FakeGithub()
+        root = github.add_commit({'README.md': 'title\none\n', 'other.txt': 'other\n'})
+        fix = github.add_commit({'README.md': 'title\ntwo\n', 'other.txt': 'other\n'},
+                                [root], 'fix')
+        github.patches['{}...{}'.format(root, fix)] = README
+        github.refs['heads/rel_1'] = root
+
+        def job(id, sha):
+            return dict(id=id, org='whiskeyriver', repo='ghpick_test', sha=sha,
+                        branches=['rel_1'], message=None)
+
+        with LocalGithub(github) as server:
+            _init_worker(dict(username='test', password='test',
+                              base_url=server.base_url, applier='python',
+                              fetch_strategy='tree', tree_strategy='flat'),
+                         None, Queue.Queue(), 1)
+            self.assertIsNone(_run_job(job(1, fix))['error'])
+            cherry = _worker['picks'][('whiskeyriver', 'ghpick_test')]
+            self.assertGreater(len(cherry.known_blobs), 1)
+            # Forgotten before the next job starts
+            _run_job(job(2, 'f' * 40))
+            self.assertEqual(cherry.known_blobs, set())